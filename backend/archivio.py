@@ -0,0 +1,953 @@
+#!/usr/bin/env python3
+"""
+Archivio dei dati: interfaccia comune e backend SQLite integrato
+Il backend PostgreSQL (pool, LISTEN/NOTIFY, migrazioni in migrations.py) è in
+backend.py; questo modulo definisce le operazioni che entrambi forniscono e
+la variante SQLite per le feste piccole, senza database ospitato.
+
+Si sceglie con DATABASE_URL: postgresql://... oppure sqlite:///festa_sport.db
+(percorso relativo alla cartella backend, sqlite:////percorso/assoluto.db).
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime
+
+import metriche
+import tracciamento
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+SQLITE_PREDEFINITO = "sqlite:///festa_sport.db"
+SQLITE_ATTESA_LOCK = int(os.environ.get("SQLITE_ATTESA_LOCK", 5000))  # millisecondi
+SQLITE_RESYNC = 1.0  # secondi tra i controlli di versione degli altri processi
+EXPORT_BLOCCO = 2000
+
+# Colonne esposte dei feedback (con PostgreSQL la tabella ha anche il tsvector di ricerca)
+COLONNE_FEEDBACK = "id, nome, rating, message, timestamp"
+
+# Righe di feedback e promemoria lette dalle tabelle riassuntive, più l'ultimo id
+# (dalla chiave primaria), per gli ETag (stesso SQL per entrambi i backend)
+SQL_CONTEGGI_RISORSE = """
+    SELECT (SELECT COALESCE(SUM(totale), 0) FROM stat_rating) AS feedbacks,
+           (SELECT COALESCE(MAX(id), 0) FROM feedbacks) AS feedbacks_id,
+           (SELECT COALESCE(MAX(valore), 0) FROM stat_contatori WHERE chiave = 'promemoria') AS reminder_requests,
+           (SELECT COALESCE(MAX(id), 0) FROM reminder_requests) AS reminder_requests_id
+"""
+
+# Posti di uno slot: prenotazioni più trattenute attive (escluso il token del
+# cliente, se è per questo slot e tavolo con gli stessi ospiti)
+SQL_OCCUPATI_SQLITE = """
+    SELECT (SELECT COALESCE(SUM(ospiti), 0) FROM prenotazioni
+            WHERE data = :data AND ora = :ora AND tavolo = :tavolo)
+         + (SELECT COALESCE(SUM(ospiti), 0) FROM trattenute
+            WHERE data = :data AND ora = :ora AND tavolo = :tavolo
+              AND scade > :adesso AND (token IS NOT :trattenuta OR ospiti <> :ospiti)) AS posti
+"""
+
+def filtri_prenotazioni(data=None, ora=None, tavolo=None, segnaposto="%s"):
+    """Clausola WHERE e parametri per i filtri opzionali (valori già normalizzati)"""
+    query = "1=1"
+    params = []
+    if data:
+        query += f" AND data = {segnaposto}"
+        params.append(data)
+    if ora:
+        query += f" AND ora = {segnaposto}"
+        params.append(ora)
+    if tavolo:
+        query += f" AND tavolo = {segnaposto}"
+        params.append(tavolo)
+    return query, params
+
+def verifica_capienza(prenotazioni, occupati):
+    """Esito di ogni prenotazione di un blocco contro la stessa fotografia dell'occupazione.
+
+    `prenotazioni` sono tuple (nome, telefono, data, ora, ospiti, tavolo, note, capienza),
+    `occupati` i posti per (data, ora, tavolo), aggiornato con quelle accettate.
+    Restituisce (accettata, posti occupati prima) nell'ordine del blocco.
+    """
+    esiti = []
+    for _, _, data, ora, ospiti, tavolo, _, capienza in prenotazioni:
+        posti = occupati.get((data, ora, tavolo), 0)
+        accettata = posti + ospiti <= capienza
+        if accettata:
+            occupati[(data, ora, tavolo)] = posti + ospiti
+        esiti.append((accettata, posti))
+    return esiti
+
+class Archivio(ABC):
+    """Operazioni sui dati usate dagli endpoint.
+
+    Date e ore sono sempre stringhe canoniche ('YYYY-MM-DD', 'HH:MM'); le righe
+    restituite sono dizionari, tranne le liste (lista_*) che restituiscono
+    (colonne, righe tuple) per la serializzazione veloce. `dopo` è la chiave
+    dell'ultima riga della pagina precedente (paginazione keyset), None per la
+    prima pagina. Classe astratta: un backend a cui manca un'operazione fallisce
+    già alla creazione, non alla prima richiesta che la usa.
+    """
+
+    nome = ""
+    segnaposto = "%s"
+    scrittura_differita = False  # supporta la coda di scrittura differita
+    notifiche_push = False       # le prenotazioni degli altri processi arrivano da notifiche()
+
+    # --- gestione ---
+    @abstractmethod
+    def connessione(self):
+        """Context manager con una connessione DB-API (righe come dizionari) per script e manutenzione"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def ping(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def stats(self):
+        raise NotImplementedError
+
+    def saturo(self):
+        """True se una nuova query dovrebbe attendere una connessione libera"""
+        return False
+
+    @abstractmethod
+    def schema(self):
+        """{"attuale": versione applicata, "richiesta": versione prevista dal codice}"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def migra(self):
+        """Porta lo schema all'ultima versione; restituisce le migrazioni applicate"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def riconcilia_statistiche(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def chiudi(self):
+        raise NotImplementedError
+
+    # --- occupazione ---
+    @abstractmethod
+    def max_id_prenotazioni(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def totali_occupazione(self, data=None):
+        """Righe (data, ora, tavolo, ospiti) sommate per slot e tavolo"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def posti_occupati(self, data, ora):
+        """{tavolo: ospiti} per uno slot, trattenute attive comprese"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def posti_occupati_tavolo(self, data, ora, tavolo):
+        """Posti occupati su un tavolo, trattenute attive comprese"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def notifiche(self):
+        """Context manager con un oggetto `attendi(timeout)` che restituisce i payload
+        delle prenotazioni degli altri processi, o None allo scadere del timeout"""
+        raise NotImplementedError
+
+    # --- prenotazioni ---
+    @abstractmethod
+    def inserisci_prenotazione(self, nome, telefono, data, ora, ospiti, tavolo, note, capienza, trattenuta=None):
+        """Controllo capienza e INSERT atomici; (id o None se pieno, posti occupati prima).
+
+        I posti occupati comprendono le trattenute attive, tranne `trattenuta`
+        (il token del cliente) se è per lo stesso data/ora/tavolo con gli stessi
+        ospiti: in quel caso viene consumata se la prenotazione riesce.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def inserisci_prenotazioni(self, prenotazioni):
+        """Blocco di prenotazioni (tuple come gli argomenti di inserisci_prenotazione) in una
+        transazione: per ognuna (id o None se pieno, posti occupati prima)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def inserisci_assegnazione(self, data, ora, tavoli, scegli):
+        """Assegnazione automatica atomica: con i tavoli `tavoli` dello slot bloccati,
+        `scegli(occupati per tavolo)` restituisce le prenotazioni da inserire (tuple come
+        in inserisci_prenotazioni, senza capienza) o None. Restituisce [(id, prenotazione)]
+        oppure None se non c'è posto."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def lista_prenotazioni(self, data, ora, tavolo, dopo, limite):
+        """(colonne, righe) delle prenotazioni in ordine (data, ora, id) decrescente"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def esporta_prenotazioni(self, data, ora, tavolo):
+        """Generatore: prima la lista delle colonne, poi le righe come tuple"""
+        raise NotImplementedError
+
+    # --- trattenute ---
+    @abstractmethod
+    def inserisci_trattenuta(self, token, data, ora, tavolo, ospiti, capienza, scade):
+        """Trattiene `ospiti` posti fino a `scade` (epoch) se ci stanno, contando prenotazioni
+        e trattenute attive; (inserita, posti occupati prima)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def rilascia_trattenuta(self, token):
+        """Elimina la trattenuta; True se esisteva"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def trattenute_attive(self):
+        """Righe (token, data, ora, tavolo, ospiti, scade) delle trattenute non scadute"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def firma_trattenute(self):
+        """(numero, posti) delle trattenute attive, per accorgersi di quelle degli altri
+        processi senza notifiche"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def pulisci_trattenute(self):
+        """Elimina le trattenute scadute; restituisce quante"""
+        raise NotImplementedError
+
+    # --- feedback e promemoria ---
+    @abstractmethod
+    def inserisci_feedback(self, nome, rating, message, timestamp):
+        raise NotImplementedError
+
+    @abstractmethod
+    def lista_feedback(self, dopo, limite):
+        """(colonne, righe) dei feedback in ordine (timestamp, id) decrescente"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def esporta_feedback(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def cerca_feedback(self, testo, rating_min, rating_max, dopo, limite):
+        """(colonne, righe) dei feedback il cui messaggio contiene `testo`, con rating nell'intervallo,
+        in ordine di rilevanza decrescente (poi id); `dopo` è la coppia (rilevanza, id) dell'ultima
+        riga della pagina precedente"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def inserisci_promemoria(self, contact, timestamp):
+        raise NotImplementedError
+
+    @abstractmethod
+    def lista_promemoria(self, limite):
+        """(colonne, righe) delle richieste di promemoria più recenti"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def promemoria_da_inviare(self, tentativi_max):
+        """Generatore come esporta_*: righe (id, contact, tentativi) non ancora inviate e
+        con meno di `tentativi_max` tentativi falliti, in ordine di id"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def contatti_inviati(self):
+        """Generatore come esporta_*: righe (contact,) dei promemoria già inviati"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def segna_promemoria(self, inviati, falliti):
+        """Registra l'esito di un blocco di invii in una transazione: `inviati` sono id,
+        `falliti` tuple (id, tentativi, errore)"""
+        raise NotImplementedError
+
+    # --- statistiche ---
+    @abstractmethod
+    def statistiche(self):
+        """(righe stat_slot, righe stat_rating, totale promemoria)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def conteggi_risorse(self):
+        """Numero di feedback e promemoria e ultimo id di ciascuno, per gli ETag"""
+        raise NotImplementedError
+
+    # --- idempotenza ---
+    @abstractmethod
+    def prenota_chiave(self, endpoint, chiave, impronta):
+        """Riserva la chiave; (True, None) se nuova, altrimenti (False, riga esistente o None)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def salva_risposta(self, endpoint, chiave, stato, corpo):
+        raise NotImplementedError
+
+    @abstractmethod
+    def libera_chiave(self, endpoint, chiave):
+        raise NotImplementedError
+
+    @abstractmethod
+    def pulisci_chiavi(self, ttl):
+        raise NotImplementedError
+
+# ================================
+# SQLITE
+# ================================
+# Un file WAL sulla stessa macchina del server: letture concorrenti senza
+# blocchi, scritture serializzate con BEGIN IMMEDIATE (anche tra worker).
+PRAGMA_SQLITE = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",      # con WAL resta consistente dopo un crash
+    f"PRAGMA busy_timeout = {SQLITE_ATTESA_LOCK}",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",       # 16 MB di cache per connessione
+    "PRAGMA mmap_size = 134217728",     # 128 MB letti via mmap
+)
+
+# I timestamp sono salvati come testo ISO e riletti come datetime
+sqlite3.register_adapter(datetime, lambda valore: valore.isoformat(" "))
+sqlite3.register_converter("TIMESTAMP", lambda valore: datetime.fromisoformat(valore.decode()))
+
+def percorso_sqlite(url):
+    """Percorso del file da un URL sqlite:///... (relativo alla cartella backend)"""
+    percorso = url[len("sqlite:///"):]
+    return percorso if os.path.isabs(percorso) else os.path.join(BACKEND_DIR, percorso)
+
+def _riga_dizionario(cursore, riga):
+    return {colonna[0]: valore for colonna, valore in zip(cursore.description, riga)}
+
+class CursoreSQLite(sqlite3.Cursor):
+    """Cursore che somma il tempo delle query alla richiesta (come CursoreMisurato)"""
+
+    def execute(self, query, parametri=()):
+        inizio = time.perf_counter()
+        try:
+            risultato = super().execute(query, parametri)
+        finally:
+            durata = time.perf_counter() - inizio
+            metriche.registra_db(durata)
+        if tracciamento.ATTIVO:
+            tracciamento.registra(None, query, parametri, durata, self.rowcount, metriche.route_corrente())
+        return risultato
+
+MIGRAZIONI_SQLITE = []  # (versione, nome, script) allineate alle migrazioni PostgreSQL
+
+def migrazione_sqlite(versione, nome, script):
+    MIGRAZIONI_SQLITE.append((versione, nome, script))
+
+migrazione_sqlite(1, "schema_iniziale", """
+    CREATE TABLE IF NOT EXISTS prenotazioni (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nome TEXT NOT NULL,
+        telefono TEXT NOT NULL,
+        data TEXT NOT NULL,
+        ora TEXT NOT NULL,
+        ospiti INTEGER NOT NULL,
+        tavolo TEXT NOT NULL,
+        note TEXT DEFAULT '',
+        timestamp TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))
+    );
+    CREATE TABLE IF NOT EXISTS feedbacks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nome TEXT DEFAULT 'Anonimo',
+        rating INTEGER NOT NULL CHECK (rating BETWEEN 0 AND 5),
+        message TEXT NOT NULL,
+        timestamp TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))
+    );
+    CREATE TABLE IF NOT EXISTS reminder_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        contact TEXT NOT NULL,
+        timestamp TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))
+    );
+
+    -- Coprente per le somme di occupazione, poi paginazione keyset
+    CREATE INDEX IF NOT EXISTS idx_prenotazioni_occupazione ON prenotazioni(data, ora, tavolo, ospiti);
+    CREATE INDEX IF NOT EXISTS idx_prenotazioni_data_ora_id ON prenotazioni(data, ora, id);
+    CREATE INDEX IF NOT EXISTS idx_prenotazioni_tavolo_data_ora_id ON prenotazioni(tavolo, data, ora, id);
+    CREATE INDEX IF NOT EXISTS idx_feedbacks_timestamp_id ON feedbacks(timestamp, id);
+    CREATE INDEX IF NOT EXISTS idx_reminder_timestamp ON reminder_requests(timestamp);
+
+    CREATE TABLE IF NOT EXISTS stat_slot (
+        data TEXT NOT NULL,
+        ora TEXT NOT NULL,
+        prenotazioni INTEGER NOT NULL DEFAULT 0,
+        ospiti INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (data, ora)
+    );
+    CREATE TABLE IF NOT EXISTS stat_rating (
+        rating INTEGER PRIMARY KEY,
+        totale INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS stat_contatori (
+        chiave TEXT PRIMARY KEY,
+        valore INTEGER NOT NULL DEFAULT 0
+    );
+
+    CREATE TRIGGER IF NOT EXISTS stat_prenotazioni_ins AFTER INSERT ON prenotazioni BEGIN
+        INSERT INTO stat_slot (data, ora, prenotazioni, ospiti) VALUES (NEW.data, NEW.ora, 1, NEW.ospiti)
+        ON CONFLICT (data, ora) DO UPDATE
+        SET prenotazioni = prenotazioni + 1, ospiti = ospiti + excluded.ospiti;
+    END;
+    CREATE TRIGGER IF NOT EXISTS stat_prenotazioni_del AFTER DELETE ON prenotazioni BEGIN
+        UPDATE stat_slot SET prenotazioni = prenotazioni - 1, ospiti = ospiti - OLD.ospiti
+        WHERE data = OLD.data AND ora = OLD.ora;
+    END;
+    CREATE TRIGGER IF NOT EXISTS stat_prenotazioni_upd AFTER UPDATE OF data, ora, ospiti ON prenotazioni BEGIN
+        UPDATE stat_slot SET prenotazioni = prenotazioni - 1, ospiti = ospiti - OLD.ospiti
+        WHERE data = OLD.data AND ora = OLD.ora;
+        INSERT INTO stat_slot (data, ora, prenotazioni, ospiti) VALUES (NEW.data, NEW.ora, 1, NEW.ospiti)
+        ON CONFLICT (data, ora) DO UPDATE
+        SET prenotazioni = prenotazioni + 1, ospiti = ospiti + excluded.ospiti;
+    END;
+    CREATE TRIGGER IF NOT EXISTS stat_feedbacks_ins AFTER INSERT ON feedbacks BEGIN
+        INSERT INTO stat_rating (rating, totale) VALUES (NEW.rating, 1)
+        ON CONFLICT (rating) DO UPDATE SET totale = totale + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS stat_feedbacks_del AFTER DELETE ON feedbacks BEGIN
+        UPDATE stat_rating SET totale = totale - 1 WHERE rating = OLD.rating;
+    END;
+    CREATE TRIGGER IF NOT EXISTS stat_feedbacks_upd AFTER UPDATE OF rating ON feedbacks BEGIN
+        UPDATE stat_rating SET totale = totale - 1 WHERE rating = OLD.rating;
+        INSERT INTO stat_rating (rating, totale) VALUES (NEW.rating, 1)
+        ON CONFLICT (rating) DO UPDATE SET totale = totale + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS stat_promemoria_ins AFTER INSERT ON reminder_requests BEGIN
+        INSERT INTO stat_contatori (chiave, valore) VALUES ('promemoria', 1)
+        ON CONFLICT (chiave) DO UPDATE SET valore = valore + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS stat_promemoria_del AFTER DELETE ON reminder_requests BEGIN
+        UPDATE stat_contatori SET valore = valore - 1 WHERE chiave = 'promemoria';
+    END;
+""")
+
+# Date e ore sono già testo canonico e ordinabile: nessuna conversione
+migrazione_sqlite(2, "data_ora_tipizzate", "")
+
+migrazione_sqlite(3, "richieste_idempotenti", """
+    CREATE TABLE IF NOT EXISTS richieste_idempotenti (
+        endpoint TEXT NOT NULL,
+        chiave TEXT NOT NULL,
+        impronta TEXT NOT NULL,
+        stato INTEGER,
+        risposta TEXT,
+        creata TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
+        PRIMARY KEY (endpoint, chiave)
+    );
+    CREATE INDEX IF NOT EXISTS idx_richieste_idempotenti_creata ON richieste_idempotenti(creata);
+""")
+
+migrazione_sqlite(4, "trattenute", """
+    CREATE TABLE IF NOT EXISTS trattenute (
+        token TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        ora TEXT NOT NULL,
+        tavolo TEXT NOT NULL,
+        ospiti INTEGER NOT NULL,
+        scade REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_trattenute_slot ON trattenute(data, ora, tavolo, ospiti, scade);
+    CREATE INDEX IF NOT EXISTS idx_trattenute_scade ON trattenute(scade);
+""")
+
+migrazione_sqlite(5, "invio_promemoria", """
+    ALTER TABLE reminder_requests ADD COLUMN inviato TIMESTAMP;
+    ALTER TABLE reminder_requests ADD COLUMN tentativi INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE reminder_requests ADD COLUMN errore TEXT;
+    CREATE INDEX IF NOT EXISTS idx_reminder_da_inviare ON reminder_requests(id) WHERE inviato IS NULL;
+""")
+
+# FTS5 al posto di tsvector e GIN: indice invertito sui messaggi, tenuto
+# allineato dai trigger (senza stemming italiano, accenti ignorati)
+migrazione_sqlite(6, "ricerca_feedback", """
+    CREATE VIRTUAL TABLE IF NOT EXISTS feedbacks_ricerca USING fts5(
+        message, content = 'feedbacks', content_rowid = 'id', tokenize = 'unicode61 remove_diacritics 2'
+    );
+    CREATE TRIGGER IF NOT EXISTS feedbacks_ricerca_ins AFTER INSERT ON feedbacks BEGIN
+        INSERT INTO feedbacks_ricerca (rowid, message) VALUES (NEW.id, NEW.message);
+    END;
+    CREATE TRIGGER IF NOT EXISTS feedbacks_ricerca_del AFTER DELETE ON feedbacks BEGIN
+        INSERT INTO feedbacks_ricerca (feedbacks_ricerca, rowid, message) VALUES ('delete', OLD.id, OLD.message);
+    END;
+    CREATE TRIGGER IF NOT EXISTS feedbacks_ricerca_upd AFTER UPDATE OF message ON feedbacks BEGIN
+        INSERT INTO feedbacks_ricerca (feedbacks_ricerca, rowid, message) VALUES ('delete', OLD.id, OLD.message);
+        INSERT INTO feedbacks_ricerca (rowid, message) VALUES (NEW.id, NEW.message);
+    END;
+    INSERT INTO feedbacks_ricerca (feedbacks_ricerca) VALUES ('rebuild');
+""")
+
+class AscoltatoreSQLite:
+    """SQLite non ha notifiche: ogni attesa termina con un controllo di versione"""
+
+    def attendi(self, timeout):
+        time.sleep(min(timeout, SQLITE_RESYNC))
+        return None
+
+class ArchivioSQLite(Archivio):
+    """Archivio su file SQLite locale (una connessione per thread)"""
+
+    nome = "sqlite"
+    segnaposto = "?"
+
+    def __init__(self, percorso):
+        self.percorso = percorso
+        self.pid = os.getpid()
+        self._locale = threading.local()
+        self._lock = threading.Lock()
+        self._connessioni = []
+        self._schema = {"attuale": None, "richiesta": max(v for v, _, _ in MIGRAZIONI_SQLITE)}
+        self._migrato = False
+
+    def _apri(self):
+        conn = sqlite3.connect(
+            self.percorso,
+            isolation_level=None,  # transazioni esplicite
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False
+        )
+        conn.row_factory = _riga_dizionario
+        for pragma in PRAGMA_SQLITE:
+            conn.execute(pragma)
+        return conn
+
+    def _conn(self):
+        conn = getattr(self._locale, "conn", None)
+        if conn is None:
+            conn = self._apri()
+            self._locale.conn = conn
+            with self._lock:
+                self._connessioni.append(conn)
+                migrare = not self._migrato
+                self._migrato = True
+            if migrare:
+                # File locale: lo schema si aggiorna alla prima connessione del processo
+                self.migra()
+        return conn
+
+    def _cursore(self):
+        return self._conn().cursor(CursoreSQLite)
+
+    @contextmanager
+    def _transazione(self):
+        """BEGIN IMMEDIATE: prende subito il lock di scrittura (niente deadlock tra lettori che scrivono)"""
+        cur = self._cursore()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            yield cur
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        cur.execute("COMMIT")
+
+    # --- gestione ---
+    @contextmanager
+    def connessione(self):
+        yield self._conn()
+
+    def ping(self):
+        self._cursore().execute("SELECT 1")
+
+    def stats(self):
+        with self._lock:
+            aperte = len(self._connessioni)
+        return {
+            "motore": "sqlite",
+            "pid": self.pid,
+            "file": self.percorso,
+            "connessioni": aperte,
+            "sqlite": sqlite3.sqlite_version
+        }
+
+    def schema(self):
+        return self._schema
+
+    def migra(self):
+        with self._lock:
+            self._migrato = True  # niente migrazione automatica alla prima connessione
+        conn = self._conn()
+        applicate = 0
+        conn.execute("BEGIN IMMEDIATE")  # un solo processo alla volta
+        try:
+            attuale = conn.execute("PRAGMA user_version").fetchone()["user_version"]
+            for versione, nome, script in sorted(MIGRAZIONI_SQLITE):
+                if versione <= attuale:
+                    continue
+                print(f"[MIGRAZIONE] {versione:03d} {nome} (sqlite)...")
+                for istruzione in _istruzioni(script):
+                    conn.execute(istruzione)
+                conn.execute(f"PRAGMA user_version = {versione}")
+                attuale = versione
+                applicate += 1
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._schema["attuale"] = attuale
+        return applicate
+
+    def riconcilia_statistiche(self):
+        with self._transazione() as cur:
+            cur.execute("DELETE FROM stat_slot")
+            cur.execute("""
+                INSERT INTO stat_slot (data, ora, prenotazioni, ospiti)
+                SELECT data, ora, COUNT(*), SUM(ospiti) FROM prenotazioni GROUP BY data, ora
+            """)
+            cur.execute("DELETE FROM stat_rating")
+            cur.execute("INSERT INTO stat_rating (rating, totale) SELECT rating, COUNT(*) FROM feedbacks GROUP BY rating")
+            cur.execute("DELETE FROM stat_contatori")
+            cur.execute("""
+                INSERT INTO stat_contatori (chiave, valore)
+                SELECT 'promemoria', COUNT(*) FROM reminder_requests
+                UNION ALL SELECT 'inizializzato', 1
+            """)
+
+    def chiudi(self):
+        with self._lock:
+            connessioni, self._connessioni = self._connessioni, []
+        for conn in connessioni:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    # --- occupazione ---
+    def max_id_prenotazioni(self):
+        cur = self._cursore()
+        cur.execute("SELECT COALESCE(MAX(id), 0) AS max_id FROM prenotazioni")
+        return cur.fetchone()["max_id"]
+
+    def totali_occupazione(self, data=None):
+        query = "SELECT data, ora, tavolo, SUM(ospiti) AS ospiti FROM prenotazioni"
+        params = []
+        if data:
+            query += " WHERE data = ?"
+            params.append(data)
+        cur = self._cursore()
+        cur.execute(query + " GROUP BY data, ora, tavolo", params)
+        return [(r["data"], r["ora"], r["tavolo"], r["ospiti"]) for r in cur.fetchall()]
+
+    def posti_occupati(self, data, ora):
+        cur = self._cursore()
+        cur.execute(
+            """
+            SELECT tavolo, SUM(ospiti) AS ospiti FROM (
+                SELECT tavolo, ospiti FROM prenotazioni WHERE data = ? AND ora = ?
+                UNION ALL
+                SELECT tavolo, ospiti FROM trattenute WHERE data = ? AND ora = ? AND scade > ?
+            ) GROUP BY tavolo
+            """,
+            (data, ora, data, ora, time.time())
+        )
+        return {r["tavolo"]: r["ospiti"] for r in cur.fetchall()}
+
+    def posti_occupati_tavolo(self, data, ora, tavolo):
+        return self._occupati_slot(self._cursore(), data, ora, tavolo)
+
+    @contextmanager
+    def notifiche(self):
+        yield AscoltatoreSQLite()
+
+    def _occupati_slot(self, cur, data, ora, tavolo, trattenuta=None, ospiti=0):
+        cur.execute(SQL_OCCUPATI_SQLITE, {
+            "data": data, "ora": ora, "tavolo": tavolo, "adesso": time.time(),
+            "trattenuta": trattenuta, "ospiti": ospiti
+        })
+        return cur.fetchone()["posti"]
+
+    # --- prenotazioni ---
+    def inserisci_prenotazione(self, nome, telefono, data, ora, ospiti, tavolo, note, capienza, trattenuta=None):
+        with self._transazione() as cur:
+            posti = self._occupati_slot(cur, data, ora, tavolo, trattenuta, ospiti)
+            if posti + ospiti > capienza:
+                return None, posti
+            cur.execute(
+                """
+                INSERT INTO prenotazioni (nome, telefono, data, ora, ospiti, tavolo, note, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (nome, telefono, data, ora, ospiti, tavolo, note, datetime.now())
+            )
+            if trattenuta:
+                cur.execute(
+                    "DELETE FROM trattenute WHERE token = ? AND data = ? AND ora = ? AND tavolo = ? AND ospiti = ?",
+                    (trattenuta, data, ora, tavolo, ospiti)
+                )
+            return cur.lastrowid, posti
+
+    def inserisci_prenotazioni(self, prenotazioni):
+        with self._transazione() as cur:
+            occupati = {}
+            for slot in {(data, ora, tavolo) for _, _, data, ora, _, tavolo, _, _ in prenotazioni}:
+                occupati[slot] = self._occupati_slot(cur, *slot)
+            risultati = []
+            adesso = datetime.now()
+            for prenotazione, (accettata, posti) in zip(prenotazioni, verifica_capienza(prenotazioni, occupati)):
+                if not accettata:
+                    risultati.append((None, posti))
+                    continue
+                cur.execute(
+                    """
+                    INSERT INTO prenotazioni (nome, telefono, data, ora, ospiti, tavolo, note, timestamp)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (*prenotazione[:7], adesso)
+                )
+                risultati.append((cur.lastrowid, posti))
+            return risultati
+
+    def inserisci_assegnazione(self, data, ora, tavoli, scegli):
+        with self._transazione() as cur:
+            cur.execute(
+                """
+                SELECT tavolo, SUM(ospiti) AS posti FROM (
+                    SELECT tavolo, ospiti FROM prenotazioni WHERE data = ? AND ora = ?
+                    UNION ALL
+                    SELECT tavolo, ospiti FROM trattenute WHERE data = ? AND ora = ? AND scade > ?
+                ) GROUP BY tavolo
+                """,
+                (data, ora, data, ora, time.time())
+            )
+            prenotazioni = scegli({riga["tavolo"]: riga["posti"] for riga in cur.fetchall()})
+            if not prenotazioni:
+                return None
+            risultati = []
+            adesso = datetime.now()
+            for prenotazione in prenotazioni:
+                cur.execute(
+                    """
+                    INSERT INTO prenotazioni (nome, telefono, data, ora, ospiti, tavolo, note, timestamp)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (*prenotazione, adesso)
+                )
+                risultati.append((cur.lastrowid, prenotazione))
+            return risultati
+
+    # --- trattenute ---
+    def inserisci_trattenuta(self, token, data, ora, tavolo, ospiti, capienza, scade):
+        with self._transazione() as cur:
+            # Le scadute dello slot non servono più: la tabella resta piccola
+            cur.execute(
+                "DELETE FROM trattenute WHERE data = ? AND ora = ? AND tavolo = ? AND scade <= ?",
+                (data, ora, tavolo, time.time())
+            )
+            posti = self._occupati_slot(cur, data, ora, tavolo)
+            if posti + ospiti > capienza:
+                return False, posti
+            cur.execute(
+                "INSERT INTO trattenute (token, data, ora, tavolo, ospiti, scade) VALUES (?, ?, ?, ?, ?, ?)",
+                (token, data, ora, tavolo, ospiti, scade)
+            )
+            return True, posti
+
+    def rilascia_trattenuta(self, token):
+        cur = self._cursore()
+        cur.execute("DELETE FROM trattenute WHERE token = ?", (token,))
+        return cur.rowcount > 0
+
+    def trattenute_attive(self):
+        cur = self._cursore()
+        cur.execute(
+            "SELECT token, data, ora, tavolo, ospiti, scade FROM trattenute WHERE scade > ?",
+            (time.time(),)
+        )
+        return [(r["token"], r["data"], r["ora"], r["tavolo"], r["ospiti"], r["scade"]) for r in cur.fetchall()]
+
+    def firma_trattenute(self):
+        cur = self._cursore()
+        cur.execute(
+            "SELECT COUNT(*) AS numero, COALESCE(SUM(ospiti), 0) AS posti FROM trattenute WHERE scade > ?",
+            (time.time(),)
+        )
+        riga = cur.fetchone()
+        return riga["numero"], riga["posti"]
+
+    def pulisci_trattenute(self):
+        cur = self._cursore()
+        cur.execute("DELETE FROM trattenute WHERE scade <= ?", (time.time(),))
+        return cur.rowcount
+
+    def lista_prenotazioni(self, data, ora, tavolo, dopo, limite):
+        filtri, params = filtri_prenotazioni(data, ora, tavolo, "?")
+        query = "SELECT * FROM prenotazioni WHERE " + filtri
+        if dopo:
+            query += " AND (data, ora, id) < (?, ?, ?)"
+            params.extend(dopo)
+        query += " ORDER BY data DESC, ora DESC, id DESC LIMIT ?"
+        params.append(limite)
+        return self._lista(query, params)
+
+    def _lista(self, query, params):
+        cur = self._cursore()
+        cur.row_factory = None  # tuple
+        cur.execute(query, params)
+        return tuple(c[0] for c in cur.description), cur.fetchall()
+
+    def _esporta(self, query, params):
+        # Connessione dedicata: il generatore può essere consumato da un altro thread
+        conn = sqlite3.connect(self.percorso, detect_types=sqlite3.PARSE_DECLTYPES)
+        try:
+            cur = conn.execute(query, params)
+            yield [c[0] for c in cur.description]
+            while True:
+                blocco = cur.fetchmany(EXPORT_BLOCCO)
+                if not blocco:
+                    return
+                yield from blocco
+        finally:
+            conn.close()
+
+    def esporta_prenotazioni(self, data, ora, tavolo):
+        filtri, params = filtri_prenotazioni(data, ora, tavolo, "?")
+        return self._esporta(
+            f"SELECT id, nome, telefono, data, ora, ospiti, tavolo, note, timestamp FROM prenotazioni "
+            f"WHERE {filtri} ORDER BY data, ora, tavolo, id",
+            params
+        )
+
+    # --- feedback e promemoria ---
+    def inserisci_feedback(self, nome, rating, message, timestamp):
+        cur = self._cursore()
+        cur.execute(
+            "INSERT INTO feedbacks (nome, rating, message, timestamp) VALUES (?, ?, ?, ?)",
+            (nome, rating, message, timestamp)
+        )
+        return cur.lastrowid
+
+    def lista_feedback(self, dopo, limite):
+        query = f"SELECT {COLONNE_FEEDBACK} FROM feedbacks"
+        params = []
+        if dopo:
+            query += " WHERE (timestamp, id) < (?, ?)"
+            params.extend(dopo)
+        query += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+        params.append(limite)
+        return self._lista(query, params)
+
+    def esporta_feedback(self):
+        return self._esporta(f"SELECT {COLONNE_FEEDBACK} FROM feedbacks ORDER BY timestamp, id", [])
+
+    def cerca_feedback(self, testo, rating_min, rating_max, dopo, limite):
+        query = _query_fts(testo)
+        if not query:
+            return ("id", "nome", "rating", "message", "timestamp", "rilevanza"), []
+        # bm25 è negativo (più piccolo = più rilevante): lo si inverte per ordinare come ts_rank
+        sql = """
+            SELECT * FROM (
+                SELECT f.id, f.nome, f.rating, f.message, f.timestamp, -bm25(feedbacks_ricerca) AS rilevanza
+                FROM feedbacks_ricerca JOIN feedbacks AS f ON f.id = feedbacks_ricerca.rowid
+                WHERE feedbacks_ricerca MATCH ? AND f.rating BETWEEN ? AND ?
+            )
+        """
+        params = [query, rating_min, rating_max]
+        if dopo:
+            sql += " WHERE (rilevanza, id) < (?, ?)"
+            params.extend(dopo)
+        sql += " ORDER BY rilevanza DESC, id DESC LIMIT ?"
+        params.append(limite)
+        return self._lista(sql, params)
+
+    def inserisci_promemoria(self, contact, timestamp):
+        cur = self._cursore()
+        cur.execute("INSERT INTO reminder_requests (contact, timestamp) VALUES (?, ?)", (contact, timestamp))
+        return cur.lastrowid
+
+    def lista_promemoria(self, limite):
+        return self._lista("SELECT * FROM reminder_requests ORDER BY timestamp DESC LIMIT ?", (limite,))
+
+    def promemoria_da_inviare(self, tentativi_max):
+        return self._esporta(
+            "SELECT id, contact, tentativi FROM reminder_requests "
+            "WHERE inviato IS NULL AND tentativi < ? ORDER BY id",
+            (tentativi_max,)
+        )
+
+    def contatti_inviati(self):
+        return self._esporta("SELECT contact FROM reminder_requests WHERE inviato IS NOT NULL", ())
+
+    def segna_promemoria(self, inviati, falliti):
+        with self._transazione() as cur:
+            adesso = datetime.now()
+            cur.executemany(
+                "UPDATE reminder_requests SET inviato = ?, errore = NULL WHERE id = ?",
+                [(adesso, promemoria_id) for promemoria_id in inviati]
+            )
+            cur.executemany(
+                "UPDATE reminder_requests SET tentativi = ?, errore = ? WHERE id = ?",
+                [(tentativi, errore, promemoria_id) for promemoria_id, tentativi, errore in falliti]
+            )
+
+    # --- statistiche ---
+    def statistiche(self):
+        cur = self._cursore()
+        cur.execute("SELECT data, ora, prenotazioni, ospiti FROM stat_slot WHERE prenotazioni > 0 ORDER BY data, ora")
+        slot = cur.fetchall()
+        cur.execute("SELECT rating, totale FROM stat_rating WHERE totale > 0")
+        rating = cur.fetchall()
+        cur.execute("SELECT valore FROM stat_contatori WHERE chiave = 'promemoria'")
+        promemoria = cur.fetchone()
+        return slot, rating, promemoria["valore"] if promemoria else 0
+
+    def conteggi_risorse(self):
+        cur = self._cursore()
+        cur.execute(SQL_CONTEGGI_RISORSE)
+        return cur.fetchone()
+
+    # --- idempotenza ---
+    def prenota_chiave(self, endpoint, chiave, impronta):
+        with self._transazione() as cur:
+            cur.execute(
+                """
+                INSERT INTO richieste_idempotenti (endpoint, chiave, impronta) VALUES (?, ?, ?)
+                ON CONFLICT (endpoint, chiave) DO NOTHING
+                """,
+                (endpoint, chiave, impronta)
+            )
+            if cur.rowcount == 1:
+                return True, None
+            cur.execute(
+                "SELECT impronta, stato, risposta FROM richieste_idempotenti WHERE endpoint = ? AND chiave = ?",
+                (endpoint, chiave)
+            )
+            return False, cur.fetchone()
+
+    def salva_risposta(self, endpoint, chiave, stato, corpo):
+        self._cursore().execute(
+            "UPDATE richieste_idempotenti SET stato = ?, risposta = ? WHERE endpoint = ? AND chiave = ?",
+            (stato, corpo, endpoint, chiave)
+        )
+
+    def libera_chiave(self, endpoint, chiave):
+        self._cursore().execute(
+            "DELETE FROM richieste_idempotenti WHERE endpoint = ? AND chiave = ?", (endpoint, chiave)
+        )
+
+    def pulisci_chiavi(self, ttl):
+        self._cursore().execute(
+            "DELETE FROM richieste_idempotenti WHERE creata < strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime', ?)",
+            (f"-{int(ttl)} seconds",)
+        )
+
+def _query_fts(testo):
+    """Testo libero in una query FTS5: parole tra virgolette, tutte richieste
+    (la sintassi FTS5 non arriva mai dal client)"""
+    return " ".join(f'"{parola}"' for parola in re.findall(r"\w+", testo))
+
+def _istruzioni(script):
+    """Divide uno script SQLite in istruzioni complete (i trigger contengono ';')"""
+    istruzioni = []
+    corrente = ""
+    for riga in script.splitlines(keepends=True):
+        corrente += riga
+        if sqlite3.complete_statement(corrente):
+            if corrente.strip():
+                istruzioni.append(corrente)
+            corrente = ""
+    return istruzioni
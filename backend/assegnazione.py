@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Assegnazione automatica dei tavoli
+Dato il numero di ospiti e i posti liberi di ogni tavolo in uno slot, sceglie
+dove sedere il gruppo:
+1. best fit: il tavolo singolo che, dopo la prenotazione, resta con meno posti
+   liberi (i tavoli vuoti restano ai gruppi grandi);
+2. se nessun tavolo basta, tavoli vicini della stessa fila (consecutivi, tutti
+   con almeno un posto libero): il minor numero di tavoli e, a parità, il minor
+   numero di posti lasciati liberi.
+
+Funzione pura, senza database: viene chiamata con i posti letti sotto lock
+all'interno della transazione che inserisce la prenotazione.
+"""
+
+def assegna(liberi, file, ospiti):
+    """Tavoli per un gruppo: [(tavolo, persone)] o None se non c'è posto.
+
+    `liberi` sono i posti liberi per tavolo (solo i tavoli prenotabili, in ordine),
+    `file` le file di tavoli vicini, ognuna nell'ordine in cui i tavoli si toccano.
+    """
+    migliore, posti_migliore = None, None
+    for tavolo, posti in liberi.items():
+        if ospiti <= posti and (posti_migliore is None or posti < posti_migliore):
+            migliore, posti_migliore = tavolo, posti
+            if posti == ospiti:
+                break  # tavolo riempito esattamente: non si fa di meglio
+    if migliore is not None:
+        return [(migliore, ospiti)]
+
+    scelta = None  # (numero di tavoli, posti sprecati, tavoli)
+    for fila in file:
+        posti = [liberi.get(tavolo, 0) for tavolo in fila]
+        for n in range(2, len(fila) + 1):
+            if scelta is not None and n > scelta[0]:
+                break
+            for inizio in range(len(fila) - n + 1):
+                finestra = posti[inizio:inizio + n]
+                totale = sum(finestra)
+                if totale < ospiti or min(finestra) == 0:
+                    continue
+                if scelta is None or (n, totale - ospiti) < scelta[:2]:
+                    scelta = (n, totale - ospiti, fila[inizio:inizio + n])
+    if scelta is None:
+        return None
+
+    # Riempie i tavoli nell'ordine della fila: con il numero minimo di tavoli
+    # ognuno riceve almeno una persona
+    assegnazione, restanti = [], ospiti
+    for tavolo in scelta[2]:
+        persone = min(liberi[tavolo], restanti)
+        assegnazione.append((tavolo, persone))
+        restanti -= persone
+    return assegnazione
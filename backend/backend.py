@@ -1,12 +1,43 @@
+import atexit
+import base64
+import binascii
+import csv
+import functools
+import hashlib
+import heapq
+import io
 import json
+import math
+import queue
+import random
+import secrets
+import select
 import signal
 import sys
-from datetime import datetime
-from flask import Flask, request, jsonify
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import execute_values
+import limitatore
+import metriche
+import promemoria
+import tracciamento
+from serializzazione import dizionari, indici, risposta_json
+from assegnazione import assegna
+from archivio import (
+    COLONNE_FEEDBACK, Archivio, ArchivioSQLite, SQLITE_PREDEFINITO, SQL_CONTEGGI_RISORSE, filtri_prenotazioni,
+    percorso_sqlite, verifica_capienza
+)
+from migrations import applica_migrazioni, riconcilia_statistiche, versione_richiesta, versione_schema
 
 # ================================
 # CONFIGURAZIONE SERVER
@@ -30,116 +61,893 @@ ALLOWED_ORIGINS = [
 CORS(app, resources={
     r"/api/*": {
         "origins": ALLOWED_ORIGINS,
-        "methods": ["GET", "POST", "OPTIONS"],
-        "allow_headers": ["Content-Type"],
+        "methods": ["GET", "POST", "DELETE", "OPTIONS"],
+        "allow_headers": ["Content-Type", "Idempotency-Key"],
+        "expose_headers": ["Idempotent-Replayed", "ETag", "Retry-After"],
         "supports_credentials": False
     }
 })
 PORT = 3001
 
-# Middleware per logging delle richieste
+# Dietro un proxy (Render, nginx) l'IP del client arriva in X-Forwarded-For:
+# PROXY_FIDATI indica quanti proxy davanti al server sono affidabili
+PROXY_FIDATI = int(os.environ.get("PROXY_FIDATI", 0))
+if PROXY_FIDATI:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_FIDATI)
+
+# Log delle richieste: disattivato di default, LOG_RICHIESTE=0.05 ne stampa
+# una su venti (1 = tutte). Le risposte 5xx vengono stampate sempre.
+LOG_RICHIESTE = float(os.environ.get("LOG_RICHIESTE", 0))
+
+def route_corrente():
+    """Etichetta della route per le metriche (la regola, non l'URL con i parametri)"""
+    return request.url_rule.rule if request.url_rule is not None else "non_trovata"
+
+# Middleware per metriche e logging delle richieste
 @app.before_request
 def log_request():
-    origin = request.headers.get('Origin', 'N/A')
-    print(f"[REQUEST] {request.method} {request.url} | Origin: {origin}")
-    
+    g.route = route_corrente()
+    g.inizio = metriche.inizio_richiesta(g.route)
+
 @app.after_request
 def after_request(response):
-    origin = request.headers.get('Origin', 'N/A')
-    print(f"[RESPONSE] {request.method} {request.url} | Status: {response.status_code} | Origin: {origin}")
+    g.stato = response.status_code
+    politica = POLITICHE_CACHE.get(request.endpoint)
+    if politica and response.status_code in (200, 304) and "Cache-Control" not in response.headers:
+        response.headers["Cache-Control"] = politica
     return response
 
+@app.teardown_request
+def chiudi_richiesta(errore):
+    inizio = g.pop("inizio", None)
+    if inizio is None:
+        return
+    stato = g.get("stato", 500)
+    durata, tempo_db = metriche.fine_richiesta(request.method, g.route, stato, inizio)
+    if stato >= 500 or (LOG_RICHIESTE and random.random() < LOG_RICHIESTE):
+        origin = request.headers.get('Origin', 'N/A')
+        print(
+            f"[RESPONSE] {request.method} {request.url} | Status: {stato} | "
+            f"{durata * 1000:.1f} ms (DB {tempo_db * 1000:.1f} ms) | Origin: {origin}"
+        )
+
 # ================================
 # DATABASE SETUP
 # ================================
 DATABASE_URL = os.environ.get("DATABASE_URL")
 
+# Senza DATABASE_URL si usa un file SQLite locale (festa su una sola macchina)
 if not DATABASE_URL:
-    print("[ERROR] DATABASE_URL non trovata nelle variabili d'ambiente!")
-    sys.exit(1)
+    print(f"[WARNING] DATABASE_URL non trovata: uso il database SQLite locale {SQLITE_PREDEFINITO}")
+    DATABASE_URL = SQLITE_PREDEFINITO
 
 # Fix per Render: postgres:// -> postgresql://
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
     print("[FIX] DATABASE_URL convertito da postgres:// a postgresql://")
 
+# Parametri di connessione e del pool (uno per ogni worker gunicorn)
+DB_SSLMODE = os.environ.get("DB_SSLMODE", "require")
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 5))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5))           # secondi di attesa max per una connessione
+DB_POOL_VALIDATE_IDLE = float(os.environ.get("DB_POOL_VALIDATE_IDLE", 30))  # ping se inattiva da più di N secondi
+
+# Le colonne DATE/TIME vengono lette come testo ('YYYY-MM-DD', 'HH:MM'):
+# l'API, le chiavi della matrice di occupazione e gli export restano invariati
+DATE_TESTO = psycopg2.extensions.new_type((1082,), "DATE_TESTO", lambda valore, cur: valore)
+ORA_TESTO = psycopg2.extensions.new_type(
+    (1083,), "ORA_TESTO", lambda valore, cur: valore[:5] if valore is not None else None
+)
+psycopg2.extensions.register_type(DATE_TESTO)
+psycopg2.extensions.register_type(ORA_TESTO)
+
 def get_db_connection():
     """Crea una nuova connessione al database PostgreSQL"""
     try:
         return psycopg2.connect(
             DATABASE_URL,
-            cursor_factory=RealDictCursor,
-            sslmode="require"
+            cursor_factory=metriche.CursoreMisurato,
+            sslmode=DB_SSLMODE
         )
     except Exception as e:
         print(f"[ERROR] Impossibile connettersi al database: {e}")
         raise
 
+class PoolTimeoutError(Exception):
+    """Nessuna connessione libera nel pool entro il timeout"""
+
+class ConnectionPool:
+    """Pool di connessioni thread-safe con timeout, validazione e statistiche"""
+
+    def __init__(self, minconn, maxconn, timeout, validate_idle):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.validate_idle = validate_idle
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = deque()  # (connessione, istante ultimo rilascio)
+        self._in_use = 0
+        self._closed = False
+        self._stats = {
+            "checkout": 0,
+            "create": 0,
+            "discard": 0,
+            "timeout": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0
+        }
+
+    def _is_valid(self, conn, idle_since):
+        """Verifica che una connessione inattiva sia ancora utilizzabile"""
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.validate_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        self._stats["discard"] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self):
+        """Preleva una connessione dal pool, attendendo al massimo `timeout` secondi"""
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeoutError("Pool di connessioni chiuso")
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._in_use < self.maxconn:
+                    conn = None
+                    self._in_use += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeout"] += 1
+                    raise PoolTimeoutError(
+                        f"Nessuna connessione disponibile entro {self.timeout}s"
+                    )
+                self._cond.wait(remaining)
+            waited = time.monotonic() - start
+            self._stats["checkout"] += 1
+            self._stats["wait_total"] += waited
+            self._stats["wait_max"] = max(self._stats["wait_max"], waited)
+
+        # Validazione e apertura fuori dal lock: possono richiedere un round trip
+        try:
+            if conn is not None and not self._is_valid(conn, idle_since):
+                with self._cond:
+                    self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = get_db_connection()
+                with self._cond:
+                    self._stats["create"] += 1
+            return conn
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn, broken=False):
+        """Restituisce una connessione al pool (o la chiude se inutilizzabile)"""
+        if not broken and not conn.closed:
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                broken = True
+        with self._cond:
+            self._in_use -= 1
+            if broken or conn.closed or self._closed:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def fill(self):
+        """Apre le connessioni minime del pool"""
+        while True:
+            with self._cond:
+                if len(self._idle) + self._in_use >= self.minconn:
+                    return
+            conn = get_db_connection()
+            with self._cond:
+                self._stats["create"] += 1
+                self._idle.append((conn, time.monotonic()))
+
+    def closeall(self):
+        """Chiude tutte le connessioni inattive e impedisce nuovi prelievi"""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._cond.notify_all()
+
+    def libere(self):
+        """Connessioni che si possono prelevare senza attendere"""
+        with self._cond:
+            return self.maxconn - self._in_use
+
+    def stats(self):
+        """Statistiche correnti del pool"""
+        with self._cond:
+            checkout = self._stats["checkout"]
+            return {
+                "pid": self.pid,
+                "min": self.minconn,
+                "max": self.maxconn,
+                "in_uso": self._in_use,
+                "inattive": len(self._idle),
+                "prelievi": checkout,
+                "connessioni_create": self._stats["create"],
+                "connessioni_scartate": self._stats["discard"],
+                "timeout": self._stats["timeout"],
+                "attesa_media_ms": round(self._stats["wait_total"] / checkout * 1000, 3) if checkout else 0,
+                "attesa_max_ms": round(self._stats["wait_max"] * 1000, 3)
+            }
+
+_pool = None
+_pool_lock = threading.Lock()
+_schema = {"attuale": None, "richiesta": versione_richiesta()}
+
+def _verifica_schema(pool):
+    """Controllo veloce (una query) che le migrazioni siano state applicate"""
+    conn = pool.getconn()
+    try:
+        _schema["attuale"] = versione_schema(conn)
+    finally:
+        pool.putconn(conn)
+    if _schema["attuale"] < _schema["richiesta"]:
+        print(f"[ERROR] Schema database alla versione {_schema['attuale']}, richiesta {_schema['richiesta']}: "
+              "esegui 'python backend.py migra'")
+
+def get_pool():
+    """Restituisce il pool del processo corrente, creandolo se necessario.
+
+    Il pool è legato al PID: dopo un fork (gunicorn --preload) ogni worker
+    ne crea uno proprio invece di condividere i socket del master.
+    """
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_VALIDATE_IDLE)
+            try:
+                _pool.fill()
+                _verifica_schema(_pool)
+            except Exception as e:
+                print(f"[WARNING] Impossibile riempire il pool: {e}")
+        return _pool
+
+@contextmanager
+def db_connection():
+    """Preleva una connessione dal pool e la restituisce all'uscita.
+
+    In caso di eccezione la transazione viene annullata; il commit resta
+    a carico del chiamante.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            broken = True
+        raise
+    finally:
+        pool.putconn(conn, broken=broken)
+
 def init_database():
-    """Inizializza il database PostgreSQL"""
+    """Porta lo schema del database all'ultima versione"""
+    archivio = get_archivio()
     try:
-        print("[CONFIG] Inizializzazione database PostgreSQL...")
+        print(f"[CONFIG] Inizializzazione database ({archivio.nome})...")
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Crea tabelle se non esistono
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS prenotazioni (
-                id SERIAL PRIMARY KEY,
-                nome TEXT NOT NULL,
-                telefono TEXT NOT NULL,
-                data TEXT NOT NULL,
-                ora TEXT NOT NULL,
-                ospiti INTEGER NOT NULL,
-                tavolo TEXT NOT NULL,
-                note TEXT DEFAULT '',
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS feedbacks (
-                id SERIAL PRIMARY KEY,
-                nome TEXT DEFAULT 'Anonimo',
-                rating INTEGER NOT NULL CHECK (rating BETWEEN 0 AND 5),
-                message TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS reminder_requests (
-                id SERIAL PRIMARY KEY,
-                contact TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        
-        # Indici per migliorare le performance
-        cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_prenotazioni_data_ora ON prenotazioni(data, ora);
-        """)
-        cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_prenotazioni_tavolo ON prenotazioni(tavolo);
-        """)
-        cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_feedbacks_timestamp ON feedbacks(timestamp);
-        """)
-        cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_reminder_timestamp ON reminder_requests(timestamp);
-        """)
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-
-        print("[OK] Database PostgreSQL inizializzato correttamente")
+        applicate = archivio.migra()
+
+        print(f"[OK] Database inizializzato correttamente ({applicate} migrazioni applicate)")
         return True
     except Exception as error:
         print(f"[ERROR] Errore nell'inizializzazione del database: {error}")
         raise error
 
+# ================================
+# ARCHIVIO POSTGRESQL
+# ================================
+# Le operazioni dell'interfaccia Archivio (archivio.py) sul pool PostgreSQL.
+# Controllo capienza e INSERT nello stesso statement multiplo: con autocommit
+# PostgreSQL lo esegue come un'unica transazione implicita (un solo round trip).
+# Il lock advisory è limitato a (data, ora, tavolo): prenotazioni su tavoli
+# diversi non si bloccano a vicenda. Il SELECT successivo al lock prende un
+# nuovo snapshot, quindi vede tutte le prenotazioni già confermate.
+# A inserimento riuscito viene notificato il canale dell'occupazione.
+# I posti occupati comprendono le trattenute attive (tranne quella del cliente,
+# consumata nella stessa transazione della prenotazione). La trattenuta del
+# cliente vale solo se è per lo stesso data/ora/tavolo e gli stessi ospiti:
+# un token di un altro tavolo non libera posti e non viene consumato.
+OCCUPAZIONE_CANALE = "festa_prenotazioni"
+
+SQL_POSTI_SLOT = """
+    SELECT (SELECT COALESCE(SUM(ospiti), 0) FROM prenotazioni
+            WHERE data = %(data)s AND ora = %(ora)s AND tavolo = %(tavolo)s)
+         + (SELECT COALESCE(SUM(ospiti), 0) FROM trattenute
+            WHERE data = %(data)s AND ora = %(ora)s AND tavolo = %(tavolo)s
+              AND scade > %(adesso)s
+              AND (token IS DISTINCT FROM %(trattenuta)s OR ospiti <> %(ospiti)s)) AS posti
+"""
+
+SQL_PRENOTA_ATOMICA = f"""
+    SELECT pg_advisory_xact_lock(hashtextextended(%(chiave)s, 0));
+    WITH occupati AS ({SQL_POSTI_SLOT}), nuova AS (
+        INSERT INTO prenotazioni (nome, telefono, data, ora, ospiti, tavolo, note)
+        SELECT %(nome)s, %(telefono)s, %(data)s::date, %(ora)s::time, %(ospiti)s, %(tavolo)s, %(note)s
+        FROM occupati
+        WHERE occupati.posti + %(ospiti)s <= %(capienza)s
+        RETURNING id
+    ), consumata AS (
+        DELETE FROM trattenute
+        WHERE token = %(trattenuta)s AND data = %(data)s AND ora = %(ora)s
+          AND tavolo = %(tavolo)s AND ospiti = %(ospiti)s AND EXISTS (SELECT 1 FROM nuova)
+        RETURNING token
+    )
+    SELECT occupati.posti AS posti_occupati, nuova.id,
+           CASE WHEN nuova.id IS NOT NULL THEN pg_notify(%(canale)s, json_build_object(
+               'pid', %(pid)s, 'id', nuova.id, 'data', %(data)s, 'ora', %(ora)s,
+               'tavolo', %(tavolo)s, 'ospiti', %(ospiti)s, 'trattenuta', (SELECT token FROM consumata)
+           )::text) END AS notifica
+    FROM occupati LEFT JOIN nuova ON TRUE
+"""
+
+# Blocco di prenotazioni: lock degli slot in ordine (niente deadlock con altri
+# blocchi; stessi lock di SQL_PRENOTA_ATOMICA) e posti occupati letti una volta
+SQL_OCCUPATI_BLOCCO = """
+    SELECT pg_advisory_xact_lock(hashtextextended(chiave, 0))
+    FROM (SELECT DISTINCT unnest(%(chiavi)s::text[]) AS chiave ORDER BY 1) AS chiavi;
+    SELECT s.data, s.ora, s.tavolo,
+           COALESCE((SELECT SUM(p.ospiti) FROM prenotazioni p
+                     WHERE p.data = s.data AND p.ora = s.ora AND p.tavolo = s.tavolo), 0)
+         + COALESCE((SELECT SUM(t.ospiti) FROM trattenute t
+                     WHERE t.data = s.data AND t.ora = s.ora AND t.tavolo = s.tavolo
+                       AND t.scade > %(adesso)s), 0) AS posti
+    FROM unnest(%(date)s::date[], %(ore)s::time[], %(tavoli)s::text[]) AS s(data, ora, tavolo)
+"""
+
+# Trattenuta: stesso lock e stesso conteggio della prenotazione; le scadute
+# dello slot vengono eliminate mentre si ha il lock
+SQL_TRATTIENI = f"""
+    SELECT pg_advisory_xact_lock(hashtextextended(%(chiave)s, 0));
+    DELETE FROM trattenute
+    WHERE data = %(data)s AND ora = %(ora)s AND tavolo = %(tavolo)s AND scade <= %(adesso)s;
+    WITH occupati AS ({SQL_POSTI_SLOT}), nuova AS (
+        INSERT INTO trattenute (token, data, ora, tavolo, ospiti, scade)
+        SELECT %(token)s, %(data)s::date, %(ora)s::time, %(tavolo)s, %(ospiti)s, %(scade)s
+        FROM occupati
+        WHERE occupati.posti + %(ospiti)s <= %(capienza)s
+        RETURNING token
+    )
+    SELECT occupati.posti AS posti_occupati, nuova.token,
+           CASE WHEN nuova.token IS NOT NULL THEN pg_notify(%(canale)s, json_build_object(
+               'pid', %(pid)s, 'trattenuta', nuova.token, 'data', %(data)s, 'ora', %(ora)s,
+               'tavolo', %(tavolo)s, 'ospiti', %(ospiti)s, 'scade', %(scade)s
+           )::text) END AS notifica
+    FROM occupati LEFT JOIN nuova ON TRUE
+"""
+
+# Ricerca nei feedback: le righe candidate arrivano dall'indice GIN su ricerca,
+# ts_rank legge il tsvector già calcolato (float8 perché il cursore lo confronta esatto)
+SQL_CERCA_FEEDBACK = f"""
+    SELECT * FROM (
+        SELECT {COLONNE_FEEDBACK}, ts_rank(ricerca, query)::float8 AS rilevanza
+        FROM feedbacks, websearch_to_tsquery('italian', %(testo)s) AS query
+        WHERE ricerca @@ query AND rating BETWEEN %(rating_min)s AND %(rating_max)s
+    ) AS trovati
+"""
+
+def notifica_risorsa(tabella):
+    """Payload della notifica di una scrittura su feedback o promemoria"""
+    return json.dumps({"pid": os.getpid(), "risorsa": tabella})
+
+class AscoltatorePostgres:
+    """Notifiche LISTEN su una connessione dedicata"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def attendi(self, timeout):
+        pronti, _, _ = select.select([self.conn], [], [], timeout)
+        if not pronti:
+            return None
+        self.conn.poll()
+        notifiche = [n.payload for n in self.conn.notifies]
+        self.conn.notifies.clear()
+        return notifiche
+
+class ArchivioPostgres(Archivio):
+    """Archivio sul pool PostgreSQL del worker"""
+
+    nome = "postgresql"
+    segnaposto = "%s"
+    scrittura_differita = True
+    notifiche_push = True
+
+    def __init__(self):
+        self.pid = os.getpid()
+
+    # --- gestione ---
+    def connessione(self):
+        return db_connection()
+
+    def ping(self):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT 1")
+
+    def stats(self):
+        return dict(get_pool().stats(), motore="postgresql")
+
+    def saturo(self):
+        # Il pool esistente del worker, senza crearlo: prima della prima query non è saturo
+        pool = _pool
+        return pool is not None and pool.pid == os.getpid() and pool.libere() <= 0
+
+    def schema(self):
+        return _schema
+
+    def migra(self):
+        conn = get_db_connection()
+        try:
+            applicate = applica_migrazioni(conn)
+            _schema["attuale"] = versione_schema(conn)
+        finally:
+            conn.close()
+        return applicate
+
+    def riconcilia_statistiche(self):
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                riconcilia_statistiche(cur)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def chiudi(self):
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.closeall()
+
+    # --- occupazione ---
+    def max_id_prenotazioni(self):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(id), 0) AS max_id FROM prenotazioni")
+            return cur.fetchone()["max_id"]
+
+    def totali_occupazione(self, data=None):
+        query = "SELECT data, ora, tavolo, SUM(ospiti) AS ospiti FROM prenotazioni"
+        params = []
+        if data:
+            query += " WHERE data = %s"
+            params.append(data)
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(query + " GROUP BY data, ora, tavolo", params)
+            return [(r["data"], r["ora"], r["tavolo"], r["ospiti"]) for r in cur]
+
+    def posti_occupati(self, data, ora):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT tavolo, SUM(ospiti) AS ospiti_totali FROM (
+                    SELECT tavolo, ospiti FROM prenotazioni WHERE data = %(data)s AND ora = %(ora)s
+                    UNION ALL
+                    SELECT tavolo, ospiti FROM trattenute WHERE data = %(data)s AND ora = %(ora)s AND scade > %(adesso)s
+                ) AS occupati GROUP BY tavolo
+                """,
+                {"data": data, "ora": ora, "adesso": time.time()}
+            )
+            return {row["tavolo"]: row["ospiti_totali"] for row in cur.fetchall()}
+
+    def posti_occupati_tavolo(self, data, ora, tavolo):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(SQL_POSTI_SLOT, {
+                "data": data, "ora": ora, "tavolo": tavolo, "adesso": time.time(), "trattenuta": None, "ospiti": 0
+            })
+            return cur.fetchone()["posti"]
+
+    @contextmanager
+    def notifiche(self):
+        conn = get_db_connection()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {OCCUPAZIONE_CANALE}")
+            yield AscoltatorePostgres(conn)
+        finally:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    # --- prenotazioni ---
+    def inserisci_prenotazione(self, nome, telefono, data, ora, ospiti, tavolo, note, capienza, trattenuta=None):
+        with db_connection() as conn:
+            autocommit = conn.autocommit
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(SQL_PRENOTA_ATOMICA, {
+                        "chiave": f"prenota:{data}|{ora}|{tavolo}",
+                        "nome": nome,
+                        "telefono": telefono,
+                        "data": data,
+                        "ora": ora,
+                        "ospiti": ospiti,
+                        "tavolo": tavolo,
+                        "note": note,
+                        "capienza": capienza,
+                        "adesso": time.time(),
+                        "trattenuta": trattenuta,
+                        "canale": OCCUPAZIONE_CANALE,
+                        "pid": os.getpid()
+                    })
+                    row = cur.fetchone()
+            finally:
+                conn.autocommit = autocommit
+        return row["id"], row["posti_occupati"]
+
+    def inserisci_prenotazioni(self, prenotazioni):
+        slot = sorted({(data, ora, tavolo) for _, _, data, ora, _, tavolo, _, _ in prenotazioni})
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(SQL_OCCUPATI_BLOCCO, {
+                    "chiavi": [f"prenota:{data}|{ora}|{tavolo}" for data, ora, tavolo in slot],
+                    "date": [data for data, _, _ in slot],
+                    "ore": [ora for _, ora, _ in slot],
+                    "tavoli": [tavolo for _, _, tavolo in slot],
+                    "adesso": time.time()
+                })
+                occupati = {(r["data"], r["ora"], r["tavolo"]): r["posti"] for r in cur.fetchall()}
+                esiti = verifica_capienza(prenotazioni, occupati)
+                accettate = [p for p, (accettata, _) in zip(prenotazioni, esiti) if accettata]
+                ids = iter(self._inserisci_righe(cur, accettate))
+            conn.commit()
+        return [(next(ids) if accettata else None, posti) for accettata, posti in esiti]
+
+    def inserisci_assegnazione(self, data, ora, tavoli, scegli):
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(SQL_OCCUPATI_BLOCCO, {
+                    "chiavi": [f"prenota:{data}|{ora}|{tavolo}" for tavolo in tavoli],
+                    "date": [data] * len(tavoli),
+                    "ore": [ora] * len(tavoli),
+                    "tavoli": list(tavoli),
+                    "adesso": time.time()
+                })
+                prenotazioni = scegli({r["tavolo"]: r["posti"] for r in cur.fetchall()})
+                if not prenotazioni:
+                    conn.rollback()
+                    return None
+                ids = self._inserisci_righe(cur, prenotazioni)
+            conn.commit()
+        return list(zip(ids, prenotazioni))
+
+    def _inserisci_righe(self, cur, prenotazioni):
+        """INSERT in blocco con notifica agli altri worker; restituisce gli id"""
+        if not prenotazioni:
+            return []
+        # Id riservati prima: ogni prenotazione sa il suo senza dipendere dall'ordine di RETURNING
+        cur.execute(
+            "SELECT nextval(pg_get_serial_sequence('prenotazioni', 'id')) AS id "
+            "FROM generate_series(1, %s)",
+            (len(prenotazioni),)
+        )
+        ids = [r["id"] for r in cur.fetchall()]
+        execute_values(
+            cur,
+            "INSERT INTO prenotazioni (id, nome, telefono, data, ora, ospiti, tavolo, note) VALUES %s",
+            [(i, *p[:7]) for i, p in zip(ids, prenotazioni)],
+            template="(%s, %s, %s, %s::date, %s::time, %s, %s, %s)",
+            page_size=len(prenotazioni)
+        )
+        cur.execute(
+            "SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload",
+            (OCCUPAZIONE_CANALE, [
+                json.dumps({"pid": os.getpid(), "id": i, "data": p[2], "ora": p[3],
+                            "tavolo": p[5], "ospiti": p[4]})
+                for i, p in zip(ids, prenotazioni)
+            ])
+        )
+        return ids
+
+    # --- trattenute ---
+    def inserisci_trattenuta(self, token, data, ora, tavolo, ospiti, capienza, scade):
+        with db_connection() as conn:
+            autocommit = conn.autocommit
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(SQL_TRATTIENI, {
+                        "chiave": f"prenota:{data}|{ora}|{tavolo}",
+                        "token": token,
+                        "data": data,
+                        "ora": ora,
+                        "tavolo": tavolo,
+                        "ospiti": ospiti,
+                        "capienza": capienza,
+                        "scade": scade,
+                        "adesso": time.time(),
+                        "trattenuta": None,
+                        "canale": OCCUPAZIONE_CANALE,
+                        "pid": os.getpid()
+                    })
+                    row = cur.fetchone()
+            finally:
+                conn.autocommit = autocommit
+        return row["token"] is not None, row["posti_occupati"]
+
+    def rilascia_trattenuta(self, token):
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    WITH rilasciata AS (DELETE FROM trattenute WHERE token = %s RETURNING token)
+                    SELECT pg_notify(%s, json_build_object('pid', %s, 'rilascia', token)::text) FROM rilasciata
+                """, (token, OCCUPAZIONE_CANALE, os.getpid()))
+                rilasciata = cur.fetchone() is not None
+            conn.commit()
+        return rilasciata
+
+    def trattenute_attive(self):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT token, data, ora, tavolo, ospiti, scade FROM trattenute WHERE scade > %s",
+                (time.time(),)
+            )
+            return [(r["token"], r["data"], r["ora"], r["tavolo"], r["ospiti"], r["scade"]) for r in cur]
+
+    def firma_trattenute(self):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT COUNT(*) AS numero, COALESCE(SUM(ospiti), 0) AS posti FROM trattenute WHERE scade > %s",
+                (time.time(),)
+            )
+            riga = cur.fetchone()
+            return riga["numero"], riga["posti"]
+
+    def pulisci_trattenute(self):
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM trattenute WHERE scade <= %s", (time.time(),))
+                eliminate = cur.rowcount
+            conn.commit()
+        return eliminate
+
+    def lista_prenotazioni(self, data, ora, tavolo, dopo, limite):
+        filtri, params = filtri_prenotazioni(data, ora, tavolo)
+        query = "SELECT * FROM prenotazioni WHERE " + filtri
+        if dopo:
+            query += " AND (data, ora, id) < (%s, %s, %s)"
+            params.extend(dopo)
+        query += " ORDER BY data DESC, ora DESC, id DESC LIMIT %s"
+        params.append(limite)
+        return self._lista(query, params)
+
+    def _lista(self, query, params):
+        with db_connection() as conn, conn.cursor(cursor_factory=metriche.CursoreTuple) as cur:
+            cur.execute(query, params)
+            return tuple(c[0] for c in cur.description), cur.fetchall()
+
+    def _esporta(self, query, params, nome_cursore):
+        """Legge con un cursore lato server (memoria costante)"""
+        with db_connection() as conn:
+            with conn.cursor(name=nome_cursore, cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.itersize = EXPORT_BLOCCO
+                cur.execute(query, params)
+                righe = iter(cur)
+                prima = next(righe, None)
+                yield [c[0] for c in cur.description]
+                if prima is not None:
+                    yield prima
+                    yield from righe
+            conn.rollback()
+
+    def esporta_prenotazioni(self, data, ora, tavolo):
+        filtri, params = filtri_prenotazioni(data, ora, tavolo)
+        return self._esporta(
+            f"SELECT id, nome, telefono, data, ora, ospiti, tavolo, note, timestamp FROM prenotazioni "
+            f"WHERE {filtri} ORDER BY data, ora, tavolo, id",
+            params, "export_prenotazioni"
+        )
+
+    # --- feedback e promemoria ---
+    def inserisci_feedback(self, nome, rating, message, timestamp):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                WITH nuovo AS (
+                    INSERT INTO feedbacks (nome, rating, message, timestamp)
+                    VALUES (%s, %s, %s, %s)
+                    RETURNING id
+                )
+                SELECT id, pg_notify(%s, %s) AS notifica FROM nuovo
+                """,
+                (nome, rating, message, timestamp, OCCUPAZIONE_CANALE, notifica_risorsa("feedbacks"))
+            )
+            feedback_id = cur.fetchone()["id"]
+            conn.commit()
+        return feedback_id
+
+    def lista_feedback(self, dopo, limite):
+        query = f"SELECT {COLONNE_FEEDBACK} FROM feedbacks"
+        params = []
+        if dopo:
+            query += " WHERE (timestamp, id) < (%s, %s)"
+            params.extend(dopo)
+        query += " ORDER BY timestamp DESC, id DESC LIMIT %s"
+        params.append(limite)
+        return self._lista(query, params)
+
+    def esporta_feedback(self):
+        return self._esporta(f"SELECT {COLONNE_FEEDBACK} FROM feedbacks ORDER BY timestamp, id", [], "export_feedback")
+
+    def cerca_feedback(self, testo, rating_min, rating_max, dopo, limite):
+        query = SQL_CERCA_FEEDBACK
+        params = {"testo": testo, "rating_min": rating_min, "rating_max": rating_max, "limite": limite}
+        if dopo:
+            query += " WHERE (rilevanza, id) < (%(rilevanza)s::float8, %(id)s)"
+            params.update(rilevanza=dopo[0], id=dopo[1])
+        return self._lista(query + " ORDER BY rilevanza DESC, id DESC LIMIT %(limite)s", params)
+
+    def inserisci_promemoria(self, contact, timestamp):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                WITH nuovo AS (
+                    INSERT INTO reminder_requests (contact, timestamp)
+                    VALUES (%s, %s)
+                    RETURNING id
+                )
+                SELECT id, pg_notify(%s, %s) AS notifica FROM nuovo
+                """,
+                (contact, timestamp, OCCUPAZIONE_CANALE, notifica_risorsa("reminder_requests"))
+            )
+            reminder_id = cur.fetchone()["id"]
+            conn.commit()
+        return reminder_id
+
+    def lista_promemoria(self, limite):
+        return self._lista("SELECT * FROM reminder_requests ORDER BY timestamp DESC LIMIT %s", (limite,))
+
+    def promemoria_da_inviare(self, tentativi_max):
+        return self._esporta(
+            "SELECT id, contact, tentativi FROM reminder_requests "
+            "WHERE inviato IS NULL AND tentativi < %s ORDER BY id",
+            (tentativi_max,), "promemoria_da_inviare"
+        )
+
+    def contatti_inviati(self):
+        return self._esporta(
+            "SELECT contact FROM reminder_requests WHERE inviato IS NOT NULL", (), "contatti_inviati"
+        )
+
+    def segna_promemoria(self, inviati, falliti):
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                if inviati:
+                    cur.execute(
+                        "UPDATE reminder_requests SET inviato = CURRENT_TIMESTAMP, errore = NULL WHERE id = ANY(%s)",
+                        (list(inviati),)
+                    )
+                if falliti:
+                    execute_values(
+                        cur,
+                        "UPDATE reminder_requests AS r SET tentativi = v.tentativi, errore = v.errore "
+                        "FROM (VALUES %s) AS v(id, tentativi, errore) WHERE r.id = v.id",
+                        falliti,
+                        page_size=len(falliti)
+                    )
+            conn.commit()
+
+    # --- statistiche ---
+    def statistiche(self):
+        # Letture dalle tabelle riassuntive: nessuna scansione delle tabelle sorgente
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT data, ora, prenotazioni, ospiti FROM stat_slot WHERE prenotazioni > 0 ORDER BY data, ora")
+            slot = cur.fetchall()
+            cur.execute("SELECT rating, totale FROM stat_rating WHERE totale > 0")
+            rating = cur.fetchall()
+            cur.execute("SELECT valore FROM stat_contatori WHERE chiave = 'promemoria'")
+            promemoria = cur.fetchone()
+        return slot, rating, promemoria["valore"] if promemoria else 0
+
+    def conteggi_risorse(self):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(SQL_CONTEGGI_RISORSE)
+            return dict(cur.fetchone())
+
+    # --- idempotenza ---
+    def prenota_chiave(self, endpoint, chiave, impronta):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO richieste_idempotenti (endpoint, chiave, impronta)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (endpoint, chiave) DO NOTHING
+                RETURNING 1
+            """, (endpoint, chiave, impronta))
+            nuova = cur.fetchone() is not None
+            esistente = None
+            if not nuova:
+                cur.execute(
+                    "SELECT impronta, stato, risposta FROM richieste_idempotenti WHERE endpoint = %s AND chiave = %s",
+                    (endpoint, chiave)
+                )
+                esistente = cur.fetchone()
+            conn.commit()
+        return nuova, esistente
+
+    def salva_risposta(self, endpoint, chiave, stato, corpo):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "UPDATE richieste_idempotenti SET stato = %s, risposta = %s WHERE endpoint = %s AND chiave = %s",
+                (stato, corpo, endpoint, chiave)
+            )
+            conn.commit()
+
+    def libera_chiave(self, endpoint, chiave):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM richieste_idempotenti WHERE endpoint = %s AND chiave = %s",
+                (endpoint, chiave)
+            )
+            conn.commit()
+
+    def pulisci_chiavi(self, ttl):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM richieste_idempotenti WHERE creata < NOW() - %s * INTERVAL '1 second'",
+                (ttl,)
+            )
+            conn.commit()
+
+_archivio = None
+_archivio_lock = threading.Lock()
+
+def get_archivio():
+    """Archivio del processo corrente, scelto dallo schema di DATABASE_URL"""
+    global _archivio
+    archivio = _archivio
+    if archivio is not None and archivio.pid == os.getpid():
+        return archivio
+    with _archivio_lock:
+        if _archivio is None or _archivio.pid != os.getpid():
+            if DATABASE_URL.startswith("sqlite:"):
+                _archivio = ArchivioSQLite(percorso_sqlite(DATABASE_URL))
+            else:
+                _archivio = ArchivioPostgres()
+        return _archivio
+
 # ================================
 # DATI CONFIGURAZIONE TAVOLI
 # ================================
@@ -152,6 +960,13 @@ TAVOLI_CONFIG = {
         "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", "14", "15",
         "16", "17", "18", "20", "21", "22", "23", "24", "25", "26", "27", "28",
         "29", "30", "31", "32", "33", "34", "35", "36", "37", "38", "39", "40"
+    ],
+
+    # File di tavoli vicini (come nella mappa), usate per i gruppi su più tavoli
+    "file": [
+        ["3", "4", "5"], ["6", "7", "8", "9"], ["10", "11", "12"], ["13", "14", "15"],
+        ["16", "17", "18"], ["20", "21", "22", "23"], ["24", "25", "26"], ["27", "28", "29", "30"],
+        ["31", "32", "33"], ["34", "35", "36", "37"], ["38", "39", "40"]
     ]
 }
 
@@ -162,56 +977,654 @@ for t in TAVOLI_CONFIG["riservati"]:
 for t in TAVOLI_CONFIG["standard"]:
     TAVOLI[t] = 10
 
+# Con tavolo "auto" il backend sceglie il tavolo (o i tavoli vicini) per il gruppo
+TAVOLO_AUTOMATICO = "auto"
+OSPITI_MAX_GRUPPO = max(sum(TAVOLI[t] for t in fila) for fila in TAVOLI_CONFIG["file"])
+
+# Slot prenotabili della festa (opzionali), es.
+# FESTA_DATE="2025-06-20,2025-06-21" FESTA_ORARI="19:00,19:30,20:00"
+# Se non configurati, la griglia usa gli slot con almeno una prenotazione.
+def normalizza_data(data):
+    """Data in formato canonico 'YYYY-MM-DD'; ValueError se non valida"""
+    return datetime.strptime(data.strip(), "%Y-%m-%d").strftime("%Y-%m-%d")
+
+def normalizza_ora(ora):
+    """Ora in formato canonico 'HH:MM' (accetta anche i secondi); ValueError se non valida"""
+    ora = ora.strip()
+    formato = "%H:%M:%S" if ora.count(":") == 2 else "%H:%M"
+    return datetime.strptime(ora, formato).strftime("%H:%M")
+
+FESTA_DATE = [normalizza_data(d) for d in os.environ.get("FESTA_DATE", "").split(",") if d.strip()]
+FESTA_ORARI = [normalizza_ora(o) for o in os.environ.get("FESTA_ORARI", "").split(",") if o.strip()]
+
+def slot_configurati():
+    """Elenco (data, ora) degli slot configurati, vuoto se non impostati"""
+    return [(d, o) for d in FESTA_DATE for o in FESTA_ORARI]
+
+# ================================
+# MOTORE OCCUPAZIONE IN MEMORIA
+# ================================
+# Ogni worker tiene in memoria una matrice (slot data/ora × tavolo) dei posti
+# occupati. Le prenotazioni del worker la aggiornano subito (write-through);
+# quelle degli altri worker arrivano via LISTEN/NOTIFY. Un controllo periodico
+# su MAX(id) ricarica tutto se qualche notifica è andata persa (con SQLite,
+# che non ha notifiche, il controllo avviene ogni secondo).
+# Le trattenute temporanee hanno una matrice parallela e scadono da un heap
+# ordinato per scadenza: a ogni lettura si tolgono solo quelle in cima già
+# scadute, senza scorrere le altre.
+OCCUPAZIONE_RESYNC = float(os.environ.get("OCCUPAZIONE_RESYNC", 30))  # secondi tra i controlli di versione
+TRATTENUTE_PULIZIA = 60  # secondi tra due eliminazioni delle trattenute scadute dal database
+
+class OccupazioneTavoli:
+    """Matrice compatta dei posti occupati per (data, ora) × tavolo"""
+
+    def __init__(self, tavoli):
+        self.tavoli = list(tavoli)
+        self.indice_tavolo = {t: i for i, t in enumerate(self.tavoli)}
+        self.pid = os.getpid()
+        self.pronto = False
+        self.max_id = 0
+        self._lock = threading.Lock()
+        self._slot = {}         # (data, ora) -> riga della matrice
+        self._posti = array("I")
+        self._trattenuti = array("I")  # posti trattenuti, stessa forma di _posti
+        self._trattenute = {}   # token -> (scade, data, ora, indice tavolo, ospiti)
+        self._scadenze = []     # heap di (scade, token); i token rilasciati restano fino alla scadenza
+        self.posti_trattenuti = 0
+        self._ultima_pulizia = 0.0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _riga(self, data, ora, crea=False):
+        riga = self._slot.get((data, ora))
+        if riga is None and crea:
+            riga = len(self._slot)
+            self._slot[(data, ora)] = riga
+            self._posti.extend([0] * len(self.tavoli))
+            self._trattenuti.extend([0] * len(self.tavoli))
+        return riga
+
+    def _occupati_cella(self, riga, i):
+        cella = riga * len(self.tavoli) + i
+        return self._posti[cella] + self._trattenuti[cella]
+
+    def _ricostruisci_trattenuti(self):
+        """Matrice delle trattenute dal dizionario (dopo un cambio delle righe)"""
+        n = len(self.tavoli)
+        self._trattenuti = array("I", [0] * (len(self._slot) * n))
+        for _, data, ora, i, ospiti in self._trattenute.values():
+            riga = self._riga(data, ora, crea=True)
+            self._trattenuti[riga * n + i] += ospiti
+
+    def carica(self, righe, max_id):
+        """Sostituisce la matrice con i totali (data, ora, tavolo, ospiti) letti dal DB"""
+        slot = {}
+        posti = array("I")
+        n = len(self.tavoli)
+        for data, ora, tavolo, ospiti in righe:
+            i = self.indice_tavolo.get(tavolo)
+            if i is None:
+                continue
+            riga = slot.get((data, ora))
+            if riga is None:
+                riga = slot[(data, ora)] = len(slot)
+                posti.extend([0] * n)
+            posti[riga * n + i] += ospiti
+        with self._lock:
+            self._slot = slot
+            self._posti = posti
+            self._ricostruisci_trattenuti()
+            self.max_id = max_id
+            self.pronto = True
+        get_stream_hub().pubblica_tutti(self)
+
+    def aggiungi(self, data, ora, tavolo, ospiti, prenotazione_id=0):
+        """Registra una nuova prenotazione nella matrice"""
+        i = self.indice_tavolo.get(tavolo)
+        if i is None:
+            return
+        with self._lock:
+            riga = self._riga(data, ora, crea=True)
+            self._posti[riga * len(self.tavoli) + i] += ospiti
+            occupati = self._occupati_cella(riga, i)
+            self.max_id = max(self.max_id, prenotazione_id)
+        get_stream_hub().pubblica(data, ora, {tavolo: max(0, TAVOLI[tavolo] - occupati)})
+
+    def firma(self):
+        """Impronta dei posti prenotati, uguale in tutti i worker con gli stessi dati"""
+        n = len(self.tavoli)
+        with self._lock:
+            righe = [(slot, self._posti[riga * n:(riga + 1) * n].tolist()) for slot, riga in self._slot.items()]
+        # Le righe nascono in ordine diverso nei worker (e vuote, per le trattenute);
+        # una matrice non ancora caricata non conferma l'ETag di una caricata
+        return impronta((self.pronto, sorted(riga for riga in righe if any(riga[1]))))
+
+    # --- trattenute ---
+    def trattieni(self, token, data, ora, tavolo, ospiti, scade):
+        """Registra una trattenuta fino a `scade` (epoch)"""
+        i = self.indice_tavolo.get(tavolo)
+        if i is None or scade <= time.time():
+            return
+        with self._lock:
+            if token in self._trattenute:
+                return
+            riga = self._riga(data, ora, crea=True)
+            self._trattenute[token] = (scade, data, ora, i, ospiti)
+            heapq.heappush(self._scadenze, (scade, token))
+            self._trattenuti[riga * len(self.tavoli) + i] += ospiti
+            self.posti_trattenuti += ospiti
+            occupati = self._occupati_cella(riga, i)
+        get_stream_hub().pubblica(data, ora, {tavolo: max(0, TAVOLI[tavolo] - occupati)})
+
+    def _togli(self, voce):
+        """Toglie una trattenuta dalla matrice (con il lock); (data, ora, tavolo, disponibili)"""
+        _, data, ora, i, ospiti = voce
+        riga = self._slot[(data, ora)]
+        cella = riga * len(self.tavoli) + i
+        # array("I") non accetta valori negativi: mai sotto zero, anche se la
+        # matrice è stata ricaricata nel frattempo
+        self._trattenuti[cella] = max(0, self._trattenuti[cella] - ospiti)
+        self.posti_trattenuti = max(0, self.posti_trattenuti - ospiti)
+        tavolo = self.tavoli[i]
+        return data, ora, tavolo, max(0, TAVOLI[tavolo] - self._occupati_cella(riga, i))
+
+    def rilascia(self, token, prenotazione=None):
+        """Toglie una trattenuta consumata o rilasciata prima della scadenza.
+
+        Con `prenotazione` (data, ora, tavolo, ospiti) la toglie solo se è la
+        trattenuta di quella prenotazione, come fa il database.
+        """
+        with self._lock:
+            voce = self._trattenute.get(token)
+            if voce is None:
+                return
+            if prenotazione is not None:
+                data, ora, tavolo, ospiti = prenotazione
+                if voce[1:] != (data, ora, self.indice_tavolo.get(tavolo), ospiti):
+                    return
+            del self._trattenute[token]
+            data, ora, tavolo, disponibili = self._togli(voce)
+            # Le voci rilasciate restano nell'heap fino alla scadenza: se sono la
+            # maggioranza l'heap viene ricostruito, così la memoria resta limitata
+            if len(self._scadenze) > 2 * len(self._trattenute) + 64:
+                self._scadenze = [(v[0], t) for t, v in self._trattenute.items()]
+                heapq.heapify(self._scadenze)
+        get_stream_hub().pubblica(data, ora, {tavolo: disponibili})
+
+    def scadi(self):
+        """Toglie le trattenute scadute: solo quelle in cima all'heap"""
+        adesso = time.time()
+        variazioni = {}
+        with self._lock:
+            while self._scadenze and self._scadenze[0][0] <= adesso:
+                scade, token = heapq.heappop(self._scadenze)
+                voce = self._trattenute.get(token)
+                if voce is None or voce[0] != scade:
+                    continue  # già rilasciata
+                del self._trattenute[token]
+                data, ora, tavolo, disponibili = self._togli(voce)
+                variazioni.setdefault((data, ora), {})[tavolo] = disponibili
+        for (data, ora), disponibili in variazioni.items():
+            get_stream_hub().pubblica(data, ora, disponibili)
+
+    def prossima_scadenza(self):
+        """Secondi alla prossima scadenza nell'heap (None se vuoto)"""
+        with self._lock:
+            return self._scadenze[0][0] - time.time() if self._scadenze else None
+
+    def carica_trattenute(self, righe):
+        """Sostituisce le trattenute con quelle attive lette dal DB"""
+        adesso = time.time()
+        trattenute = {
+            token: (scade, data, ora, self.indice_tavolo[tavolo], ospiti)
+            for token, data, ora, tavolo, ospiti, scade in righe
+            if tavolo in self.indice_tavolo and scade > adesso
+        }
+        scadenze = [(voce[0], token) for token, voce in trattenute.items()]
+        heapq.heapify(scadenze)
+        with self._lock:
+            self._trattenute = trattenute
+            self._scadenze = scadenze
+            self.posti_trattenuti = sum(voce[4] for voce in trattenute.values())
+            self._ricostruisci_trattenuti()
+        get_stream_hub().pubblica_tutti(self)
+
+    def numero_trattenute(self):
+        with self._lock:
+            return len(self._trattenute)
+
+    def occupati(self, data, ora, trattenute=True):
+        """Posti occupati per ogni tavolo con almeno una prenotazione (o trattenuta)"""
+        if trattenute:
+            self.scadi()
+        with self._lock:
+            riga = self._riga(data, ora)
+            if riga is None:
+                return {}
+            n = len(self.tavoli)
+            valori = self._posti[riga * n:(riga + 1) * n]
+            if trattenute:
+                valori = [p + t for p, t in zip(valori, self._trattenuti[riga * n:(riga + 1) * n])]
+        return {t: v for t, v in zip(self.tavoli, valori) if v}
+
+    def occupati_tavolo(self, data, ora, tavolo, trattenute=True):
+        """Posti occupati su un singolo tavolo.
+
+        Con trattenute=False conta solo le prenotazioni, che possono solo
+        crescere (per i pre-controlli che evitano il database).
+        """
+        if trattenute:
+            self.scadi()
+        i = self.indice_tavolo.get(tavolo)
+        with self._lock:
+            riga = self._riga(data, ora)
+            if riga is None or i is None:
+                return 0
+            if trattenute:
+                return self._occupati_cella(riga, i)
+            return self._posti[riga * len(self.tavoli) + i]
+
+    def griglia(self, slot=None):
+        """Posti occupati (trattenute comprese) per più slot in un'unica lettura.
+
+        Restituisce (slot, righe): righe[i] elenca gli occupati dello slot i
+        nell'ordine di self.tavoli. Senza `slot` usa tutti quelli noti.
+        """
+        self.scadi()
+        n = len(self.tavoli)
+        with self._lock:
+            if slot is None:
+                slot = sorted(self._slot)
+            righe = []
+            for chiave in slot:
+                riga = self._slot.get(chiave)
+                if riga is None:
+                    righe.append([0] * n)
+                    continue
+                righe.append([p + t for p, t in zip(self._posti[riga * n:(riga + 1) * n],
+                                                    self._trattenuti[riga * n:(riga + 1) * n])])
+        return slot, righe
+
+    def ricarica(self):
+        """Ricarica l'intera matrice dal database"""
+        archivio = get_archivio()
+        # Prima la versione: una prenotazione concorrente fa solo ricaricare di nuovo
+        max_id = archivio.max_id_prenotazioni()
+        righe = archivio.totali_occupazione()
+        self.carica(righe, max_id)
+        self.carica_trattenute(archivio.trattenute_attive())
+        print(f"[OCCUPAZIONE] Matrice caricata: {len(self._slot)} slot, max id {max_id}, "
+              f"{self.numero_trattenute()} trattenute")
+
+    def _verifica_versione(self):
+        """Ricarica se il DB contiene prenotazioni non ancora viste"""
+        archivio = get_archivio()
+        if archivio.max_id_prenotazioni() != self.max_id:
+            self.ricarica()
+        elif not archivio.notifiche_push:
+            # Trattenute degli altri processi, che senza notifiche non arrivano
+            self.scadi()
+            with self._lock:
+                firma = (len(self._trattenute), self.posti_trattenuti)
+            if archivio.firma_trattenute() != firma:
+                self.carica_trattenute(archivio.trattenute_attive())
+        # Feedback e promemoria scritti senza notifica (SQLite, notifiche perse)
+        get_versioni().verifica(archivio.conteggi_risorse())
+
+    def _applica_notifica(self, payload):
+        evento = json.loads(payload)
+        if evento.get("pid") == self.pid:
+            return  # prenotazione di questo worker, già applicata
+        if "risorsa" in evento:
+            get_versioni().invalida(evento["risorsa"])
+            return
+        if "rilascia" in evento:
+            self.rilascia(evento["rilascia"])
+            return
+        if "id" not in evento:
+            self.trattieni(evento["trattenuta"], evento["data"], evento["ora"], evento["tavolo"],
+                           evento["ospiti"], evento["scade"])
+            return
+        self.aggiungi(evento["data"], evento["ora"], evento["tavolo"], evento["ospiti"], evento["id"])
+        if evento.get("trattenuta"):
+            self.rilascia(evento["trattenuta"], (evento["data"], evento["ora"], evento["tavolo"], evento["ospiti"]))
+
+    def _pulisci_trattenute(self):
+        """Elimina dal DB le trattenute scadute (al massimo ogni TRATTENUTE_PULIZIA secondi)"""
+        adesso = time.monotonic()
+        if adesso - self._ultima_pulizia < TRATTENUTE_PULIZIA:
+            return
+        self._ultima_pulizia = adesso
+        eliminate = get_archivio().pulisci_trattenute()
+        if eliminate:
+            print(f"[OCCUPAZIONE] {eliminate} trattenute scadute eliminate")
+
+    def _ascolta(self):
+        """Thread di sincronizzazione: notifiche degli altri worker + controllo periodico"""
+        while not self._stop.is_set():
+            try:
+                with get_archivio().notifiche() as ascoltatore:
+                    # Dopo il LISTEN nessuna notifica va persa: ricarica completa
+                    self.ricarica()
+                    get_versioni().verifica(get_archivio().conteggi_risorse())
+                    ultima_verifica = time.monotonic()
+                    while not self._stop.is_set():
+                        # Sveglia anche alla prossima scadenza, per avvisare gli stream
+                        attesa = OCCUPAZIONE_RESYNC
+                        scadenza = self.prossima_scadenza()
+                        if scadenza is not None:
+                            attesa = min(attesa, max(0.05, scadenza))
+                        notifiche = ascoltatore.attendi(attesa)
+                        self.scadi()
+                        self._pulisci_trattenute()
+                        if notifiche is None:
+                            if (not get_archivio().notifiche_push
+                                    or time.monotonic() - ultima_verifica >= OCCUPAZIONE_RESYNC):
+                                self._verifica_versione()
+                                ultima_verifica = time.monotonic()
+                            continue
+                        for payload in notifiche:
+                            self._applica_notifica(payload)
+            except Exception as e:
+                print(f"[OCCUPAZIONE] Sincronizzazione interrotta: {e}")
+                with self._lock:
+                    self.pronto = False
+                self._stop.wait(5)
+
+    def avvia(self):
+        """Avvia il thread di caricamento e sincronizzazione"""
+        self._thread = threading.Thread(target=self._ascolta, name="occupazione", daemon=True)
+        self._thread.start()
+
+    def ferma(self):
+        self._stop.set()
+
+# ================================
+# STREAM DISPONIBILITÀ (SSE)
+# ================================
+# Un solo hub per worker: ogni variazione di occupazione viene inviata una
+# volta per slot a tutti i client iscritti, senza query per client.
+# Le connessioni aperte sono per lo più inattive: usare un worker a thread
+# (gunicorn -k gthread --threads 100) per non occupare un worker sync ciascuna.
+STREAM_MAX_CLIENTI = int(os.environ.get("STREAM_MAX_CLIENTI", 500))  # per worker
+STREAM_HEARTBEAT = float(os.environ.get("STREAM_HEARTBEAT", 15))     # secondi
+STREAM_CODA = 100  # eventi in attesa per client prima di disconnetterlo
+
+class StreamHub:
+    """Distribuisce le variazioni di disponibilità ai client iscritti per slot"""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._iscritti = {}  # (data, ora) -> set di code
+        self._totale = 0
+
+    def iscrivi(self, data, ora):
+        """Registra un client sullo slot; None se il worker è al completo"""
+        coda = queue.Queue(maxsize=STREAM_CODA)
+        with self._lock:
+            if self._totale >= STREAM_MAX_CLIENTI:
+                return None
+            self._iscritti.setdefault((data, ora), set()).add(coda)
+            self._totale += 1
+        return coda
+
+    def disiscrivi(self, data, ora, coda):
+        with self._lock:
+            code = self._iscritti.get((data, ora))
+            if code is None or coda not in code:
+                return
+            code.discard(coda)
+            self._totale -= 1
+            if not code:
+                del self._iscritti[(data, ora)]
+
+    def _invia(self, code, evento):
+        for coda in code:
+            try:
+                coda.put_nowait(evento)
+            except queue.Full:
+                # Client troppo lento: lo chiudiamo, EventSource si riconnette
+                # e riceve uno snapshot aggiornato. La coda si svuota con get_nowait
+                # (mai toccando coda.queue senza il suo mutex); si riprova se un
+                # altro thread l'ha riempita nel frattempo
+                while True:
+                    try:
+                        while True:
+                            coda.get_nowait()
+                    except queue.Empty:
+                        pass
+                    try:
+                        coda.put_nowait(None)
+                        break
+                    except queue.Full:
+                        continue
+
+    def pubblica(self, data, ora, variazioni):
+        """Invia {tavolo: posti_disponibili} agli iscritti dello slot"""
+        with self._lock:
+            code = list(self._iscritti.get((data, ora), ()))
+        if code:
+            self._invia(code, ("delta", variazioni))
+
+    def pubblica_tutti(self, motore):
+        """Dopo una ricarica completa invia uno snapshot a ogni slot seguito"""
+        with self._lock:
+            slot = {k: list(v) for k, v in self._iscritti.items()}
+        for (data, ora), code in slot.items():
+            self._invia(code, ("snapshot", stato_tavoli(motore.occupati(data, ora))))
+
+    def stats(self):
+        with self._lock:
+            return {"clienti": self._totale, "slot": len(self._iscritti)}
+
+_stream_hub = None
+_stream_hub_lock = threading.Lock()
+
+def get_stream_hub():
+    """Restituisce l'hub SSE del processo corrente"""
+    global _stream_hub
+    hub = _stream_hub
+    if hub is None or hub.pid != os.getpid():
+        with _stream_hub_lock:
+            if _stream_hub is None or _stream_hub.pid != os.getpid():
+                _stream_hub = StreamHub()
+            hub = _stream_hub
+    return hub
+
+def stato_tavoli(occupati):
+    """Posti disponibili per ogni tavolo dato il dizionario degli occupati"""
+    return {t: max(0, TAVOLI[t] - occupati.get(t, 0)) for t in TAVOLI}
+
+def evento_sse(tipo, dati):
+    """Formatta un evento Server-Sent Events"""
+    return f"event: {tipo}\ndata: {json.dumps(dati)}\n\n"
+
+_occupazione = None
+_occupazione_lock = threading.Lock()
+
+def get_occupazione():
+    """Restituisce il motore di occupazione del processo corrente (avviandolo se serve)"""
+    global _occupazione
+    motore = _occupazione
+    if motore is not None and motore.pid == os.getpid():
+        return motore
+    with _occupazione_lock:
+        if _occupazione is None or _occupazione.pid != os.getpid():
+            _occupazione = OccupazioneTavoli(TAVOLI)
+            _occupazione.avvia()
+        return _occupazione
+
 # ================================
 # INIZIALIZZAZIONE DB ALL'AVVIO
 # ================================
-# Esegui init_database quando il modulo viene caricato
-# (sia con app.run che con Gunicorn)
-try:
-    print("[STARTUP] Inizializzazione database in corso...")
-    init_database()
-except Exception as e:
-    print(f"[STARTUP ERROR] Impossibile inizializzare il database: {e}")
-    # Non bloccare l'avvio, le tabelle potrebbero già esistere
+# L'import del modulo non apre connessioni: le migrazioni si applicano una
+# volta sola con "python backend.py migra" (o da start_server in sviluppo),
+# mentre pool, matrice di occupazione e controllo di versione partono alla
+# prima richiesta di ogni worker. Così l'avvio è compatibile con --preload.
+# MIGRA_ALL_AVVIO=1 ripristina il vecchio comportamento (migrazioni all'import).
+if os.environ.get("MIGRA_ALL_AVVIO") == "1":
+    try:
+        print("[STARTUP] Inizializzazione database in corso...")
+        init_database()
+    except Exception as e:
+        print(f"[STARTUP ERROR] Impossibile inizializzare il database: {e}")
 
 # ================================
 # UTILITY FUNCTIONS
 # ================================
 def calcola_posti_occupati(data, ora, tavolo=None):
     """Calcola i posti occupati per data/ora specifici"""
+    motore = get_occupazione()
+    if motore.pronto:
+        if tavolo:
+            return motore.occupati_tavolo(data, ora, tavolo)
+        return motore.occupati(data, ora)
+
+    # Matrice non ancora caricata: calcolo dal database
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
         if tavolo:
-            # Calcola posti occupati per un tavolo specifico
-            cur.execute(
-                "SELECT SUM(ospiti) as ospiti_totali FROM prenotazioni WHERE data = %s AND ora = %s AND tavolo = %s",
-                (data, ora, tavolo)
-            )
-            result = cur.fetchone()
-            ospiti_totali = result["ospiti_totali"] if result["ospiti_totali"] else 0
-            cur.close()
-            conn.close()
-            return ospiti_totali
-        else:
-            # Calcola posti occupati per tutti i tavoli
-            cur.execute(
-                "SELECT tavolo, SUM(ospiti) as ospiti_totali FROM prenotazioni WHERE data = %s AND ora = %s GROUP BY tavolo",
-                (data, ora)
-            )
-            results = cur.fetchall()
-            occupati = {}
-            for row in results:
-                occupati[row["tavolo"]] = row["ospiti_totali"]
-            cur.close()
-            conn.close()
-            return occupati
+            return get_archivio().posti_occupati_tavolo(data, ora, tavolo)
+        return get_archivio().posti_occupati(data, ora)
                 
     except Exception as error:
         print(f"Errore nel calcolo posti occupati: {error}")
         return 0 if tavolo else {}
 
+def inserisci_prenotazione(nome, telefono, data, ora, ospiti, tavolo, note, trattenuta=None):
+    """Verifica la capienza e inserisce la prenotazione in modo atomico.
+
+    Restituisce (id, posti_occupati): id è None se i posti non bastano,
+    posti_occupati è il valore letto prima dell'inserimento. I posti della
+    `trattenuta` del cliente non contano e la trattenuta viene consumata.
+    """
+    archivio = get_archivio()
+    prenotazione_id, posti_occupati = archivio.inserisci_prenotazione(
+        nome, telefono, data, ora, ospiti, tavolo, note, TAVOLI[tavolo], trattenuta
+    )
+    if prenotazione_id is not None:
+        # Senza notifiche la versione resta quella letta: gli id intermedi degli
+        # altri processi arrivano solo con il controllo su MAX(id)
+        versione = prenotazione_id if archivio.notifiche_push else 0
+        motore = get_occupazione()
+        motore.aggiungi(data, ora, tavolo, ospiti, versione)
+        if trattenuta:
+            motore.rilascia(trattenuta, (data, ora, tavolo, ospiti))
+    return prenotazione_id, posti_occupati
+
+def inserisci_prenotazioni(prenotazioni):
+    """Come inserisci_prenotazione per un blocco, in un'unica transazione.
+
+    `prenotazioni` sono tuple (nome, telefono, data, ora, ospiti, tavolo, note);
+    restituisce (id, posti_occupati) per ognuna, nello stesso ordine.
+    """
+    if not prenotazioni:
+        return []
+    archivio = get_archivio()
+    esiti = archivio.inserisci_prenotazioni([(*p, TAVOLI[p[5]]) for p in prenotazioni])
+    motore = get_occupazione()
+    for (_, _, data, ora, ospiti, tavolo, _), (prenotazione_id, _) in zip(prenotazioni, esiti):
+        if prenotazione_id is not None:
+            motore.aggiungi(data, ora, tavolo, ospiti, prenotazione_id if archivio.notifiche_push else 0)
+    return esiti
+
+def posti_liberi(occupati):
+    """Posti liberi di ogni tavolo prenotabile, dai posti occupati per tavolo"""
+    return {t: TAVOLI[t] - occupati.get(t, 0) for t in TAVOLI_CONFIG["standard"]}
+
+def note_gruppo(note, assegnazione):
+    """Note delle righe di un gruppo su più tavoli (una prenotazione per tavolo)"""
+    if len(assegnazione) == 1:
+        return note
+    ospiti = sum(persone for _, persone in assegnazione)
+    gruppo = f"[gruppo di {ospiti}: tavoli {', '.join(t for t, _ in assegnazione)}]"
+    return f"{note} {gruppo}" if note else gruppo
+
+def prenota_automatica(nome, telefono, data, ora, ospiti, note):
+    """Sceglie i tavoli e li prenota in modo atomico.
+
+    Restituisce [(id, tavolo, persone)] oppure None se nessun tavolo (o fila
+    di tavoli vicini) ha abbastanza posti.
+    """
+    # Pre-controllo in memoria: senza le trattenute i posti liberi possono solo diminuire
+    motore = get_occupazione()
+    if motore.pronto and assegna(posti_liberi(motore.occupati(data, ora, trattenute=False)),
+                                 TAVOLI_CONFIG["file"], ospiti) is None:
+        return None
+
+    def scegli(occupati):
+        assegnazione = assegna(posti_liberi(occupati), TAVOLI_CONFIG["file"], ospiti)
+        if assegnazione is None:
+            return None
+        note_righe = note_gruppo(note, assegnazione)
+        return [(nome, telefono, data, ora, persone, tavolo, note_righe) for tavolo, persone in assegnazione]
+
+    archivio = get_archivio()
+    inserite = archivio.inserisci_assegnazione(data, ora, TAVOLI_CONFIG["standard"], scegli)
+    if inserite is None:
+        return None
+    risultato = []
+    for prenotazione_id, (_, _, _, _, persone, tavolo, _) in inserite:
+        motore.aggiungi(data, ora, tavolo, persone, prenotazione_id if archivio.notifiche_push else 0)
+        risultato.append((prenotazione_id, tavolo, persone))
+    return risultato
+
+def codifica_cursore(valori):
+    """Codifica la chiave dell'ultima riga di una pagina in un cursore opaco"""
+    grezzo = json.dumps(valori, separators=(",", ":"), default=str).encode()
+    return base64.urlsafe_b64encode(grezzo).decode().rstrip("=")
+
+def decodifica_cursore(cursore, *campi):
+    """Decodifica un cursore con un convertitore per campo (campo_*); solleva ValueError
+    se non valido, anche quando è JSON corretto ma con forma o tipi sbagliati"""
+    try:
+        grezzo = base64.urlsafe_b64decode(cursore + "=" * (-len(cursore) % 4))
+        valori = json.loads(grezzo)
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError("Cursore non valido.") from e
+    if not isinstance(valori, list) or len(valori) != len(campi):
+        raise ValueError("Cursore non valido.")
+    try:
+        return [converti(valore) for converti, valore in zip(campi, valori)]
+    except (TypeError, ValueError, OverflowError) as e:
+        raise ValueError("Cursore non valido.") from e
+
+def campo_data(valore):
+    """'YYYY-MM-DD' (resta stringa: i backend la confrontano come la salvano)"""
+    datetime.strptime(valore, "%Y-%m-%d")
+    return valore
+
+def campo_ora(valore):
+    """'HH:MM' o 'HH:MM:SS' (PostgreSQL restituisce i secondi)"""
+    datetime.fromisoformat("2000-01-01T" + valore)
+    return valore
+
+def campo_istante(valore):
+    return datetime.fromisoformat(valore)
+
+def campo_id(valore):
+    if type(valore) is not int or not 0 <= valore < 2 ** 63:
+        raise TypeError("id non valido")
+    return valore
+
+def campo_numero(valore):
+    if type(valore) not in (int, float) or not math.isfinite(valore):
+        raise TypeError("numero non valido")
+    return float(valore)
+
+def filtri_richiesta():
+    """Filtri opzionali data/ora/tavolo della query string, normalizzati.
+
+    Solleva ValueError se data o ora non sono valide.
+    """
+    data = request.args.get('data')
+    ora = request.args.get('ora')
+    return (
+        normalizza_data(data) if data else None,
+        normalizza_ora(ora) if ora else None,
+        request.args.get('tavolo') or None
+    )
+
 def valida_prenotazione(dati):
     """Valida i dati di una prenotazione"""
     nome = dati.get('nome')
@@ -224,14 +1637,643 @@ def valida_prenotazione(dati):
     if not all([nome, telefono, data, ora, ospiti, tavolo]):
         return {"valida": False, "errore": "Compila tutti i campi obbligatori."}
     
-    if tavolo not in TAVOLI:
+    if not isinstance(tavolo, str):
         return {"valida": False, "errore": "Tavolo non valido."}
-    
-    if TAVOLI[tavolo] == 0:
+    if tavolo == TAVOLO_AUTOMATICO:
+        pass
+    elif tavolo not in TAVOLI:
+        return {"valida": False, "errore": "Tavolo non valido."}
+    elif TAVOLI[tavolo] == 0:
         return {"valida": False, "errore": "Questo tavolo non è prenotabile."}
     
+    try:
+        normalizza_data(data)
+        normalizza_ora(ora)
+    except (ValueError, AttributeError):
+        return {"valida": False, "errore": "Data o ora non valida."}
+    
     return {"valida": True}
 
+# ================================
+# SCRITTURA DIFFERITA (WRITE-BEHIND)
+# ================================
+# Opzionale (SCRITTURA_DIFFERITA=1): feedback e promemoria vengono confermati
+# subito e scritti in blocco da un thread per tabella, quando il blocco è
+# pieno o è passato l'intervallo. Gli id sono riservati in anticipo dalla
+# sequenza, così la risposta resta identica a quella della scrittura diretta.
+SCRITTURA_DIFFERITA = os.environ.get("SCRITTURA_DIFFERITA") == "1"
+SCRITTURA_BATCH_MAX = int(os.environ.get("SCRITTURA_BATCH_MAX", 200))          # righe per INSERT
+SCRITTURA_INTERVALLO = float(os.environ.get("SCRITTURA_INTERVALLO", 0.5))      # secondi
+SCRITTURA_CODA_MAX = int(os.environ.get("SCRITTURA_CODA_MAX", 10000))          # oltre si scrive subito
+SCRITTURA_BLOCCO_ID = 100  # id riservati dalla sequenza per ogni round trip
+# Blocchi non scritti dopo tutti i tentativi (database irraggiungibile): salvati
+# qui in NDJSON e riscritti appena il database torna, anche da un altro worker
+SCRITTURA_RECUPERO_DIR = os.environ.get(
+    "SCRITTURA_RECUPERO_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "scritture_fallite")
+)
+SCRITTURA_RECUPERO_INTERVALLO = 30  # secondi tra due tentativi di recupero
+
+class ScritturaDifferita:
+    """Coda di INSERT per una tabella, svuotata in blocco da un thread dedicato"""
+
+    def __init__(self, tabella, colonne):
+        self.tabella = tabella
+        self.colonne = colonne
+        self.pid = os.getpid()
+        self._coda = queue.Queue(maxsize=SCRITTURA_CODA_MAX)
+        self._id_liberi = deque()
+        self._id_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "accodate": 0,
+            "scritte": 0,
+            "flush": 0,
+            "errori": 0,
+            "flush_ultimo_ms": 0.0,
+            "flush_max_ms": 0.0,
+            "flush_totale_ms": 0.0,
+            "su_disco": 0,
+            "recuperate": 0
+        }
+        self._ultimo_recupero = 0.0
+        self._thread = threading.Thread(target=self._ciclo, name=f"scrittura-{tabella}", daemon=True)
+        self._thread.start()
+
+    def prossimo_id(self):
+        """Id riservato dalla sequenza della tabella (a blocchi)"""
+        with self._id_lock:
+            if not self._id_liberi:
+                with db_connection() as conn, conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT nextval(pg_get_serial_sequence(%s, 'id')) AS id FROM generate_series(1, %s)",
+                        (self.tabella, SCRITTURA_BLOCCO_ID)
+                    )
+                    self._id_liberi.extend(r["id"] for r in cur.fetchall())
+                    conn.commit()
+            return self._id_liberi.popleft()
+
+    def accoda(self, riga):
+        """Accoda una riga (tupla nell'ordine di `colonne`); False se la coda è piena"""
+        try:
+            self._coda.put_nowait(riga)
+        except queue.Full:
+            return False
+        with self._stats_lock:
+            self._stats["accodate"] += 1
+        return True
+
+    def _scrivi(self, righe):
+        inizio = time.monotonic()
+        with db_connection() as conn, conn.cursor() as cur:
+            # ON CONFLICT: un blocco recuperato dal disco può essere già stato scritto
+            # (commit riuscito ma risposta persa), gli id della sequenza lo riconoscono
+            execute_values(
+                cur,
+                f"INSERT INTO {self.tabella} ({', '.join(self.colonne)}) VALUES %s ON CONFLICT (id) DO NOTHING",
+                righe,
+                page_size=SCRITTURA_BATCH_MAX
+            )
+            cur.execute("SELECT pg_notify(%s, %s)", (OCCUPAZIONE_CANALE, notifica_risorsa(self.tabella)))
+            conn.commit()
+        get_versioni().invalida(self.tabella)
+        durata = (time.monotonic() - inizio) * 1000
+        with self._stats_lock:
+            self._stats["scritte"] += len(righe)
+            self._stats["flush"] += 1
+            self._stats["flush_ultimo_ms"] = round(durata, 3)
+            self._stats["flush_max_ms"] = round(max(self._stats["flush_max_ms"], durata), 3)
+            self._stats["flush_totale_ms"] += durata
+
+    def _scrivi_con_retry(self, righe, tentativi=5):
+        try:
+            self._scrivi_o_registra(righe, tentativi)
+        finally:
+            for _ in righe:
+                self._coda.task_done()
+
+    def _scrivi_o_registra(self, righe, tentativi):
+        for tentativo in range(tentativi):
+            try:
+                self._scrivi(righe)
+                return True
+            except Exception as e:
+                with self._stats_lock:
+                    self._stats["errori"] += 1
+                print(f"[ERROR] Scrittura differita su {self.tabella} fallita ({tentativo + 1}/{tentativi}): {e}")
+                time.sleep(min(2 ** tentativo * 0.1, 5))
+        self._salva_su_disco(righe)
+        return False
+
+    def _salva_su_disco(self, righe):
+        """Salva un blocco non scritto in SCRITTURA_RECUPERO_DIR (file completo o niente)"""
+        nome = os.path.join(SCRITTURA_RECUPERO_DIR, f"{self.tabella}-{os.getpid()}-{time.time_ns()}.ndjson")
+        try:
+            os.makedirs(SCRITTURA_RECUPERO_DIR, exist_ok=True)
+            with open(nome + ".parziale", "w", encoding="utf-8") as f:
+                for riga in righe:
+                    f.write(json.dumps(riga, default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(nome + ".parziale", nome)
+        except OSError as e:
+            # Né database né disco: le righe restano almeno nei log
+            print(f"[ERROR] Impossibile salvare su disco il blocco di {self.tabella}: {e}")
+            for riga in righe:
+                print(f"[PERSA] {self.tabella} {json.dumps(riga, default=str)}")
+            return
+        with self._stats_lock:
+            self._stats["su_disco"] += len(righe)
+        metriche.SCRITTURE_SU_DISCO.labels(self.tabella).inc(len(righe))
+        print(f"[WARNING] {len(righe)} righe di {self.tabella} salvate in {nome}, riscritte al ritorno del database")
+
+    def _file_da_recuperare(self):
+        """File in attesa della tabella, compresi quelli presi da un worker terminato"""
+        try:
+            nomi = sorted(os.listdir(SCRITTURA_RECUPERO_DIR))
+        except FileNotFoundError:
+            return []
+        file = []
+        for nome in nomi:
+            if not nome.startswith(self.tabella + "-"):
+                continue
+            if nome.endswith(".ndjson"):
+                file.append(nome)
+            elif ".ndjson." in nome and not nome.endswith(".parziale"):
+                pid = nome.rsplit(".", 1)[1]
+                if pid.isdigit() and not _processo_attivo(int(pid)):
+                    file.append(nome)
+        return file
+
+    def _recupera(self):
+        """Riscrive i blocchi salvati su disco; si ferma al primo errore (database ancora giù)"""
+        self._ultimo_recupero = time.monotonic()
+        for nome in self._file_da_recuperare():
+            originale = os.path.join(SCRITTURA_RECUPERO_DIR, nome.split(".ndjson")[0] + ".ndjson")
+            preso = f"{originale}.{os.getpid()}"
+            try:
+                # rename atomico: un solo worker prende il file
+                os.replace(os.path.join(SCRITTURA_RECUPERO_DIR, nome), preso)
+            except FileNotFoundError:
+                continue
+            try:
+                with open(preso, encoding="utf-8") as f:
+                    righe = [tuple(json.loads(riga)) for riga in f if riga.strip()]
+                self._scrivi(righe)
+            except Exception as e:
+                os.replace(preso, originale)
+                print(f"[WARNING] Recupero di {originale} rimandato: {e}")
+                return
+            os.remove(preso)
+            with self._stats_lock:
+                self._stats["recuperate"] += len(righe)
+            metriche.SCRITTURE_RECUPERATE.labels(self.tabella).inc(len(righe))
+            print(f"[OK] Recuperate {len(righe)} righe di {self.tabella} da {originale}")
+
+    def _preleva(self, attesa):
+        """Preleva fino a SCRITTURA_BATCH_MAX righe, attendendo al massimo `attesa` secondi"""
+        righe = []
+        scadenza = time.monotonic() + attesa
+        while len(righe) < SCRITTURA_BATCH_MAX:
+            restante = scadenza - time.monotonic()
+            try:
+                if restante <= 0:
+                    righe.append(self._coda.get_nowait())
+                else:
+                    righe.append(self._coda.get(timeout=restante))
+            except queue.Empty:
+                break
+        return righe
+
+    def _ciclo(self):
+        while True:
+            righe = self._preleva(SCRITTURA_INTERVALLO)
+            if righe:
+                self._scrivi_con_retry(righe)
+            if time.monotonic() - self._ultimo_recupero >= SCRITTURA_RECUPERO_INTERVALLO:
+                try:
+                    self._recupera()
+                except Exception as e:
+                    print(f"[ERROR] Recupero delle scritture di {self.tabella} fallito: {e}")
+
+    def svuota(self):
+        """Scrive subito tutto ciò che è in coda e attende il blocco in corso (chiusura del worker)"""
+        while True:
+            righe = self._preleva(0)
+            if not righe:
+                break
+            self._scrivi_con_retry(righe)
+        self._coda.join()
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        flush = stats.pop("flush_totale_ms")
+        stats["in_coda"] = self._coda.qsize()
+        stats["file_su_disco"] = len(self._file_da_recuperare())
+        stats["flush_medio_ms"] = round(flush / stats["flush"], 3) if stats["flush"] else 0
+        return stats
+
+def _processo_attivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+_scritture = {}
+_scritture_lock = threading.Lock()
+
+# Colonne scritte dalla coda per ogni tabella
+SCRITTURA_COLONNE = {
+    "feedbacks": ("id", "nome", "rating", "message", "timestamp"),
+    "reminder_requests": ("id", "contact", "timestamp")
+}
+
+def get_scrittura(tabella):
+    """Coda di scrittura differita del processo corrente per la tabella"""
+    coda = _scritture.get(tabella)
+    if coda is not None and coda.pid == os.getpid():
+        return coda
+    with _scritture_lock:
+        coda = _scritture.get(tabella)
+        if coda is None or coda.pid != os.getpid():
+            coda = _scritture[tabella] = ScritturaDifferita(tabella, SCRITTURA_COLONNE[tabella])
+        return coda
+
+def scrivi_differita(tabella, valori):
+    """Accoda una riga e ne restituisce l'id; None se va scritta subito"""
+    if not SCRITTURA_DIFFERITA or not get_archivio().scrittura_differita:
+        return None
+    coda = get_scrittura(tabella)
+    nuovo_id = coda.prossimo_id()
+    if not coda.accoda((nuovo_id,) + valori):
+        return None
+    return nuovo_id
+
+def svuota_scritture_differite():
+    """Svuota le code del processo corrente (chiamata alla chiusura)"""
+    for coda in list(_scritture.values()):
+        if coda.pid == os.getpid():
+            coda.svuota()
+
+def stats_scritture_differite():
+    return {tabella: coda.stats() for tabella, coda in _scritture.items() if coda.pid == os.getpid()}
+
+atexit.register(svuota_scritture_differite)
+
+# ================================
+# IDEMPOTENZA DELLE POST
+# ================================
+# Con l'header Idempotency-Key la prima risposta viene salvata nella tabella
+# richieste_idempotenti (condivisa tra i worker, chiave unica per endpoint) e
+# in una cache locale limitata. I retry con la stessa chiave ricevono la
+# risposta salvata senza ripetere controlli e INSERT.
+IDEMPOTENZA_TTL = int(os.environ.get("IDEMPOTENZA_TTL", 24 * 3600))       # secondi
+IDEMPOTENZA_CACHE_MAX = int(os.environ.get("IDEMPOTENZA_CACHE_MAX", 1000))  # voci per worker
+IDEMPOTENZA_PULIZIA = 600  # secondi tra due pulizie delle chiavi scadute
+IDEMPOTENZA_TENTATIVI = 3  # prenotazioni della chiave se la riga sparisce durante la lettura
+
+class CacheIdempotenza:
+    """Cache LRU con scadenza delle risposte già inviate"""
+
+    def __init__(self, massimo, ttl):
+        self.massimo = massimo
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._voci = OrderedDict()  # (endpoint, chiave) -> (scadenza, impronta, stato, corpo)
+
+    def leggi(self, chiave):
+        with self._lock:
+            voce = self._voci.get(chiave)
+            if voce is None:
+                return None
+            if voce[0] < time.monotonic():
+                del self._voci[chiave]
+                return None
+            self._voci.move_to_end(chiave)
+            return voce[1:]
+
+    def scrivi(self, chiave, impronta, stato, corpo):
+        with self._lock:
+            self._voci[chiave] = (time.monotonic() + self.ttl, impronta, stato, corpo)
+            self._voci.move_to_end(chiave)
+            while len(self._voci) > self.massimo:
+                self._voci.popitem(last=False)
+
+_cache_idempotenza = CacheIdempotenza(IDEMPOTENZA_CACHE_MAX, IDEMPOTENZA_TTL)
+_ultima_pulizia_idempotenza = 0.0
+
+def _pulisci_idempotenza(archivio):
+    """Elimina le chiavi scadute (al massimo una volta ogni IDEMPOTENZA_PULIZIA secondi)"""
+    global _ultima_pulizia_idempotenza
+    adesso = time.monotonic()
+    if adesso - _ultima_pulizia_idempotenza < IDEMPOTENZA_PULIZIA:
+        return
+    _ultima_pulizia_idempotenza = adesso
+    archivio.pulisci_chiavi(IDEMPOTENZA_TTL)
+
+def impronta_richiesta(dati, grezzi):
+    """Impronta del corpo: JSON in forma canonica (così la stessa prenotazione inviata
+    da /api/prenota o come voce di /api/prenota/batch ha la stessa impronta), altrimenti i byte"""
+    if dati is None:
+        return hashlib.sha256(grezzi).hexdigest()
+    return hashlib.sha256(json.dumps(dati, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+def riserva_chiave(archivio, endpoint, chiave, impronta):
+    """prenota_chiave ripetuta se la riga esistente sparisce tra l'INSERT e la lettura"""
+    for _ in range(IDEMPOTENZA_TENTATIVI):
+        nuova, esistente = archivio.prenota_chiave(endpoint, chiave, impronta)
+        # esistente None: la chiave è stata liberata (errore) o è scaduta tra
+        # l'INSERT e la lettura: si riprova a prenotarla
+        if nuova or esistente is not None:
+            break
+    return nuova, esistente
+
+def _risposta_salvata(stato, corpo):
+    return Response(corpo, status=stato, mimetype="application/json",
+                    headers={"Idempotent-Replayed": "true"})
+
+def idempotente(view):
+    """Decoratore per le POST: onora l'header Idempotency-Key"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        chiave = request.headers.get("Idempotency-Key")
+        if not chiave:
+            return view(*args, **kwargs)
+        if len(chiave) > 255:
+            return jsonify({"error": "Idempotency-Key troppo lunga."}), 400
+        
+        endpoint = request.path
+        impronta = impronta_richiesta(request.get_json(silent=True), request.get_data())
+        
+        # 1. Cache locale del worker
+        salvata = _cache_idempotenza.leggi((endpoint, chiave))
+        if salvata is not None:
+            if salvata[0] != impronta:
+                return jsonify({"error": "Idempotency-Key già usata con dati diversi."}), 422
+            return _risposta_salvata(salvata[1], salvata[2])
+        
+        # 2. Prenota la chiave nel database (indice unico condiviso tra i worker)
+        archivio = get_archivio()
+        _pulisci_idempotenza(archivio)
+        nuova, esistente = riserva_chiave(archivio, endpoint, chiave, impronta)
+        
+        if not nuova:
+            if esistente is None:
+                return jsonify({"error": "Richiesta in elaborazione, riprova."}), 409
+            if esistente["impronta"] != impronta:
+                return jsonify({"error": "Idempotency-Key già usata con dati diversi."}), 422
+            if esistente["stato"] is None:
+                return jsonify({"error": "Richiesta già in elaborazione."}), 409
+            _cache_idempotenza.scrivi((endpoint, chiave), impronta, esistente["stato"], esistente["risposta"])
+            return _risposta_salvata(esistente["stato"], esistente["risposta"])
+        
+        # 3. Prima esecuzione: salva la risposta (o libera la chiave se errore del server).
+        # Se la view solleva, la chiave va liberata: altrimenti resterebbe "in
+        # elaborazione" e ogni nuovo tentativo del client riceverebbe 409 fino al TTL
+        try:
+            risposta = app.make_response(view(*args, **kwargs))
+        except BaseException:
+            try:
+                archivio.libera_chiave(endpoint, chiave)
+            except Exception as error:
+                print(f"[WARNING] Impossibile liberare la chiave idempotente: {error}")
+            raise
+        try:
+            if risposta.status_code >= 500:
+                archivio.libera_chiave(endpoint, chiave)
+            else:
+                corpo = risposta.get_data(as_text=True)
+                archivio.salva_risposta(endpoint, chiave, risposta.status_code, corpo)
+                _cache_idempotenza.scrivi((endpoint, chiave), impronta, risposta.status_code, corpo)
+        except Exception as error:
+            print(f"[WARNING] Impossibile salvare la risposta idempotente: {error}")
+        return risposta
+    return wrapper
+
+# ================================
+# CACHE HTTP (ETAG / 304)
+# ================================
+# Le GET cacheabili hanno un ETag uguale in tutti i worker: per i tavoli
+# l'impronta della matrice di occupazione in memoria, per feedback e
+# statistiche anche quella dei conteggi e dell'ultimo id delle tabelle,
+# riletti (una query leggera) solo dopo una scrittura propria o notificata.
+# Con If-None-Match uguale la risposta è un 304 senza corpo.
+POLITICHE_CACHE = {
+    "get_tavoli_info": "public, max-age=3600",
+    "get_tavoli": "no-cache",
+    "get_griglia_tavoli": "no-cache",
+    "get_feedback": "no-cache",
+    "cerca_feedback": "no-cache",
+    "get_stats": "private, no-cache",
+    "get_prenotazioni": "private, no-store",
+    "get_reminder": "private, no-store",
+    "export_prenotazioni": "private, no-store",
+    "export_feedback": "private, no-store",
+}
+
+# La configurazione dei tavoli cambia solo con un nuovo deploy di questo file
+ULTIMA_MODIFICA_CONFIG = datetime.fromtimestamp(int(os.path.getmtime(__file__)), timezone.utc)
+
+class VersioniRisorse:
+    """Stato delle risorse da cui si calcolano gli ETag.
+
+    Gli ETag sono impronte di valori uguali in tutti i worker: righe e ultimo
+    id di feedback e promemoria letti dal database, contenuto della matrice
+    di occupazione per le prenotazioni. Qualunque worker conferma quindi un
+    If-None-Match. Dopo una scrittura (propria o notificata) i conteggi sono
+    riletti alla prima richiesta che li usa.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._conteggi = None  # None: da rileggere
+        self._generazione = 0  # cambia a ogni invalidazione
+
+    def invalida(self, risorsa):
+        """Dopo una scrittura su `risorsa` (i conteggi si rileggono tutti con una query)"""
+        with self._lock:
+            self._conteggi = None
+            self._generazione += 1
+
+    def verifica(self, conteggi):
+        """Controllo periodico: se i conteggi sono cambiati vanno riletti. Non li
+        salva: letti prima di una scrittura appena invalidata, sarebbero già vecchi"""
+        with self._lock:
+            if self._conteggi is not None and self._conteggi != dict(conteggi):
+                self._conteggi = None
+                self._generazione += 1
+
+    def _conteggi_attuali(self):
+        with self._lock:
+            conteggi, generazione = self._conteggi, self._generazione
+        if conteggi is None:
+            conteggi = dict(get_archivio().conteggi_risorse())
+            with self._lock:
+                # Una scrittura arrivata durante la lettura la rende già vecchia
+                if self._generazione == generazione:
+                    self._conteggi = conteggi
+        return conteggi
+
+    def etag(self, *risorse):
+        valori = []
+        conteggi = None
+        for risorsa in risorse:
+            if risorsa == "prenotazioni":
+                valori.append(get_occupazione().firma())
+            else:
+                conteggi = conteggi or self._conteggi_attuali()
+                valori.append((conteggi[risorsa], conteggi[f"{risorsa}_id"]))
+        return impronta(valori)
+
+_versioni = None
+_versioni_lock = threading.Lock()
+
+def get_versioni():
+    """Stato delle risorse del processo corrente"""
+    global _versioni
+    versioni = _versioni
+    if versioni is None or versioni.pid != os.getpid():
+        with _versioni_lock:
+            if _versioni is None or _versioni.pid != os.getpid():
+                _versioni = VersioniRisorse()
+            versioni = _versioni
+        # Le scritture degli altri worker arrivano dal thread dell'occupazione
+        get_occupazione()
+    return versioni
+
+def impronta(valore):
+    """ETag di un valore già in memoria (stesso risultato in tutti i worker)"""
+    return hashlib.blake2b(repr(valore).encode(), digest_size=8).hexdigest()
+
+def non_modificato(etag, ultima_modifica=None):
+    """Risposta 304 se il client ha già questa versione, altrimenti None"""
+    if request.if_none_match:
+        # If-None-Match ha la precedenza su If-Modified-Since
+        if not request.if_none_match.contains_weak(etag):
+            return None
+    elif ultima_modifica is None or request.if_modified_since is None or ultima_modifica > request.if_modified_since:
+        return None
+    risposta = Response(status=304)
+    return con_etag(risposta, etag, ultima_modifica)
+
+def con_etag(risposta, etag, ultima_modifica=None):
+    """Aggiunge ETag (debole: il corpo può essere compresso) e Last-Modified"""
+    risposta.set_etag(etag, weak=True)
+    if ultima_modifica is not None:
+        risposta.last_modified = ultima_modifica
+    return risposta
+
+# ================================
+# LIMITI DELLE RICHIESTE E AMMISSIONE
+# ================================
+# Prima di ogni endpoint due controlli:
+# 1. un token bucket per (IP, endpoint) condiviso dai worker della macchina
+#    (limitatore.py): oltre il limite 429 con Retry-After;
+# 2. per gli endpoint costosi un tetto di richieste contemporanee per worker
+#    e un 503 immediato con Retry-After se il pool del database è esaurito,
+#    invece di attendere DB_POOL_TIMEOUT in coda con le prenotazioni.
+# Le prenotazioni non vengono mai scartate per il pool: attendono il loro turno.
+# Il limite per IP è spento di default: senza PROXY_FIDATI dietro un proxy tutti i
+# client hanno l'IP del proxy, e anche con l'IP vero il wifi della festa mette
+# centinaia di telefoni dietro lo stesso NAT. Va acceso solo sapendo da dove
+# arrivano le richieste.
+LIMITE_RICHIESTE = os.environ.get("LIMITE_RICHIESTE", "0") == "1"
+if LIMITE_RICHIESTE and not PROXY_FIDATI:
+    print("[WARNING] LIMITE_RICHIESTE=1 senza PROXY_FIDATI: se il server è dietro un proxy "
+          "tutti i client condividono lo stesso limite")
+# Moltiplicatore dei limiti, es. 5 se molti client escono dallo stesso IP (wifi della festa)
+LIMITE_RICHIESTE_SCALA = float(os.environ.get("LIMITE_RICHIESTE_SCALA", 1))
+
+# endpoint -> (richieste al secondo, raffica) per IP. Dimensionati per un IP
+# condiviso da un centinaio di telefoni nell'ora di punta della festa: fermano
+# un client impazzito o uno script, non la coda alla cassa.
+LIMITI_RICHIESTE = {
+    "prenota": (5, 50),
+    "prenota_batch": (1, 20),
+    "crea_trattenuta": (5, 50),
+    "post_feedback": (2, 30),
+    "cerca_feedback": (5, 50),
+    "post_reminder": (2, 30),
+    "get_prenotazioni": (5, 50),
+    "get_reminder": (2, 20),
+    "export_prenotazioni": (0.2, 5),
+    "export_feedback": (0.2, 5),
+    "stream_tavoli": (5, 100),
+}
+LIMITE_PREDEFINITO = (20, 200)
+SENZA_LIMITI = {"health_check", "get_metrics"}
+
+# endpoint -> richieste contemporanee per worker (gli export tengono una
+# connessione per tutto lo streaming)
+CONCORRENZA_MAX = {
+    "get_prenotazioni": 3,
+    "get_reminder": 2,
+    "get_stats": 3,
+    "get_feedback": 4,
+    "cerca_feedback": 2,
+    "export_prenotazioni": 1,
+    "export_feedback": 1,
+}
+_semafori = {endpoint: threading.BoundedSemaphore(n) for endpoint, n in CONCORRENZA_MAX.items()}
+
+def rifiuta(stato, messaggio, attesa):
+    """Risposta 429/503 con il numero di secondi dopo cui riprovare"""
+    risposta = jsonify({"success": False, "error": messaggio})
+    risposta.status_code = stato
+    risposta.headers["Retry-After"] = str(max(1, math.ceil(attesa)))
+    return risposta
+
+@app.before_request
+def controllo_ammissione():
+    endpoint = request.endpoint
+    if request.method == "OPTIONS" or endpoint is None or endpoint in SENZA_LIMITI:
+        return None
+
+    if LIMITE_RICHIESTE:
+        ritmo, raffica = LIMITI_RICHIESTE.get(endpoint, LIMITE_PREDEFINITO)
+        consentita, attesa = limitatore.consuma(
+            f"{request.remote_addr}|{endpoint}", ritmo * LIMITE_RICHIESTE_SCALA, raffica * LIMITE_RICHIESTE_SCALA
+        )
+        if not consentita:
+            metriche.RIFIUTATE.labels(g.route, "limite").inc()
+            return rifiuta(429, "Troppe richieste, riprova tra poco.", attesa)
+
+    semaforo = _semafori.get(endpoint)
+    if semaforo is None:
+        return None
+    if not semaforo.acquire(blocking=False):
+        metriche.RIFIUTATE.labels(g.route, "concorrenza").inc()
+        return rifiuta(503, "Server occupato, riprova tra poco.", 1)
+    g.semaforo = semaforo
+    if get_archivio().saturo():
+        g.pop("semaforo").release()
+        metriche.RIFIUTATE.labels(g.route, "pool").inc()
+        return rifiuta(503, "Server occupato, riprova tra poco.", 1)
+    return None
+
+@app.after_request
+def rilascia_ammissione(response):
+    semaforo = g.pop("semaforo", None)
+    if semaforo is None:
+        return response
+    if response.is_streamed:
+        # Export in streaming: la connessione resta occupata finché il corpo non è stato inviato
+        response.call_on_close(semaforo.release)
+    else:
+        semaforo.release()
+    return response
+
+@app.teardown_request
+def rilascia_ammissione_errore(errore):
+    # Richiesta interrotta prima di after_request
+    semaforo = g.pop("semaforo", None)
+    if semaforo is not None:
+        semaforo.release()
+
 # ================================
 # API ENDPOINTS - TAVOLI
 # ================================
@@ -244,39 +2286,250 @@ def get_tavoli():
         if not data or not ora:
             return jsonify({"error": "Data e ora sono obbligatorie."}), 400
         
+        try:
+            data, ora = normalizza_data(data), normalizza_ora(ora)
+        except ValueError:
+            return jsonify({"error": "Data o ora non valida."}), 400
+        
         occupati = calcola_posti_occupati(data, ora)
         
-        stato_tavoli = {}
-        for tavolo in TAVOLI:
-            stato_tavoli[tavolo] = max(0, TAVOLI[tavolo] - occupati.get(tavolo, 0))
+        # ETag solo se letto dalla matrice (il fallback sul DB non è versionato)
+        etag = None
+        if get_occupazione().pronto:
+            etag = "t" + impronta(sorted(occupati.items()))
+            risposta = non_modificato(etag)
+            if risposta:
+                return risposta
         
         totale_prenotazioni = sum(occupati.values())
         
-        return jsonify({
+        risposta = risposta_json({
             "success": True,
-            "data": stato_tavoli,
+            "data": stato_tavoli(occupati),
             "info": {
                 "data": data,
                 "ora": ora,
                 "totalePrenotazioni": totale_prenotazioni
             }
         })
+        return con_etag(risposta, etag) if etag else risposta
         
     except Exception as error:
         print(f"Errore nel recupero stato tavoli: {error}")
         return jsonify({"error": "Errore interno del server."}), 500
 
+def calcola_griglia(slot=None, data=None):
+    """Occupati per tutti gli slot: dalla matrice in memoria o con un'unica query"""
+    motore = get_occupazione()
+    if motore.pronto:
+        slot, righe = motore.griglia(slot)
+    else:
+        indice = {t: i for i, t in enumerate(TAVOLI)}
+        per_slot = {}
+        for giorno, ora, tavolo, ospiti in get_archivio().totali_occupazione(data):
+            i = indice.get(tavolo)
+            if i is None:
+                continue
+            riga = per_slot.setdefault((giorno, ora), [0] * len(indice))
+            riga[i] += ospiti
+        if slot is None:
+            slot = sorted(per_slot)
+        righe = [per_slot.get(chiave, [0] * len(indice)) for chiave in slot]
+    if data:
+        filtrati = [(k, r) for k, r in zip(slot, righe) if k[0] == data]
+        slot = [k for k, _ in filtrati]
+        righe = [r for _, r in filtrati]
+    return slot, righe
+
+@app.route('/api/tavoli/griglia', methods=['GET'])
+def get_griglia_tavoli():
+    """Posti disponibili di ogni tavolo per ogni slot in una sola risposta.
+
+    Formato compatto: per ogni slot un array di posti liberi nell'ordine
+    di "tavoli", invece di un dizionario per tavolo.
+    """
+    try:
+        data = request.args.get('data')
+        if data:
+            try:
+                data = normalizza_data(data)
+            except ValueError:
+                return jsonify({"error": "Data non valida."}), 400
+        slot = slot_configurati() or None
+        
+        pronto = get_occupazione().pronto
+        slot, righe = calcola_griglia(slot, data)
+        
+        etag = None
+        if pronto:
+            etag = "g" + impronta((slot, [list(riga) for riga in righe]))
+            risposta = non_modificato(etag)
+            if risposta:
+                return risposta
+        
+        capienza = list(TAVOLI.values())
+        disponibili = [
+            [max(0, c - o) for c, o in zip(capienza, riga)]
+            for riga in righe
+        ]
+        
+        risposta = risposta_json({
+            "success": True,
+            "tavoli": list(TAVOLI),
+            "capienza": capienza,
+            "slot": [[d, o] for d, o in slot],
+            "disponibili": disponibili,
+            "occupati_totali": [sum(riga) for riga in righe]
+        })
+        return con_etag(risposta, etag) if etag else risposta
+        
+    except Exception as error:
+        print(f"Errore nel recupero griglia tavoli: {error}")
+        return jsonify({"error": "Errore interno del server."}), 500
+
+@app.route('/api/tavoli/stream', methods=['GET'])
+def stream_tavoli():
+    """Stream SSE della disponibilità dei tavoli per uno slot data/ora"""
+    data = request.args.get('data')
+    ora = request.args.get('ora')
+    
+    if not data or not ora:
+        return jsonify({"error": "Data e ora sono obbligatorie."}), 400
+    
+    try:
+        data, ora = normalizza_data(data), normalizza_ora(ora)
+    except ValueError:
+        return jsonify({"error": "Data o ora non valida."}), 400
+    
+    hub = get_stream_hub()
+    coda = hub.iscrivi(data, ora)
+    if coda is None:
+        return jsonify({"error": "Troppi client connessi, riprova più tardi."}), 503, {"Retry-After": "10"}
+    
+    def genera():
+        try:
+            # Snapshot iniziale, poi solo le variazioni
+            yield "retry: 3000\n"
+            yield evento_sse("snapshot", stato_tavoli(calcola_posti_occupati(data, ora)))
+            while True:
+                try:
+                    evento = coda.get(timeout=STREAM_HEARTBEAT)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if evento is None:
+                    return
+                yield evento_sse(*evento)
+        finally:
+            hub.disiscrivi(data, ora, coda)
+    
+    return Response(genera(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
 @app.route('/api/tavoli/info', methods=['GET'])
 def get_tavoli_info():
-    return jsonify({
+    etag = "i" + impronta(TAVOLI_CONFIG)
+    risposta = non_modificato(etag, ULTIMA_MODIFICA_CONFIG)
+    if risposta:
+        return risposta
+    risposta = risposta_json({
         "success": True,
         "configurazione": {
             "tavoli_riservati": TAVOLI_CONFIG["riservati"],
             "tavoli_standard": TAVOLI_CONFIG["standard"],
             "posti_per_tavolo_standard": 10,
-            "totale_tavoli": len(TAVOLI)
+            "totale_tavoli": len(TAVOLI),
+            "file": TAVOLI_CONFIG["file"],
+            "ospiti_max_gruppo": OSPITI_MAX_GRUPPO
         }
     })
+    return con_etag(risposta, etag, ULTIMA_MODIFICA_CONFIG)
+
+# ================================
+# API ENDPOINTS - TRATTENUTE
+# ================================
+# Mentre l'utente compila il modulo i posti scelti restano trattenuti per
+# TRATTENUTE_TTL secondi: contano come occupati per tutti gli altri e /api/prenota
+# con il token li consuma. Quelle abbandonate scadono da sole; il numero di
+# trattenute attive è limitato da TRATTENUTE_MAX (la memoria resta limitata).
+TRATTENUTE_TTL = int(os.environ.get("TRATTENUTE_TTL", 300))      # secondi
+TRATTENUTE_MAX = int(os.environ.get("TRATTENUTE_MAX", 5000))     # attive in tutto
+
+@app.route('/api/tavoli/hold', methods=['POST'])
+@idempotente
+def crea_trattenuta():
+    """Trattiene per qualche minuto i posti di un tavolo; restituisce il token da passare a /api/prenota"""
+    try:
+        dati = request.get_json(silent=True) or {}
+        if not isinstance(dati, dict):
+            return jsonify({"error": "Richiesta non valida."}), 400
+        data = dati.get('data')
+        ora = dati.get('ora')
+        tavolo = dati.get('tavolo')
+        ospiti = dati.get('ospiti')
+        
+        if not all([data, ora, tavolo, ospiti]):
+            return jsonify({"error": "Data, ora, tavolo e ospiti sono obbligatori."}), 400
+        if not isinstance(tavolo, str) or tavolo not in TAVOLI or TAVOLI[tavolo] == 0:
+            return jsonify({"error": "Tavolo non valido."}), 400
+        try:
+            data, ora = normalizza_data(data), normalizza_ora(ora)
+            posti_richiesti = 7 if ospiti == "7+" else int(ospiti)
+        except (ValueError, TypeError, AttributeError):
+            return jsonify({"error": "Data, ora o numero ospiti non validi."}), 400
+        if not 0 < posti_richiesti <= TAVOLI[tavolo]:
+            return jsonify({"error": "Numero ospiti non valido."}), 400
+        
+        motore = get_occupazione()
+        if motore.numero_trattenute() >= TRATTENUTE_MAX:
+            print("[WARNING] Troppe trattenute attive")
+            return rifiuta(503, "Troppe richieste in corso, riprova tra poco.", 10)
+        
+        token = secrets.token_urlsafe(16)
+        scade = time.time() + TRATTENUTE_TTL
+        inserita, posti_occupati = get_archivio().inserisci_trattenuta(
+            token, data, ora, tavolo, posti_richiesti, TAVOLI[tavolo], scade
+        )
+        if not inserita:
+            return jsonify({
+                "error": "Non ci sono abbastanza posti disponibili su questo tavolo.",
+                "info": {
+                    "posti_richiesti": posti_richiesti,
+                    "posti_disponibili": max(0, TAVOLI[tavolo] - posti_occupati),
+                    "posti_totali": TAVOLI[tavolo]
+                }
+            }), 400
+        motore.trattieni(token, data, ora, tavolo, posti_richiesti, scade)
+        
+        return jsonify({
+            "success": True,
+            "trattenuta": {
+                "token": token,
+                "data": data,
+                "ora": ora,
+                "tavolo": tavolo,
+                "ospiti": posti_richiesti,
+                "scade": datetime.fromtimestamp(scade, timezone.utc).isoformat(),
+                "ttl": TRATTENUTE_TTL
+            }
+        })
+        
+    except Exception as error:
+        print(f"[ERROR] Errore nella trattenuta: {error}")
+        return jsonify({"error": "Errore interno del server."}), 500
+
+@app.route('/api/tavoli/hold/<token>', methods=['DELETE'])
+def rilascia_trattenuta(token):
+    """Rilascia una trattenuta prima della scadenza (ad esempio cambiando tavolo)"""
+    try:
+        rilasciata = get_archivio().rilascia_trattenuta(token)
+        get_occupazione().rilascia(token)
+        return jsonify({"success": True, "rilasciata": rilasciata})
+    except Exception as error:
+        print(f"[ERROR] Errore nel rilascio della trattenuta: {error}")
+        return jsonify({"error": "Errore interno del server."}), 500
 
 # ================================
 # API ENDPOINTS - TEST/HEALTH
@@ -287,12 +2540,9 @@ def health_check():
     db_status = "disconnected"
     db_error = None
     
+    archivio = get_archivio()
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT 1")
-        cur.close()
-        conn.close()
+        archivio.ping()
         db_status = "connected"
     except Exception as e:
         db_error = str(e)
@@ -303,17 +2553,52 @@ def health_check():
         "timestamp": datetime.now().isoformat(),
         "database": {
             "status": db_status,
-            "error": db_error
-        }
+            "error": db_error,
+            "pool": archivio.stats(),
+            "schema": archivio.schema()
+        },
+        "stream": get_stream_hub().stats(),
+        "trattenute": get_occupazione().numero_trattenute(),
+        "scrittura_differita": stats_scritture_differite()
     })
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Metriche in formato Prometheus"""
+    corpo, content_type = metriche.esporta()
+    return Response(corpo, mimetype=None, content_type=content_type)
+
+@app.route('/api/debug/sql', methods=['GET'])
+def get_debug_sql():
+    """Query più costose, query lente e tracce delle ultime richieste (TRACCIA_SQL=1)"""
+    if not tracciamento.ATTIVO:
+        return jsonify({"success": False, "message": "Tracciamento SQL non attivo (TRACCIA_SQL=1)"}), 404
+
+    ordine = request.args.get('ordine', 'totale_ms')
+    if ordine not in ("totale_ms", "max_ms", "medio_ms", "chiamate"):
+        return jsonify({"success": False, "message": "Ordine non valido"}), 400
+    try:
+        n = max(1, min(int(request.args.get('top', 10)), 100))
+    except ValueError:
+        return jsonify({"success": False, "message": "Parametro top non valido"}), 400
+
+    risposta = {
+        "success": True,
+        "worker": os.getpid(),
+        "soglia_lenta_ms": tracciamento.SOGLIA_LENTA_MS,
+        "top": tracciamento.top(n, ordine),
+        "lente": tracciamento.lente()
+    }
+    if request.args.get('richieste') == '1':
+        risposta["richieste"] = tracciamento.ultime_richieste()
+    return jsonify(risposta)
+
 # ================================
 # API ENDPOINTS - PRENOTAZIONI
 # ================================
 @app.route('/api/prenota', methods=['POST'])
+@idempotente
 def prenota():
-    conn = None
-    cur = None
     try:
         dati = request.get_json()
         print(f"[DEBUG] Ricevuta richiesta prenotazione: {dati}")
@@ -331,6 +2616,7 @@ def prenota():
         if not validazione["valida"]:
             print(f"[ERROR] Validazione fallita: {validazione['errore']}")
             return jsonify({"error": validazione["errore"]}), 400
+        data, ora = normalizza_data(data), normalizza_ora(ora)
         
         # Conversione ospiti
         posti_richiesti = 7 if ospiti == "7+" else int(ospiti)
@@ -338,13 +2624,39 @@ def prenota():
             print(f"[ERROR] Numero ospiti non valido: {ospiti}")
             return jsonify({"error": "Numero ospiti non valido."}), 400
         
-        # Controllo disponibilità
-        posti_occupati = calcola_posti_occupati(data, ora, tavolo)
+        if tavolo == TAVOLO_AUTOMATICO:
+            return prenota_tavolo_automatico(nome.strip(), telefono.strip(), data, ora, posti_richiesti, note.strip())
+        
+        # Pre-controllo in memoria: le prenotazioni possono solo crescere, quindi
+        # se la matrice dice "pieno" il tavolo è pieno senza interrogare il DB
+        # (le trattenute scadono, le controlla il database)
+        motore = get_occupazione()
+        if motore.pronto:
+            posti_occupati = motore.occupati_tavolo(data, ora, tavolo, trattenute=False)
+            if posti_richiesti > TAVOLI[tavolo] - posti_occupati:
+                print("[ERROR] Posti insufficienti (occupazione in memoria)")
+                return jsonify({
+                    "error": "Non ci sono abbastanza posti disponibili su questo tavolo.",
+                    "info": {
+                        "posti_richiesti": posti_richiesti,
+                        "posti_disponibili": TAVOLI[tavolo] - posti_occupati,
+                        "posti_totali": TAVOLI[tavolo]
+                    }
+                }), 400
+        
+        # Controllo disponibilità e inserimento atomici
+        print("[DB] Controllo posti e INSERT...")
+        trattenuta = dati.get('trattenuta')
+        prenotazione_id, posti_occupati = inserisci_prenotazione(
+            nome.strip(), telefono.strip(), data, ora,
+            posti_richiesti, tavolo, note.strip(),
+            trattenuta if isinstance(trattenuta, str) and trattenuta else None
+        )
         posti_disponibili = TAVOLI[tavolo] - posti_occupati
         
         print(f"[TABLE] Tavolo {tavolo}: {posti_occupati} occupati, {posti_disponibili} disponibili, {posti_richiesti} richiesti")
         
-        if posti_richiesti > posti_disponibili:
+        if prenotazione_id is None:
             print("[ERROR] Posti insufficienti")
             return jsonify({
                 "error": "Non ci sono abbastanza posti disponibili su questo tavolo.",
@@ -355,23 +2667,6 @@ def prenota():
                 }
             }), 400
         
-        # Inserimento prenotazione
-        print("[DB] Apertura connessione...")
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        print("[DB] Esecuzione INSERT...")
-        cur.execute(
-            """
-            INSERT INTO prenotazioni (nome, telefono, data, ora, ospiti, tavolo, note)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-            """,
-            (nome.strip(), telefono.strip(), data, ora, posti_richiesti, tavolo, note.strip())
-        )
-        
-        prenotazione_id = cur.fetchone()["id"]
-        conn.commit()
         print(f"[OK] Prenotazione inserita con ID: {prenotazione_id}")
         
         nuova_prenotazione = {
@@ -398,58 +2693,325 @@ def prenota():
         import traceback
         print(f"[ERROR] Traceback: {traceback.format_exc()}")
         return jsonify({"error": f"Errore interno del server: {str(error)}"}), 500
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+
+def prenota_tavolo_automatico(nome, telefono, data, ora, posti_richiesti, note):
+    """Risposta di /api/prenota con tavolo "auto": i tavoli li sceglie il backend"""
+    if posti_richiesti > OSPITI_MAX_GRUPPO:
+        return jsonify({
+            "error": f"Per gruppi di più di {OSPITI_MAX_GRUPPO} persone contatta gli organizzatori."
+        }), 400
+    
+    assegnate = prenota_automatica(nome, telefono, data, ora, posti_richiesti, note)
+    if assegnate is None:
+        print("[ERROR] Nessun tavolo libero per l'assegnazione automatica")
+        return jsonify({
+            "error": "Non ci sono tavoli vicini con abbastanza posti per questo orario.",
+            "info": {"posti_richiesti": posti_richiesti}
+        }), 400
+    
+    tavoli = [tavolo for _, tavolo, _ in assegnate]
+    print(f"[OK] Assegnazione automatica: {posti_richiesti} ospiti ai tavoli {', '.join(tavoli)}")
+    return jsonify({
+        "success": True,
+        "prenotazione": {
+            "id": str(assegnate[0][0]),
+            "nome": nome,
+            "telefono": telefono,
+            "data": data,
+            "ora": ora,
+            "ospiti": posti_richiesti,
+            "tavolo": ", ".join(tavoli),
+            "tavoli": [
+                {"id": str(prenotazione_id), "tavolo": tavolo, "ospiti": persone}
+                for prenotazione_id, tavolo, persone in assegnate
+            ],
+            "note": note,
+            "timestamp": datetime.now().isoformat()
+        },
+        "message": "Prenotazione effettuata con successo!"
+    })
+
+PRENOTA_BATCH_MAX = 50  # prenotazioni per richiesta
+
+def _salva_rif(archivio, rif, corpo):
+    """Salva l'esito di una voce come risposta di /api/prenota con Idempotency-Key `rif`"""
+    try:
+        stato = 200 if corpo.get("success") else 400
+        archivio.salva_risposta('/api/prenota', rif, stato, jsonify(corpo).get_data(as_text=True))
+    except Exception as error:
+        print(f"[WARNING] Impossibile salvare la risposta idempotente: {error}")
+
+def _libera_rif(archivio, rif):
+    try:
+        archivio.libera_chiave('/api/prenota', rif)
+    except Exception as error:
+        print(f"[WARNING] Impossibile liberare la chiave idempotente: {error}")
+
+@app.route('/api/prenota/batch', methods=['POST'])
+@idempotente
+def prenota_batch():
+    """Più prenotazioni in una richiesta, ad esempio la coda offline del service worker.
+
+    Ogni prenotazione ha il suo esito (nello stesso ordine, con il "rif" del
+    client se presente). Il "rif" è l'Idempotency-Key della POST /api/prenota
+    originale: se quella prenotazione è già stata eseguita l'esito salvato
+    viene restituito (con "ripetuta": true) senza un secondo inserimento, e
+    l'esito della voce viene salvato sotto la stessa chiave.
+
+    Il blocco non è atomico: le prenotazioni a tavolo fisso sono controllate
+    contro la stessa occupazione e inserite in un'unica transazione, quelle
+    con tavolo "auto" ognuna nella propria, dopo. Ogni esito dice se quella
+    prenotazione è stata salvata; una voce fallita per un errore del server ha
+    "riprova": true e il suo rif resta libero per un nuovo invio.
+    """
+    archivio = get_archivio()
+    chiavi = {}  # indice -> rif riservato e non ancora salvato
+
+    def concludi(i, corpo):
+        """Esito definitivo della voce i, salvato sotto il suo rif"""
+        risultati[i].update({"success": False}, **corpo)
+        rif = chiavi.pop(i, None)
+        if rif is not None:
+            _salva_rif(archivio, rif, corpo)
+
+    try:
+        dati = request.get_json(silent=True)
+        elenco = dati.get('prenotazioni') if isinstance(dati, dict) else None
+        if not isinstance(elenco, list) or not elenco:
+            return jsonify({"error": "Invia un elenco 'prenotazioni' non vuoto."}), 400
+        if len(elenco) > PRENOTA_BATCH_MAX:
+            return jsonify({"error": f"Al massimo {PRENOTA_BATCH_MAX} prenotazioni per richiesta."}), 400
+
+        risultati = []
+        valide, posizioni = [], []
+        automatiche = []  # tavolo "auto": assegnate una alla volta dopo il blocco
+        for i, voce in enumerate(elenco):
+            esito = {"indice": i}
+            risultati.append(esito)
+            if not isinstance(voce, dict):
+                esito.update(success=False, error="Prenotazione non valida.")
+                continue
+
+            rif = voce.get('rif')
+            if rif is not None:
+                esito["rif"] = rif
+            if isinstance(rif, str) and rif:
+                if len(rif) > 255:
+                    esito.update(success=False, error="Riferimento troppo lungo.")
+                    continue
+                originale = {campo: valore for campo, valore in voce.items() if campo != 'rif'}
+                impronta = impronta_richiesta(originale, b"")
+                nuova, esistente = riserva_chiave(archivio, '/api/prenota', rif, impronta)
+                if not nuova:
+                    if esistente is None or esistente["stato"] is None:
+                        # La POST originale è ancora in corso: il blocco va ripetuto più tardi
+                        for riservato in chiavi.values():
+                            _libera_rif(archivio, riservato)
+                        chiavi.clear()
+                        return rifiuta(503, "Prenotazione già in elaborazione, riprova tra poco.", 1)
+                    if esistente["impronta"] != impronta:
+                        esito.update(success=False, error="Riferimento già usato con dati diversi.")
+                        continue
+                    esito.update({"success": False, "ripetuta": True}, **json.loads(esistente["risposta"]))
+                    continue
+                chiavi[i] = rif
+
+            validazione = valida_prenotazione(voce)
+            if not validazione["valida"]:
+                concludi(i, {"error": validazione["errore"]})
+                continue
+            ospiti = voce['ospiti']
+            try:
+                posti_richiesti = 7 if ospiti == "7+" else int(ospiti)
+            except (TypeError, ValueError):
+                posti_richiesti = 0
+            if posti_richiesti <= 0:
+                concludi(i, {"error": "Numero ospiti non valido."})
+                continue
+            prenotazione = (
+                str(voce['nome']).strip(), str(voce['telefono']).strip(),
+                normalizza_data(voce['data']), normalizza_ora(voce['ora']),
+                posti_richiesti, voce['tavolo'], str(voce.get('note') or '').strip()
+            )
+            if voce['tavolo'] == TAVOLO_AUTOMATICO:
+                automatiche.append((i, prenotazione))
+            else:
+                valide.append(prenotazione)
+                posizioni.append(i)
+
+        adesso = datetime.now().isoformat()
+        for i, prenotazione, (prenotazione_id, posti_occupati) in zip(
+            posizioni, valide, inserisci_prenotazioni(valide)
+        ):
+            nome, telefono, data, ora, posti_richiesti, tavolo, note = prenotazione
+            if prenotazione_id is None:
+                concludi(i, {
+                    "error": "Non ci sono abbastanza posti disponibili su questo tavolo.",
+                    "info": {
+                        "posti_richiesti": posti_richiesti,
+                        "posti_disponibili": TAVOLI[tavolo] - posti_occupati,
+                        "posti_totali": TAVOLI[tavolo]
+                    }
+                })
+                continue
+            concludi(i, {
+                "success": True,
+                "prenotazione": {
+                    "id": str(prenotazione_id),
+                    "nome": nome,
+                    "telefono": telefono,
+                    "data": data,
+                    "ora": ora,
+                    "ospiti": posti_richiesti,
+                    "tavolo": tavolo,
+                    "note": note,
+                    "timestamp": adesso
+                },
+                "message": "Prenotazione effettuata con successo!"
+            })
+
+        # Le prenotazioni a tavolo fisso sono già salvate: da qui un errore
+        # riguarda solo la voce automatica che lo ha causato
+        for i, (nome, telefono, data, ora, posti_richiesti, _, note) in automatiche:
+            try:
+                risposta = app.make_response(prenota_tavolo_automatico(nome, telefono, data, ora, posti_richiesti, note))
+            except Exception as error:
+                print(f"[ERROR] Assegnazione automatica nel blocco fallita: {error}")
+                risultati[i].update(success=False, riprova=True, error="Errore interno del server, riprova.")
+                if i in chiavi:
+                    _libera_rif(archivio, chiavi.pop(i))
+                continue
+            concludi(i, risposta.get_json())
+
+        confermate = sum(1 for esito in risultati if esito["success"])
+        print(f"[OK] Blocco di prenotazioni: {confermate} confermate, {len(risultati) - confermate} rifiutate")
+        return jsonify({
+            "success": True,
+            "risultati": risultati,
+            "confermate": confermate,
+            "rifiutate": len(risultati) - confermate
+        })
+
+    except Exception as error:
+        print(f"[ERROR] Errore nel blocco di prenotazioni: {error}")
+        # Nessuna delle voci ancora riservate è stata salvata: i rif tornano liberi
+        for rif in chiavi.values():
+            _libera_rif(archivio, rif)
+        return jsonify({"error": "Errore interno del server."}), 500
 
 @app.route('/api/prenotazioni', methods=['GET'])
 def get_prenotazioni():
     try:
-        data = request.args.get('data')
-        ora = request.args.get('ora')
-        tavolo = request.args.get('tavolo')
         limit = min(int(request.args.get('limit', 100)), 500)  # max 500
+        cursore = request.args.get('cursor')
         
-        # Costruzione query dinamica
-        query = "SELECT * FROM prenotazioni WHERE 1=1"
-        params = []
+        try:
+            data, ora, tavolo = filtri_richiesta()
+        except ValueError:
+            return jsonify({"error": "Data o ora non valida."}), 400
         
-        if data:
-            query += " AND data = %s"
-            params.append(data)
-        if ora:
-            query += " AND ora = %s"
-            params.append(ora)
-        if tavolo:
-            query += " AND tavolo = %s"
-            params.append(tavolo)
+        # Paginazione keyset su (data, ora, id)
+        dopo = None
+        if cursore:
+            try:
+                dopo = decodifica_cursore(cursore, campo_data, campo_ora, campo_id)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
             
-        query += " ORDER BY data DESC, ora DESC LIMIT %s"
-        params.append(limit)
+        # Una riga in più per sapere se esiste la pagina successiva
+        colonne, prenotazioni = get_archivio().lista_prenotazioni(data, ora, tavolo, dopo, limit + 1)
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(query, params)
-        prenotazioni = cur.fetchall()
-        cur.close()
-        conn.close()
+        next_cursor = None
+        if len(prenotazioni) > limit:
+            prenotazioni = prenotazioni[:limit]
+            ultima = prenotazioni[-1]
+            indice = indici(colonne)
+            next_cursor = codifica_cursore([ultima[indice["data"]], ultima[indice["ora"]], ultima[indice["id"]]])
         
-        return jsonify({
+        return risposta_json({
             "success": True,
-            "data": prenotazioni,
-            "totale": len(prenotazioni)
+            "data": dizionari(colonne, prenotazioni),
+            "totale": len(prenotazioni),
+            "next_cursor": next_cursor
         })
         
     except Exception as error:
         print(f"Errore nel recupero prenotazioni: {error}")
         return jsonify({"error": "Errore interno del server."}), 500
 
+# ================================
+# API ENDPOINTS - ESPORTAZIONE
+# ================================
+EXPORT_BLOCCO = 2000  # righe lette dal cursore lato server per ogni round trip
+
+def _valore_export(valore):
+    return valore.isoformat() if isinstance(valore, datetime) else valore
+
+def stream_export(righe, formato):
+    """Genera CSV o NDJSON dalle righe dell'archivio (prima riga: colonne), a memoria costante"""
+    colonne = next(righe)
+    
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if formato == "csv" else None
+    if writer:
+        writer.writerow(colonne)
+    
+    n = 0
+    for riga in righe:
+        valori = [_valore_export(v) for v in riga]
+        if writer:
+            writer.writerow(valori)
+        else:
+            buffer.write(json.dumps(dict(zip(colonne, valori)), ensure_ascii=False))
+            buffer.write("\n")
+        n += 1
+        if n % EXPORT_BLOCCO == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def risposta_export(righe, formato, nome_file):
+    """Risposta HTTP in streaming per un export"""
+    mimetype = "text/csv" if formato == "csv" else "application/x-ndjson"
+    estensione = "csv" if formato == "csv" else "ndjson"
+    return Response(
+        stream_export(righe, formato),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={nome_file}.{estensione}"}
+    )
+
+@app.route('/api/export/prenotazioni', methods=['GET'])
+def export_prenotazioni():
+    """Esporta tutte le prenotazioni (filtri opzionali data/ora/tavolo)"""
+    formato = request.args.get('formato', 'csv')
+    if formato not in ("csv", "ndjson"):
+        return jsonify({"error": "Formato non valido (csv o ndjson)."}), 400
+    
+    try:
+        data, ora, tavolo = filtri_richiesta()
+    except ValueError:
+        return jsonify({"error": "Data o ora non valida."}), 400
+    return risposta_export(get_archivio().esporta_prenotazioni(data, ora, tavolo), formato, "prenotazioni")
+
+@app.route('/api/export/feedback', methods=['GET'])
+def export_feedback():
+    """Esporta tutti i feedback"""
+    formato = request.args.get('formato', 'csv')
+    if formato not in ("csv", "ndjson"):
+        return jsonify({"error": "Formato non valido (csv o ndjson)."}), 400
+    
+    return risposta_export(get_archivio().esporta_feedback(), formato, "feedback")
+
 # ================================
 # API ENDPOINTS - FEEDBACK
 # ================================
+# /api/feedback/search cerca nei messaggi con l'indice full-text (tsvector
+# italiano e GIN con PostgreSQL, FTS5 con SQLite), mai con una scansione ILIKE
+RICERCA_LUNGHEZZA_MAX = 200  # caratteri del testo da cercare
+
 @app.route('/api/feedback', methods=['POST'])
+@idempotente
 def post_feedback():
     try:
         dati = request.get_json()
@@ -463,27 +3025,18 @@ def post_feedback():
         if rating < 0 or rating > 5:
             return jsonify({"error": "Il rating deve essere tra 0 e 5."}), 400
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO feedbacks (nome, rating, message)
-            VALUES (%s, %s, %s)
-            RETURNING id
-            """,
-            (nome.strip(), rating, message)
-        )
-        feedback_id = cur.fetchone()["id"]
-        conn.commit()
-        cur.close()
-        conn.close()
+        adesso = datetime.now()
+        feedback_id = scrivi_differita("feedbacks", (nome.strip(), rating, message, adesso))
+        if feedback_id is None:
+            feedback_id = get_archivio().inserisci_feedback(nome.strip(), rating, message, adesso)
+            get_versioni().invalida("feedbacks")
         
         nuovo_feedback = {
             "id": str(feedback_id),
             "nome": nome.strip(),
             "rating": rating,
             "message": message,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": adesso.isoformat()
         }
         
         return jsonify({
@@ -498,41 +3051,104 @@ def post_feedback():
 
 @app.route('/api/feedback', methods=['GET'])
 def get_feedback():
-    conn = None
-    cur = None
     try:
         limit = min(int(request.args.get('limit', 10)), 50)  # max 50
+        cursore = request.args.get('cursor')
+        
+        # Paginazione keyset su (timestamp, id)
+        dopo = None
+        if cursore:
+            try:
+                dopo = decodifica_cursore(cursore, campo_istante, campo_id)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+        
+        # Versione letta prima della query: il contenuto è almeno così recente
+        etag = "f" + get_versioni().etag("feedbacks")
+        risposta = non_modificato(etag)
+        if risposta:
+            return risposta
         
         print(f"[DB] Recupero feedback (limit={limit})...")
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT * FROM feedbacks ORDER BY timestamp DESC LIMIT %s",
-            (limit,)
-        )
-        feedbacks = cur.fetchall()
+        colonne, feedbacks = get_archivio().lista_feedback(dopo, limit + 1)
         
-        return jsonify({
+        next_cursor = None
+        if len(feedbacks) > limit:
+            feedbacks = feedbacks[:limit]
+            ultimo = feedbacks[-1]
+            indice = indici(colonne)
+            next_cursor = codifica_cursore([ultimo[indice["timestamp"]].isoformat(), ultimo[indice["id"]]])
+        
+        return con_etag(risposta_json({
             "success": True,
-            "data": feedbacks,
-            "totale": len(feedbacks)
-        })
+            "data": dizionari(colonne, feedbacks),
+            "totale": len(feedbacks),
+            "next_cursor": next_cursor
+        }), etag)
         
     except Exception as error:
         print(f"Errore nel recupero feedback: {error}")
         import traceback
         print(f"[ERROR] Traceback: {traceback.format_exc()}")
         return jsonify({"error": f"Errore interno del server: {str(error)}"}), 500
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+
+@app.route('/api/feedback/search', methods=['GET'])
+def cerca_feedback():
+    """Ricerca full-text nei messaggi: ?q=parcheggio griglia&rating_min=&rating_max=&limit=&cursor="""
+    try:
+        testo = request.args.get('q', '').strip()
+        if not testo:
+            return jsonify({"error": "Il testo da cercare (q) è obbligatorio."}), 400
+        if len(testo) > RICERCA_LUNGHEZZA_MAX:
+            return jsonify({"error": f"Il testo da cercare può avere al massimo {RICERCA_LUNGHEZZA_MAX} caratteri."}), 400
+        try:
+            limit = min(int(request.args.get('limit', 20)), 50)  # max 50
+            rating_min = int(request.args.get('rating_min', 0))
+            rating_max = int(request.args.get('rating_max', 5))
+        except ValueError:
+            return jsonify({"error": "limit, rating_min e rating_max devono essere numeri interi."}), 400
+        if limit < 1 or not 0 <= rating_min <= rating_max <= 5:
+            return jsonify({"error": "Il rating deve essere tra 0 e 5 (rating_min <= rating_max)."}), 400
+
+        # Paginazione keyset su (rilevanza, id)
+        dopo = None
+        cursore = request.args.get('cursor')
+        if cursore:
+            try:
+                dopo = decodifica_cursore(cursore, campo_numero, campo_id)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+
+        etag = "c" + get_versioni().etag("feedbacks")
+        risposta = non_modificato(etag)
+        if risposta:
+            return risposta
+
+        colonne, trovati = get_archivio().cerca_feedback(testo, rating_min, rating_max, dopo, limit + 1)
+
+        next_cursor = None
+        if len(trovati) > limit:
+            trovati = trovati[:limit]
+            ultimo = trovati[-1]
+            indice = indici(colonne)
+            next_cursor = codifica_cursore([ultimo[indice["rilevanza"]], ultimo[indice["id"]]])
+
+        return con_etag(risposta_json({
+            "success": True,
+            "data": dizionari(colonne, trovati),
+            "totale": len(trovati),
+            "next_cursor": next_cursor
+        }), etag)
+
+    except Exception as error:
+        print(f"Errore nella ricerca dei feedback: {error}")
+        return jsonify({"error": "Errore interno del server."}), 500
 
 # ================================
 # API ENDPOINTS - PROMEMORIA
 # ================================
 @app.route('/api/reminder', methods=['POST'])
+@idempotente
 def post_reminder():
     try:
         dati = request.get_json()
@@ -541,25 +3157,16 @@ def post_reminder():
         if not contact:
             return jsonify({"error": "Il contatto è obbligatorio."}), 400
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO reminder_requests (contact)
-            VALUES (%s)
-            RETURNING id
-            """,
-            (contact,)
-        )
-        reminder_id = cur.fetchone()["id"]
-        conn.commit()
-        cur.close()
-        conn.close()
+        adesso = datetime.now()
+        reminder_id = scrivi_differita("reminder_requests", (contact, adesso))
+        if reminder_id is None:
+            reminder_id = get_archivio().inserisci_promemoria(contact, adesso)
+            get_versioni().invalida("reminder_requests")
         
         nuovo_promemoria = {
             "id": str(reminder_id),
             "contact": contact,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": adesso.isoformat()
         }
         
         return jsonify({
@@ -575,18 +3182,11 @@ def post_reminder():
 @app.route('/api/reminder', methods=['GET'])
 def get_reminder():
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT * FROM reminder_requests ORDER BY timestamp DESC LIMIT 20"
-        )
-        reminders = cur.fetchall()
-        cur.close()
-        conn.close()
+        colonne, reminders = get_archivio().lista_promemoria(20)
         
-        return jsonify({
+        return risposta_json({
             "success": True,
-            "data": reminders,
+            "data": dizionari(colonne, reminders),
             "totale": len(reminders)
         })
         
@@ -600,35 +3200,43 @@ def get_reminder():
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+        etag = "s" + get_versioni().etag("prenotazioni", "feedbacks", "reminder_requests")
+        risposta = non_modificato(etag)
+        if risposta:
+            return risposta
         
-        # Stats prenotazioni
-        cur.execute("SELECT COUNT(*) as totale, SUM(ospiti) as ospiti_totali FROM prenotazioni")
-        stats_prenotazioni = cur.fetchone()
+        # Letture dalle tabelle riassuntive: nessuna scansione delle tabelle sorgente
+        stats_slot, stats_rating, totale_promemoria = get_archivio().statistiche()
         
-        # Stats feedback
-        cur.execute("SELECT COUNT(*) as totale, AVG(rating) as rating_medio FROM feedbacks")
-        stats_feedback = cur.fetchone()
+        per_data = {}
+        for row in stats_slot:
+            giorno = per_data.setdefault(row["data"], {"prenotazioni": 0, "ospiti": 0})
+            giorno["prenotazioni"] += row["prenotazioni"]
+            giorno["ospiti"] += row["ospiti"]
         
-        # Stats reminder
-        cur.execute("SELECT COUNT(*) as totale FROM reminder_requests")
-        stats_reminder = cur.fetchone()
-        
-        cur.close()
-        conn.close()
+        istogramma = {str(r): 0 for r in range(6)}
+        for row in stats_rating:
+            istogramma[str(row["rating"])] = row["totale"]
+        totale_feedback = sum(istogramma.values())
+        somma_rating = sum(int(r) * n for r, n in istogramma.items())
         
         stats = {
             "prenotazioni": {
-                "totale": stats_prenotazioni["totale"] or 0,
-                "ospiti_totali": stats_prenotazioni["ospiti_totali"] or 0
+                "totale": sum(row["prenotazioni"] for row in stats_slot),
+                "ospiti_totali": sum(row["ospiti"] for row in stats_slot),
+                "per_data": per_data,
+                "per_slot": [
+                    {"data": row["data"], "ora": row["ora"], "prenotazioni": row["prenotazioni"], "ospiti": row["ospiti"]}
+                    for row in stats_slot
+                ]
             },
             "feedback": {
-                "totale": stats_feedback["totale"] or 0,
-                "rating_medio": f"{stats_feedback['rating_medio']:.1f}" if stats_feedback["rating_medio"] else "0"
+                "totale": totale_feedback,
+                "rating_medio": f"{somma_rating / totale_feedback:.1f}" if somma_rating else "0",
+                "rating_istogramma": istogramma
             },
             "promemoria": {
-                "totale": stats_reminder["totale"] or 0
+                "totale": totale_promemoria
             },
             "tavoli": {
                 "totale": len(TAVOLI),
@@ -637,10 +3245,10 @@ def get_stats():
             }
         }
         
-        return jsonify({
+        return con_etag(risposta_json({
             "success": True,
             "data": stats
-        })
+        }), etag)
         
     except Exception as error:
         print(f"Errore nel recupero statistiche: {error}")
@@ -656,6 +3264,11 @@ def not_found(error):
         "path": request.path
     }), 404
 
+@app.errorhandler(PoolTimeoutError)
+def pool_esaurito(error):
+    print(f"[WARNING] {error} ({request.method} {request.path})")
+    return rifiuta(503, "Server occupato, riprova tra poco.", 1)
+
 @app.errorhandler(500)
 def internal_error(error):
     print(f"Errore non gestito: {error}")
@@ -668,6 +3281,11 @@ def internal_error(error):
 # ================================
 def signal_handler(sig, frame):
     print(f"\n[SIGNAL] Ricevuto segnale {sig}, chiusura graceful...")
+    svuota_scritture_differite()
+    if _occupazione is not None and _occupazione.pid == os.getpid():
+        _occupazione.ferma()
+    if _archivio is not None and _archivio.pid == os.getpid():
+        _archivio.chiudi()
     print("[OK] Server chiuso correttamente")
     sys.exit(0)
 
@@ -679,12 +3297,19 @@ signal.signal(signal.SIGTERM, signal_handler)
 # ================================
 def start_server():
     try:
+        # In sviluppo lo schema viene aggiornato all'avvio del server
+        try:
+            init_database()
+        except Exception as e:
+            print(f"[STARTUP ERROR] Impossibile inizializzare il database: {e}")
+
         print(f"[SERVER] Backend Festa dello Sport avviato su http://localhost:{PORT}")
-        print(f"[DB] Database PostgreSQL: {DATABASE_URL[:30]}...")
+        print(f"[DB] Database {get_archivio().nome}: {DATABASE_URL[:30]}...")
         print(f"[CONFIG] Configurazione tavoli: {len(TAVOLI_CONFIG['standard'])} prenotabili, {len(TAVOLI_CONFIG['riservati'])} riservati")
         
         # Per produzione, usa Gunicorn invece di app.run()
-        # Comando: gunicorn -w 4 -b 0.0.0.0:3001 backend:app
+        # Comando: gunicorn -w 4 -k gthread --threads 100 -b 0.0.0.0:3001 backend:app
+        # (worker a thread: gli stream SSE inattivi non bloccano un worker ciascuno)
         # Per sviluppo locale, usa app.run()
         if os.environ.get('FLASK_ENV') == 'development':
             app.run(host='0.0.0.0', port=PORT, debug=False, threaded=True)
@@ -698,5 +3323,44 @@ def start_server():
         print(f"[ERROR] Errore nell'avvio del server: {error}")
         sys.exit(1)
 
+def migra_cli():
+    """Comando una tantum: python backend.py migra"""
+    try:
+        init_database()
+    except Exception:
+        sys.exit(1)
+
+def riconcilia_statistiche_cli():
+    """Comando una tantum: python backend.py riconcilia-statistiche"""
+    get_archivio().riconcilia_statistiche()
+    print("[OK] Statistiche riconciliate")
+
+def invia_promemoria_cli(argomenti):
+    """Comando da cron: python backend.py invia-promemoria [--prova] [--limite N]"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="backend.py invia-promemoria", description="Invia i promemoria in attesa")
+    parser.add_argument("--prova", action="store_true", help="stampa i messaggi invece di inviarli, senza segnarli come inviati")
+    parser.add_argument("--limite", type=int, help="righe da leggere al massimo")
+    args = parser.parse_args(argomenti)
+
+    nomi = ["stampa"] if args.prova else os.environ.get("PROMEMORIA_TRASPORTI", "smtp").split(",")
+    try:
+        conteggi = promemoria.invia_promemoria(
+            get_archivio(), promemoria.crea_trasporti(nomi), limite=args.limite, prova=args.prova
+        )
+    except Exception as error:
+        print(f"[ERROR] Invio promemoria interrotto: {error}")
+        sys.exit(1)
+    print("[OK] Promemoria: " + ", ".join(f"{chiave} {valore}" for chiave, valore in conteggi.items()))
+    if conteggi["falliti"]:
+        sys.exit(2)  # il cron riprova più tardi: le righe fallite restano da inviare
+
 if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "migra":
+        migra_cli()
+    elif len(sys.argv) > 1 and sys.argv[1] == "riconcilia-statistiche":
+        riconcilia_statistiche_cli()
+    elif len(sys.argv) > 1 and sys.argv[1] == "invia-promemoria":
+        invia_promemoria_cli(sys.argv[2:])
+    else:
+        start_server()
\ No newline at end of file
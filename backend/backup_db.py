@@ -1,67 +1,388 @@
 #!/usr/bin/env python3
 """
-Script per backup automatico del database SQLite
+Script per backup automatico del database
 Esegui questo script periodicamente (es. con cron job)
+
+PostgreSQL: ogni backup è una cartella con un file CSV compresso per tabella
+(COPY ... TO STDOUT, tabelle esportate in parallelo sullo stesso snapshot) e
+un manifest.json. Con --incrementale vengono esportate solo le righe nuove
+rispetto all'ultimo backup; il ripristino (COPY ... FROM STDIN) applica tutta
+la catena di backup in un'unica transazione.
+
+SQLite: copia del file con l'API di backup online.
+
+Uso:
+  python backup_db.py                      # backup completo
+  python backup_db.py --incrementale       # solo le righe dopo l'ultimo backup
+  python backup_db.py --ripristina festa_sport_backup_20250620_230000
 """
 
-import sqlite3
-import shutil
+import argparse
+import gzip
+import json
 import os
-from datetime import datetime
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "festa_sport.db")
+from archivio import SQLITE_PREDEFINITO, percorso_sqlite
+
+# Stesso database usato dal backend
+DATABASE_URL = os.environ.get("DATABASE_URL") or SQLITE_PREDEFINITO
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+DB_SSLMODE = os.environ.get("DB_SSLMODE", "require")
+DB_PATH = percorso_sqlite(DATABASE_URL) if DATABASE_URL.startswith("sqlite:") else None
 BACKUP_DIR = os.path.join(os.path.dirname(__file__), "backups")
+PREFISSO = "festa_sport_backup_"
+
+TABELLE = ("prenotazioni", "feedbacks", "reminder_requests")
+FORMATO = 1
+# Con la scrittura differita una riga può arrivare nel database dopo un backup
+# con un id più basso di quelli già salvati (gli id sono riservati a blocchi):
+# l'incrementale riprende anche le righe con timestamp fino a MARGINE prima del
+# backup precedente. Le righe già presenti vengono ignorate al ripristino.
+MARGINE = timedelta(minutes=int(os.environ.get("BACKUP_MARGINE_MINUTI", 10)))
+
+def formatta_byte(n):
+    for unita in ("B", "KB", "MB"):
+        if n < 1024:
+            return f"{n:.0f} {unita}" if unita == "B" else f"{n:.1f} {unita}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+def connetti():
+    import psycopg2
+    return psycopg2.connect(DATABASE_URL, sslmode=DB_SSLMODE)
+
+# ================================
+# BACKUP POSTGRESQL
+# ================================
+def leggi_manifest(percorso):
+    with open(os.path.join(percorso, "manifest.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+def ultimo_backup_postgres(backup_dir):
+    """Cartella dell'ultimo backup PostgreSQL completato, o None"""
+    cartelle = sorted(
+        f for f in os.listdir(backup_dir)
+        if f.startswith(PREFISSO) and os.path.isfile(os.path.join(backup_dir, f, "manifest.json"))
+    )
+    return os.path.join(backup_dir, cartelle[-1]) if cartelle else None
+
+def esporta_tabella(snapshot, tabella, colonne, condizione, parametri, destinazione):
+    """COPY di una tabella in un CSV gzip, sullo snapshot del backup"""
+    from psycopg2 import sql
+
+    inizio = time.perf_counter()
+    conn = connetti()
+    try:
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        with conn.cursor() as cur:
+            # Stessa fotografia del database per tutte le tabelle
+            cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+            cur.execute("SET DateStyle = 'ISO'")
+            select = sql.SQL("SELECT {} FROM {} WHERE {} ORDER BY id").format(
+                sql.SQL(", ").join(map(sql.Identifier, colonne)), sql.Identifier(tabella), sql.SQL(condizione)
+            )
+            query = cur.mogrify(select, parametri).decode()
+            # Il CSV passa dal server al file compresso a blocchi, senza restare in memoria
+            with gzip.open(destinazione, "wb", compresslevel=6) as f:
+                cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", f)
+            righe = cur.rowcount
+        conn.rollback()
+    finally:
+        conn.close()
+    return {
+        "file": os.path.basename(destinazione),
+        "colonne": list(colonne),
+        "righe": righe,
+        "byte": os.path.getsize(destinazione),
+        "durata_s": round(time.perf_counter() - inizio, 3)
+    }
+
+def esporta_tabelle(cartella, manifest_base):
+    """Esporta in parallelo tutte le tabelle: (istante, versione schema, voci del manifest)"""
+    from migrations import versione_schema
+
+    conn = connetti()
+    try:
+        # La transazione resta aperta finché le esportazioni non hanno importato lo snapshot
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_export_snapshot(), LOCALTIMESTAMP")
+            snapshot, istante = cur.fetchone()
+            lavori = {}
+            for tabella in TABELLE:
+                # Le colonne generate (feedbacks.ricerca) si ricalcolano al ripristino
+                cur.execute("""
+                    SELECT column_name FROM information_schema.columns
+                    WHERE table_schema = current_schema() AND table_name = %s AND is_generated = 'NEVER'
+                    ORDER BY ordinal_position
+                """, (tabella,))
+                colonne = [riga[0] for riga in cur.fetchall()]
+                cur.execute(f"SELECT COALESCE(MAX(id), 0) FROM {tabella}")
+                max_id = cur.fetchone()[0]
+                if manifest_base:
+                    dal = datetime.fromisoformat(manifest_base["istante"]) - MARGINE
+                    condizione = 'id > %s OR "timestamp" >= %s'
+                    parametri = (manifest_base["tabelle"][tabella]["max_id"], dal)
+                else:
+                    condizione, parametri = "TRUE", ()
+                lavori[tabella] = (colonne, condizione, parametri, max_id)
+            versione = versione_schema(conn)
+
+            with ThreadPoolExecutor(max_workers=len(TABELLE)) as esecutore:
+                futuri = {
+                    tabella: esecutore.submit(
+                        esporta_tabella, snapshot, tabella, colonne, condizione, parametri,
+                        os.path.join(cartella, f"{tabella}.csv.gz")
+                    )
+                    for tabella, (colonne, condizione, parametri, _) in lavori.items()
+                }
+                tabelle = {
+                    tabella: dict(futuro.result(), max_id=lavori[tabella][3])
+                    for tabella, futuro in futuri.items()
+                }
+        conn.rollback()
+    finally:
+        conn.close()
+    return istante, versione, tabelle
+
+def backup_postgres(backup_dir, incrementale=False):
+    """Backup completo o incrementale delle tabelle in una nuova cartella"""
+    inizio = time.perf_counter()
+    base = ultimo_backup_postgres(backup_dir) if incrementale else None
+    manifest_base = leggi_manifest(base) if base else None
+    if incrementale and base is None:
+        print("[INFO] Nessun backup precedente: eseguo un backup completo")
+
+    nome = PREFISSO + datetime.now().strftime("%Y%m%d_%H%M%S")
+    parziale = os.path.join(backup_dir, nome + ".parziale")
+    os.makedirs(parziale)
+    try:
+        istante, versione, tabelle = esporta_tabelle(parziale, manifest_base)
+    except Exception:
+        shutil.rmtree(parziale, ignore_errors=True)
+        raise
+
+    manifest = {
+        "formato": FORMATO,
+        "motore": "postgresql",
+        "tipo": "incrementale" if manifest_base else "completo",
+        "base": os.path.basename(base) if manifest_base else None,
+        "istante": istante.isoformat(),
+        "versione_schema": versione,
+        "durata_s": round(time.perf_counter() - inizio, 3),
+        "tabelle": tabelle
+    }
+    with open(os.path.join(parziale, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    percorso = os.path.join(backup_dir, nome)
+    os.rename(parziale, percorso)
+
+    totale = sum(voce["byte"] for voce in tabelle.values())
+    print(f"[OK] Backup {manifest['tipo']} creato: {percorso}")
+    for tabella, voce in tabelle.items():
+        print(f"     {tabella:<18} {voce['righe']:>8} righe  {formatta_byte(voce['byte']):>10}  {voce['durata_s']:.2f} s")
+    print(f"     totale {formatta_byte(totale)} in {manifest['durata_s']:.2f} s")
+    return percorso
+
+# ================================
+# RIPRISTINO POSTGRESQL
+# ================================
+def catena(percorso):
+    """Backup da applicare per ripristinare `percorso`, dal completo al più recente"""
+    backup = []
+    while percorso is not None:
+        manifest = leggi_manifest(percorso)
+        backup.append((percorso, manifest))
+        base = manifest["base"]
+        percorso = os.path.join(os.path.dirname(percorso), base) if base else None
+    return list(reversed(backup))
+
+def ripristina_postgres(percorso):
+    """Carica la catena di backup nelle tabelle con COPY FROM, in un'unica transazione"""
+    from psycopg2 import sql
+    from migrations import versione_schema
 
-def create_backup():
+    inizio = time.perf_counter()
+    backup = catena(percorso)
+    conn = connetti()
+    try:
+        versione = versione_schema(conn)
+        richiesta = max(manifest["versione_schema"] for _, manifest in backup)
+        if versione < richiesta:
+            print(f"[ERROR] Schema alla versione {versione}, il backup richiede {richiesta}: "
+                  "esegui prima 'python backend.py migra'")
+            return False
+
+        inserite = {tabella: 0 for tabella in TABELLE}
+        with conn.cursor() as cur:
+            cur.execute("SET DateStyle = 'ISO'")
+            for cartella, manifest in backup:
+                for tabella, voce in manifest["tabelle"].items():
+                    colonne = sql.SQL(", ").join(map(sql.Identifier, voce["colonne"]))
+                    # Tabella d'appoggio: le righe già presenti (stesso id) vengono ignorate
+                    cur.execute(sql.SQL(
+                        "CREATE TEMP TABLE ripristino (LIKE {}) ON COMMIT DROP"
+                    ).format(sql.Identifier(tabella)))
+                    with gzip.open(os.path.join(cartella, voce["file"]), "rb") as f:
+                        cur.copy_expert(
+                            sql.SQL("COPY ripristino ({}) FROM STDIN WITH (FORMAT csv, HEADER true)")
+                            .format(colonne).as_string(conn),
+                            f
+                        )
+                    # I trigger aggiornano le statistiche riga per riga
+                    cur.execute(sql.SQL(
+                        "INSERT INTO {tabella} ({colonne}) SELECT {colonne} FROM ripristino "
+                        "ORDER BY id ON CONFLICT (id) DO NOTHING"
+                    ).format(tabella=sql.Identifier(tabella), colonne=colonne))
+                    inserite[tabella] += cur.rowcount
+                    cur.execute("DROP TABLE ripristino")
+                print(f"[INFO] Applicato {os.path.basename(cartella)} ({manifest['tipo']})")
+
+            # Le sequenze ripartono dopo l'id più alto ripristinato
+            for tabella in TABELLE:
+                # nextval: la sequenza non torna mai indietro (id già riservati dai worker)
+                cur.execute(
+                    "SELECT setval(pg_get_serial_sequence(%(t)s, 'id'), "
+                    f"GREATEST(MAX(id), nextval(pg_get_serial_sequence(%(t)s, 'id')))) FROM {tabella}",
+                    {"t": tabella}
+                )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    print(f"[OK] Ripristino completato in {time.perf_counter() - inizio:.2f} s")
+    for tabella, n in inserite.items():
+        print(f"     {tabella:<18} {n:>8} righe inserite")
+    print("[INFO] I worker attivi ricaricano l'occupazione dei tavoli al prossimo controllo di versione")
+    return True
+
+# ================================
+# SQLITE
+# ================================
+def backup_sqlite(backup_dir):
+    """Backup online del file: copia coerente anche con il server attivo (file WAL)"""
+    if not os.path.exists(DB_PATH):
+        print(f"[ERROR] Database non trovato: {DB_PATH}")
+        return None
+
+    inizio = time.perf_counter()
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    backup_path = os.path.join(backup_dir, f"{PREFISSO}{timestamp}.db")
+    sorgente = sqlite3.connect(DB_PATH)
+    destinazione = sqlite3.connect(backup_path)
+    try:
+        sorgente.backup(destinazione)
+    finally:
+        destinazione.close()
+        sorgente.close()
+
+    print(f"[OK] Backup creato: {backup_path}")
+    print(f"     {formatta_byte(os.path.getsize(backup_path))} in {time.perf_counter() - inizio:.2f} s")
+    return backup_path
+
+def ripristina_sqlite(percorso):
+    """Sostituisce il contenuto del database con quello del backup"""
+    sorgente = sqlite3.connect(percorso)
+    destinazione = sqlite3.connect(DB_PATH)
+    try:
+        sorgente.backup(destinazione)
+    finally:
+        destinazione.close()
+        sorgente.close()
+    print(f"[OK] Database {DB_PATH} ripristinato da {percorso}")
+    return True
+
+# ================================
+# COMANDI
+# ================================
+def create_backup(incrementale=False, keep_last=30):
     """Crea un backup del database"""
     try:
         # Crea la cartella backups se non esiste
         os.makedirs(BACKUP_DIR, exist_ok=True)
-        
-        # Genera nome file backup con timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_filename = f"festa_sport_backup_{timestamp}.db"
-        backup_path = os.path.join(BACKUP_DIR, backup_filename)
-        
-        # Verifica che il database esista
-        if not os.path.exists(DB_PATH):
-            print(f"[ERROR] Database non trovato: {DB_PATH}")
+
+        if DB_PATH is not None:
+            if incrementale:
+                print("[INFO] SQLite: il backup è sempre completo")
+            percorso = backup_sqlite(BACKUP_DIR)
+        else:
+            percorso = backup_postgres(BACKUP_DIR, incrementale)
+        if percorso is None:
             return False
-        
-        # Copia il database
-        shutil.copy2(DB_PATH, backup_path)
-        
-        print(f"[OK] Backup creato: {backup_path}")
-        
-        # Mantieni solo gli ultimi 30 backup (opzionale)
-        cleanup_old_backups(BACKUP_DIR, keep_last=30)
-        
+
+        # Mantieni solo gli ultimi N backup (e i completi da cui dipendono)
+        cleanup_old_backups(BACKUP_DIR, keep_last=keep_last)
+
         return True
-        
+
     except Exception as error:
         print(f"[ERROR] Errore durante il backup: {error}")
         return False
 
+def restore_backup(nome):
+    """Ripristina un backup (nome nella cartella backups o percorso)"""
+    percorso = nome if os.path.exists(nome) else os.path.join(BACKUP_DIR, nome)
+    if not os.path.exists(percorso):
+        print(f"[ERROR] Backup non trovato: {nome}")
+        return False
+    try:
+        if DB_PATH is not None:
+            return ripristina_sqlite(percorso)
+        return ripristina_postgres(percorso.rstrip(os.sep))
+    except Exception as error:
+        print(f"[ERROR] Errore durante il ripristino: {error}")
+        return False
+
 def cleanup_old_backups(backup_dir, keep_last=30):
     """Rimuove i backup più vecchi, mantenendo solo gli ultimi N"""
     try:
         backup_files = [
-            os.path.join(backup_dir, f) 
-            for f in os.listdir(backup_dir) 
-            if f.startswith("festa_sport_backup_") and f.endswith(".db")
+            os.path.join(backup_dir, f)
+            for f in os.listdir(backup_dir)
+            if f.startswith(PREFISSO) and (f.endswith(".db") or os.path.isdir(os.path.join(backup_dir, f)))
         ]
-        
+
         # Ordina per data di modifica (più recenti prima)
         backup_files.sort(key=lambda x: os.path.getmtime(x), reverse=True)
-        
+
+        # Un incrementale da conservare tiene in vita la sua catena
+        necessari = set()
+        for backup in backup_files[:keep_last]:
+            if os.path.isfile(os.path.join(backup, "manifest.json")):
+                necessari.update(percorso for percorso, _ in catena(backup))
+
         # Rimuovi i backup più vecchi
         if len(backup_files) > keep_last:
             for old_backup in backup_files[keep_last:]:
-                os.remove(old_backup)
+                if old_backup in necessari:
+                    continue
+                if os.path.isdir(old_backup):
+                    shutil.rmtree(old_backup)
+                else:
+                    os.remove(old_backup)
                 print(f"[INFO] Rimosso backup vecchio: {os.path.basename(old_backup)}")
-                
+
     except Exception as error:
         print(f"[WARNING] Errore durante la pulizia backup: {error}")
 
 if __name__ == "__main__":
-    create_backup()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Backup e ripristino del database della festa")
+    parser.add_argument("--incrementale", action="store_true", help="solo le righe nuove dall'ultimo backup")
+    parser.add_argument("--ripristina", metavar="BACKUP", help="nome o percorso del backup da ripristinare")
+    parser.add_argument("--mantieni", type=int, default=30, help="backup da conservare (default 30)")
+    args = parser.parse_args()
+
+    if args.ripristina:
+        ok = restore_backup(args.ripristina)
+    else:
+        ok = create_backup(args.incrementale, args.mantieni)
+    raise SystemExit(0 if ok else 1)
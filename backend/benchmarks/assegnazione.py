@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark dell'assegnazione automatica dei tavoli
+Misura assegnazione.assegna su occupazioni casuali dei 37 tavoli standard e
+gruppi da 1 a OSPITI_MAX_GRUPPO persone (l'obiettivo è restare sotto il
+millisecondo: viene chiamata con i lock dei tavoli presi). Poi simula una
+serata di arrivi e confronta i posti occupati con l'assegnazione automatica e
+con la scelta "primo tavolo con abbastanza posti" fatta dagli utenti.
+
+Uso: python benchmarks/assegnazione.py [--ripetizioni 20000] [--seme 1]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import backend  # noqa: E402  (l'import non apre connessioni)
+from assegnazione import assegna  # noqa: E402
+
+FILE = backend.TAVOLI_CONFIG["file"]
+STANDARD = backend.TAVOLI_CONFIG["standard"]
+SOGLIA_US = 1000
+
+def occupazione_casuale(rng):
+    """Posti liberi con un riempimento medio tra il 30% e il 95%"""
+    riempimento = rng.uniform(0.3, 0.95)
+    return {t: backend.TAVOLI[t] - min(backend.TAVOLI[t], int(rng.expovariate(1 / (10 * riempimento))))
+            for t in STANDARD}
+
+def percentile(valori, p):
+    valori = sorted(valori)
+    return valori[min(len(valori) - 1, int(len(valori) * p))]
+
+def bench_tempi(ripetizioni, rng):
+    casi = [(occupazione_casuale(rng), rng.randint(1, backend.OSPITI_MAX_GRUPPO)) for _ in range(ripetizioni)]
+    tempi = []
+    trovate = 0
+    for liberi, ospiti in casi:
+        inizio = time.perf_counter()
+        risultato = assegna(liberi, FILE, ospiti)
+        tempi.append((time.perf_counter() - inizio) * 1e6)
+        trovate += risultato is not None
+    p99 = percentile(tempi, 0.99)
+    print(f"\n[BENCH] assegna() su {ripetizioni} casi ({trovate} con posto)")
+    print(f"  mediana {statistics.median(tempi):.1f} µs  p99 {p99:.1f} µs  max {max(tempi):.1f} µs")
+    return p99
+
+def primo_tavolo(liberi, ospiti):
+    """Quello che fa un utente: il primo tavolo della mappa con abbastanza posti"""
+    for tavolo, posti in liberi.items():
+        if posti >= ospiti:
+            return [(tavolo, ospiti)]
+    return None
+
+def simula_serata(strategia, gruppi):
+    liberi = {t: backend.TAVOLI[t] for t in STANDARD}
+    seduti = rifiutati = 0
+    for ospiti in gruppi:
+        assegnazione = strategia(liberi, ospiti)
+        if assegnazione is None:
+            rifiutati += 1
+            continue
+        for tavolo, persone in assegnazione:
+            liberi[tavolo] -= persone
+        seduti += ospiti
+    return seduti, rifiutati
+
+def bench_serata(rng):
+    # Gruppi tipici di una sagra: molte coppie e famiglie, qualche comitiva
+    gruppi = [rng.choice([2, 2, 3, 4, 4, 5, 6, 7, 8, 12, 15, 20]) for _ in range(60)]
+    posti = sum(backend.TAVOLI[t] for t in STANDARD)
+    print(f"\n[BENCH] serata simulata: {len(gruppi)} gruppi, {sum(gruppi)} persone, {posti} posti")
+    for nome, strategia in (
+        ("primo tavolo libero", primo_tavolo),
+        ("assegnazione automatica", lambda liberi, ospiti: assegna(liberi, FILE, ospiti)),
+    ):
+        seduti, rifiutati = simula_serata(strategia, gruppi)
+        print(f"  {nome:<26} {seduti:>5} seduti ({seduti / posti:.0%} dei posti), {rifiutati} gruppi rifiutati")
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark dell'assegnazione automatica dei tavoli")
+    parser.add_argument("--ripetizioni", type=int, default=20000)
+    parser.add_argument("--seme", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seme)
+    p99 = bench_tempi(args.ripetizioni, rng)
+    bench_serata(rng)
+    if p99 >= SOGLIA_US:
+        print(f"[ERROR] p99 {p99:.0f} µs oltre la soglia di {SOGLIA_US} µs")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Test di carico dell'API prenotazioni
+Riproduce il traffico della sera della festa: molte letture di /api/tavoli,
+raffiche di /api/prenota sui tavoli più richiesti e picchi di feedback.
+Riporta throughput, latenze p50/p95/p99, errori e overbooking per endpoint.
+
+Di default avvia gunicorn sul DATABASE_URL indicato (usare un database locale
+o di prova), usa date dedicate (2099-...) e a fine prova cancella i dati creati.
+Il limite di richieste per IP è disattivato (LIMITE_RICHIESTE=0), il controllo
+di ammissione sugli endpoint costosi resta attivo. Con --url il server va
+avviato con LIMITE_RICHIESTE=0.
+
+Uso:
+  DATABASE_URL=... python benchmarks/carico.py --workers 4 --utenti 50 --durata 30
+  DATABASE_URL=... python benchmarks/carico.py --url http://127.0.0.1:3001 --json prima.json
+  DATABASE_URL=... python benchmarks/carico.py --baseline prima.json   # esce con 1 se peggiora
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+import psycopg2
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from backend import TAVOLI  # noqa: E402  (l'import non apre connessioni)
+
+DATE_PROVA = ["2099-06-20", "2099-06-21"]
+ORARI_PROVA = ["19:00", "19:30", "20:00", "20:30"]
+NOME_PROVA = "Bench Carico"
+MESSAGGIO_PROVA = "[bench-carico]"
+
+TAVOLI_PRENOTABILI = sorted((t for t, posti in TAVOLI.items() if posti > 0), key=int)
+TAVOLI_CALDI = TAVOLI_PRENOTABILI[:4]  # i tavoli vicino al palco, presi d'assalto
+
+# Peso delle operazioni fuori e dentro un picco di feedback
+MIX_NORMALE = {"tavoli": 70, "griglia": 5, "prenota": 20, "feedback": 5}
+MIX_PICCO = {"tavoli": 40, "griglia": 0, "prenota": 10, "feedback": 50}
+PICCO_OGNI = 10.0     # secondi tra l'inizio di due picchi
+PICCO_DURATA = 2.0    # secondi di picco
+
+# ================================
+# SERVER E DATI DI PROVA
+# ================================
+def porta_libera():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def avvia_server(workers, threads):
+    """Avvia gunicorn su una porta libera e attende che risponda"""
+    porta = porta_libera()
+    env = dict(os.environ, LOG_RICHIESTE="0")
+    # Gli utenti simulati escono tutti da 127.0.0.1: il limite per IP li bloccherebbe
+    env.setdefault("LIMITE_RICHIESTE", "0")
+    processo = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-w", str(workers), "-k", "gthread",
+         "--threads", str(threads), "-b", f"127.0.0.1:{porta}", "backend:app"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    url = f"http://127.0.0.1:{porta}"
+    scadenza = time.monotonic() + 30
+    while time.monotonic() < scadenza:
+        try:
+            stato, _ = richiesta(http.client.HTTPConnection("127.0.0.1", porta, timeout=2), "GET", "/api/health")
+            if stato == 200:
+                return processo, url
+        except OSError:
+            pass
+        time.sleep(0.2)
+    processo.kill()
+    raise RuntimeError("gunicorn non risponde")
+
+def ferma_server(processo):
+    processo.send_signal(signal.SIGTERM)
+    try:
+        processo.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        processo.kill()
+
+def pulisci(conn):
+    """Cancella prenotazioni e feedback creati dal test (i trigger aggiornano le statistiche)"""
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM prenotazioni WHERE data = ANY(%s::date[])", (DATE_PROVA,))
+        prenotazioni = cur.rowcount
+        cur.execute("DELETE FROM feedbacks WHERE message = %s", (MESSAGGIO_PROVA,))
+        feedback = cur.rowcount
+    conn.commit()
+    return prenotazioni, feedback
+
+def semina(conn, quante, rng):
+    """Inserisce `quante` prenotazioni di partenza sui tavoli non caldi, senza superare i posti"""
+    occupati = {}
+    righe = []
+    tavoli = [t for t in TAVOLI_PRENOTABILI if t not in TAVOLI_CALDI]
+    tentativi = 0
+    while len(righe) < quante and tentativi < quante * 10:
+        tentativi += 1
+        chiave = (rng.choice(DATE_PROVA), rng.choice(ORARI_PROVA), rng.choice(tavoli))
+        ospiti = rng.randint(1, 4)
+        if occupati.get(chiave, 0) + ospiti > TAVOLI[chiave[2]]:
+            continue
+        occupati[chiave] = occupati.get(chiave, 0) + ospiti
+        righe.append((NOME_PROVA, "3330000000", chiave[0], chiave[1], ospiti, chiave[2], ""))
+    with conn.cursor() as cur:
+        cur.executemany(
+            """
+            INSERT INTO prenotazioni (nome, telefono, data, ora, ospiti, tavolo, note)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """,
+            righe
+        )
+    conn.commit()
+    return len(righe)
+
+def overbooking(conn):
+    """Slot e tavoli di prova con più ospiti dei posti disponibili"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT data::text, to_char(ora, 'HH24:MI'), tavolo, SUM(ospiti)
+            FROM prenotazioni WHERE data = ANY(%s::date[])
+            GROUP BY data, ora, tavolo
+            """,
+            (DATE_PROVA,)
+        )
+        return [
+            {"data": data, "ora": ora, "tavolo": tavolo, "ospiti": int(ospiti), "posti": TAVOLI.get(tavolo, 0)}
+            for data, ora, tavolo, ospiti in cur.fetchall()
+            if ospiti > TAVOLI.get(tavolo, 0)
+        ]
+
+def prenotazioni_salvate(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT COUNT(*) FROM prenotazioni WHERE data = ANY(%s::date[]) AND nome = %s",
+            (DATE_PROVA, NOME_PROVA + " live")
+        )
+        return cur.fetchone()[0]
+
+# ================================
+# CLIENT
+# ================================
+def richiesta(conn, metodo, percorso, corpo=None):
+    """Una richiesta HTTP sulla connessione keep-alive; restituisce (stato, json)"""
+    headers = {}
+    dati = None
+    if corpo is not None:
+        dati = json.dumps(corpo)
+        headers["Content-Type"] = "application/json"
+    conn.request(metodo, percorso, body=dati, headers=headers)
+    risposta = conn.getresponse()
+    contenuto = risposta.read()
+    try:
+        return risposta.status, json.loads(contenuto) if contenuto else None
+    except ValueError:
+        return risposta.status, None
+
+def scegli(rng, pesi):
+    return rng.choices(list(pesi), weights=list(pesi.values()))[0]
+
+def operazione(rng, tipo):
+    """(metodo, percorso, corpo) di un'operazione del mix"""
+    data, ora = rng.choice(DATE_PROVA), rng.choice(ORARI_PROVA)
+    if tipo == "tavoli":
+        return "GET", "/api/tavoli?" + urlencode({"data": data, "ora": ora}), None
+    if tipo == "griglia":
+        return "GET", "/api/tavoli/griglia?" + urlencode({"data": data}), None
+    if tipo == "prenota":
+        tavolo = rng.choice(TAVOLI_CALDI) if rng.random() < 0.7 else rng.choice(TAVOLI_PRENOTABILI)
+        return "POST", "/api/prenota", {
+            "nome": NOME_PROVA + " live", "telefono": "3331112222", "data": data, "ora": ora,
+            "ospiti": rng.randint(1, 4), "tavolo": tavolo, "note": ""
+        }
+    return "POST", "/api/feedback", {"nome": "Bench", "rating": rng.randint(1, 5), "message": MESSAGGIO_PROVA}
+
+class Risultati:
+    """Latenze ed esiti per tipo di operazione, raccolti dai thread client"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latenze = {}
+        self.esiti = {}
+
+    def aggiungi(self, tipo, latenza, esito):
+        with self._lock:
+            self.latenze.setdefault(tipo, []).append(latenza)
+            esiti = self.esiti.setdefault(tipo, {})
+            esiti[esito] = esiti.get(esito, 0) + 1
+
+def esito_di(tipo, stato, corpo):
+    if stato >= 500:
+        return "errore"
+    if tipo == "prenota" and stato == 400 and corpo and "info" in corpo:
+        return "posti_esauriti"
+    return "ok" if stato < 400 else f"http_{stato}"
+
+def client(url, indice, seme, fine, inizio, risultati):
+    rng = random.Random(seme * 1000 + indice)
+    parti = urlsplit(url)
+    conn = http.client.HTTPConnection(parti.hostname, parti.port, timeout=30)
+    while True:
+        adesso = time.monotonic()
+        if adesso >= fine:
+            break
+        in_picco = (adesso - inizio) % PICCO_OGNI < PICCO_DURATA
+        tipo = scegli(rng, MIX_PICCO if in_picco else MIX_NORMALE)
+        metodo, percorso, corpo = operazione(rng, tipo)
+        partenza = time.perf_counter()
+        try:
+            stato, dati = richiesta(conn, metodo, percorso, corpo)
+            esito = esito_di(tipo, stato, dati)
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = http.client.HTTPConnection(parti.hostname, parti.port, timeout=30)
+            esito = "errore"
+        risultati.aggiungi(tipo, time.perf_counter() - partenza, esito)
+    conn.close()
+
+# ================================
+# REPORT
+# ================================
+def percentile(ordinati, p):
+    if not ordinati:
+        return 0.0
+    return ordinati[min(len(ordinati) - 1, int(len(ordinati) * p))]
+
+def riepiloga(risultati, durata):
+    report = {}
+    for tipo, latenze in sorted(risultati.latenze.items()):
+        latenze = sorted(latenze)
+        esiti = risultati.esiti[tipo]
+        report[tipo] = {
+            "richieste": len(latenze),
+            "rps": round(len(latenze) / durata, 1),
+            "p50_ms": round(percentile(latenze, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latenze, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latenze, 0.99) * 1000, 2),
+            "errori": esiti.get("errore", 0),
+            "esiti": esiti
+        }
+    return report
+
+def stampa(report, extra):
+    print(f"\n[BENCH] {extra['durata']} s, {extra['utenti']} utenti, "
+          f"{extra['seme_prenotazioni']} prenotazioni di partenza")
+    print(f"  {'endpoint':<10} {'richieste':>9} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errori':>7}")
+    for tipo, r in report.items():
+        print(f"  {tipo:<10} {r['richieste']:>9} {r['rps']:>8} {r['p50_ms']:>8} "
+              f"{r['p95_ms']:>8} {r['p99_ms']:>8} {r['errori']:>7}")
+    prenota = report.get("prenota", {}).get("esiti", {})
+    print(f"  prenota: {prenota.get('ok', 0)} confermate, {prenota.get('posti_esauriti', 0)} rifiutate per posti esauriti")
+    print(f"  prenotazioni confermate ma non salvate: {extra['prenotazioni_perse']}")
+    print(f"  overbooking: {len(extra['overbooking'])} tavoli")
+    for voce in extra["overbooking"]:
+        print(f"    [OVERBOOKING] {voce['data']} {voce['ora']} tavolo {voce['tavolo']}: {voce['ospiti']}/{voce['posti']}")
+
+def confronta(report, baseline, tolleranza):
+    """Stampa le differenze di p95 con una prova precedente; True se c'è una regressione"""
+    regressione = False
+    print(f"\n[BENCH] Confronto con la baseline (tolleranza p95 +{tolleranza:.0%})")
+    for tipo, r in report.items():
+        prima = baseline["endpoint"].get(tipo)
+        if not prima or not prima["p95_ms"]:
+            continue
+        variazione = r["p95_ms"] / prima["p95_ms"] - 1
+        peggiora = variazione > tolleranza
+        regressione = regressione or peggiora
+        print(f"  {tipo:<10} p95 {prima['p95_ms']:>8} -> {r['p95_ms']:>8} ms ({variazione:+.0%})"
+              + ("  [REGRESSIONE]" if peggiora else ""))
+    return regressione
+
+def main():
+    parser = argparse.ArgumentParser(description="Test di carico dell'API prenotazioni")
+    parser.add_argument("--url", help="Backend già avviato (altrimenti avvia gunicorn)")
+    parser.add_argument("--workers", type=int, default=2, help="Worker gunicorn")
+    parser.add_argument("--threads", type=int, default=8, help="Thread per worker gunicorn")
+    parser.add_argument("--utenti", type=int, default=32, help="Client concorrenti")
+    parser.add_argument("--durata", type=float, default=20, help="Secondi di carico")
+    parser.add_argument("--prenotazioni", type=int, default=200, help="Prenotazioni inserite prima della prova")
+    parser.add_argument("--seme", type=int, default=42, help="Seme casuale (prove ripetibili)")
+    parser.add_argument("--json", help="Salva il report in un file JSON")
+    parser.add_argument("--baseline", help="Report JSON precedente da confrontare")
+    parser.add_argument("--tolleranza", type=float, default=0.2, help="Aumento massimo del p95 rispetto alla baseline")
+    parser.add_argument("--mantieni", action="store_true", help="Non cancellare i dati di prova")
+    args = parser.parse_args()
+
+    if not os.environ.get("DATABASE_URL"):
+        print("[ERROR] DATABASE_URL non impostata")
+        sys.exit(1)
+
+    db = psycopg2.connect(os.environ["DATABASE_URL"], sslmode=os.environ.get("DB_SSLMODE", "require"))
+    pulisci(db)
+    seminate = semina(db, args.prenotazioni, random.Random(args.seme))
+
+    processo = None
+    url = args.url
+    if not url:
+        processo, url = avvia_server(args.workers, args.threads)
+        print(f"[BENCH] gunicorn avviato su {url} ({args.workers} worker x {args.threads} thread)")
+
+    try:
+        risultati = Risultati()
+        inizio = time.monotonic()
+        fine = inizio + args.durata
+        clienti = [
+            threading.Thread(target=client, args=(url, i, args.seme, fine, inizio, risultati))
+            for i in range(args.utenti)
+        ]
+        for thread in clienti:
+            thread.start()
+        for thread in clienti:
+            thread.join()
+        durata = time.monotonic() - inizio
+    finally:
+        if processo:
+            ferma_server(processo)  # svuota anche le eventuali scritture differite
+
+    report = riepiloga(risultati, durata)
+    confermate = report.get("prenota", {}).get("esiti", {}).get("ok", 0)
+    extra = {
+        "durata": round(durata, 1),
+        "utenti": args.utenti,
+        "workers": None if args.url else args.workers,
+        "seme_prenotazioni": seminate,
+        "overbooking": overbooking(db),
+        "prenotazioni_perse": confermate - prenotazioni_salvate(db)
+    }
+    stampa(report, extra)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"endpoint": report, **extra}, f, indent=2)
+        print(f"\n[BENCH] Report salvato in {args.json}")
+
+    regressione = bool(extra["overbooking"]) or extra["prenotazioni_perse"] != 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressione = confronta(report, json.load(f), args.tolleranza) or regressione
+
+    if not args.mantieni:
+        prenotazioni, feedback = pulisci(db)
+        print(f"[BENCH] Dati di prova cancellati: {prenotazioni} prenotazioni, {feedback} feedback")
+    db.close()
+    sys.exit(1 if regressione else 0)
+
+if __name__ == "__main__":
+    main()
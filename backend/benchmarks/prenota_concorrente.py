@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Test di concorrenza delle prenotazioni: nessun overbooking
+Spara alcune centinaia di POST /api/prenota contemporanee sullo stesso
+data/ora/tavolo contro un PostgreSQL vero (gunicorn con più worker, quindi
+più processi e più connessioni) e verifica sul database che:
+- la somma degli ospiti non superi mai i posti del tavolo;
+- le prenotazioni confermate dall'API siano esattamente le righe salvate
+  (stessi id, stessi ospiti).
+Ripete la raffica su più tavoli; esce con 1 alla prima violazione.
+
+Usa una data dedicata (2099-...) e a fine prova cancella le righe create.
+Con --url il server va avviato con LIMITE_RICHIESTE=0.
+
+Uso:
+  DATABASE_URL=... python benchmarks/prenota_concorrente.py --richieste 400 --workers 4
+"""
+
+import argparse
+import http.client
+import os
+import random
+import sys
+import threading
+from urllib.parse import urlsplit
+
+import psycopg2
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.append(BENCH_DIR)  # in coda: benchmarks/serializzazione.py non deve coprire quello del backend
+
+from backend import TAVOLI  # noqa: E402  (l'import non apre connessioni)
+from carico import avvia_server, ferma_server, richiesta  # noqa: E402
+
+DATA_PROVA = "2099-07-01"
+ORA_PROVA = "20:00"
+NOME_PROVA = "Test Concorrenza"
+
+TAVOLI_PRENOTABILI = sorted((t for t, posti in TAVOLI.items() if posti > 0), key=int)
+
+def pulisci(conn):
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM prenotazioni WHERE data = %s AND nome = %s", (DATA_PROVA, NOME_PROVA))
+        cur.execute("DELETE FROM trattenute WHERE data = %s", (DATA_PROVA,))
+    conn.commit()
+
+def raffica(url, tavolo, richieste, rng):
+    """Tutte le richieste partono insieme (barriera); restituisce (confermate {id: ospiti}, rifiutate, errori)"""
+    parti = urlsplit(url)
+    ospiti = [rng.randint(1, 4) for _ in range(richieste)]
+    # Connessioni aperte prima della barriera: la raffica non aspetta il TCP
+    connessioni = [http.client.HTTPConnection(parti.hostname, parti.port, timeout=60) for _ in range(richieste)]
+    for conn in connessioni:
+        conn.connect()
+    barriera = threading.Barrier(richieste)
+    lock = threading.Lock()
+    confermate, esiti = {}, {"rifiutate": 0, "errori": 0}
+
+    def invia(i):
+        barriera.wait()
+        try:
+            stato, corpo = richiesta(connessioni[i], "POST", "/api/prenota", {
+                "nome": NOME_PROVA, "telefono": "3330000000", "data": DATA_PROVA, "ora": ORA_PROVA,
+                "ospiti": ospiti[i], "tavolo": tavolo, "note": f"richiesta {i}"
+            })
+        except (OSError, http.client.HTTPException):
+            stato, corpo = None, None
+        finally:
+            connessioni[i].close()
+        with lock:
+            if stato == 200 and corpo and corpo.get("success"):
+                confermate[int(corpo["prenotazione"]["id"])] = ospiti[i]
+            elif stato == 400 and corpo and "info" in corpo:
+                esiti["rifiutate"] += 1
+            else:
+                esiti["errori"] += 1
+
+    thread = [threading.Thread(target=invia, args=(i,)) for i in range(richieste)]
+    for t in thread:
+        t.start()
+    for t in thread:
+        t.join()
+    return confermate, esiti["rifiutate"], esiti["errori"]
+
+def salvate(conn, tavolo):
+    """{id: ospiti} delle righe di prova sul tavolo"""
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT id, ospiti FROM prenotazioni WHERE data = %s AND ora = %s AND tavolo = %s AND nome = %s",
+            (DATA_PROVA, ORA_PROVA, tavolo, NOME_PROVA)
+        )
+        return dict(cur.fetchall())
+
+def main():
+    parser = argparse.ArgumentParser(description="Test di concorrenza delle prenotazioni (nessun overbooking)")
+    parser.add_argument("--url", help="Backend già avviato (altrimenti avvia gunicorn)")
+    parser.add_argument("--workers", type=int, default=4, help="Worker gunicorn")
+    parser.add_argument("--threads", type=int, default=16, help="Thread per worker gunicorn")
+    parser.add_argument("--richieste", type=int, default=300, help="POST contemporanee per tavolo")
+    parser.add_argument("--tavoli", type=int, default=3, help="Tavoli provati, uno dopo l'altro")
+    parser.add_argument("--seme", type=int, default=7)
+    args = parser.parse_args()
+
+    if not os.environ.get("DATABASE_URL", "").startswith("postgres"):
+        print("[ERROR] DATABASE_URL deve puntare a un database PostgreSQL di prova")
+        sys.exit(1)
+
+    db = psycopg2.connect(os.environ["DATABASE_URL"], sslmode=os.environ.get("DB_SSLMODE", "require"))
+    pulisci(db)
+    processo = None
+    url = args.url
+    if not url:
+        processo, url = avvia_server(args.workers, args.threads)
+        print(f"[BENCH] gunicorn avviato su {url} ({args.workers} worker x {args.threads} thread)")
+
+    rng = random.Random(args.seme)
+    violazioni = 0
+    try:
+        for tavolo in TAVOLI_PRENOTABILI[:args.tavoli]:
+            confermate, rifiutate, errori = raffica(url, tavolo, args.richieste, rng)
+            righe = salvate(db, tavolo)
+            posti = TAVOLI[tavolo]
+            totale = sum(righe.values())
+            print(f"[BENCH] tavolo {tavolo}: {args.richieste} richieste, {len(confermate)} confermate, "
+                  f"{rifiutate} rifiutate, {errori} errori; {totale}/{posti} posti occupati")
+            if totale > posti:
+                print(f"[ERROR] Overbooking sul tavolo {tavolo}: {totale} ospiti su {posti} posti")
+                violazioni += 1
+            if righe != confermate:
+                print(f"[ERROR] Tavolo {tavolo}: {len(confermate)} prenotazioni confermate ma {len(righe)} righe "
+                      f"salvate (diverse: {sorted(set(righe.items()) ^ set(confermate.items()))[:10]})")
+                violazioni += 1
+            if errori:
+                print(f"[ERROR] Tavolo {tavolo}: {errori} richieste senza risposta valida")
+                violazioni += 1
+    finally:
+        if processo:
+            ferma_server(processo)
+        pulisci(db)
+        db.close()
+
+    if violazioni:
+        sys.exit(1)
+    print("[OK] Nessun overbooking, prenotazioni confermate = righe salvate")
+
+if __name__ == "__main__":
+    main()
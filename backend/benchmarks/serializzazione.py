@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark della serializzazione delle risposte
+Per ogni endpoint confronta il vecchio percorso (una RealDictRow per riga e
+flask.jsonify) con quello attuale (righe tuple, dizionari costruiti dalle
+colonne e serializzazione.risposta_json) e verifica che il corpo sia identico
+byte per byte. Le righe sono sintetiche, con nomi accentati ed emoji.
+
+Con --db misura anche la lettura dal database (RealDictCursor contro
+CursoreTuple) sulla query di /api/prenotazioni.
+
+Uso: python benchmarks/serializzazione.py [--ripetizioni 200] [--db]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from flask import jsonify  # noqa: E402
+from psycopg2.extras import RealDictRow  # noqa: E402
+
+import backend  # noqa: E402  (l'import non apre connessioni)
+import serializzazione  # noqa: E402
+
+NOMI = ["Mario Rossi", "Niccolò Bianchi", "Zoë Verdi", "Renée Neri 🎉", "Luca Esposito"]
+
+def righe_prenotazioni(n):
+    colonne = ("id", "nome", "telefono", "data", "ora", "ospiti", "tavolo", "note", "timestamp")
+    inizio = datetime(2025, 6, 1, 18, 0)
+    righe = [
+        (i, NOMI[i % len(NOMI)], "3331234567", f"2025-06-{20 + i % 2}", ["19:00", "19:30", "20:00"][i % 3],
+         1 + i % 8, str(3 + i % 37), "Allergia: glutine, è importante" if i % 4 == 0 else "",
+         inizio + timedelta(seconds=i * 37, microseconds=i))
+        for i in range(n)
+    ]
+    return colonne, righe
+
+def righe_feedback(n):
+    colonne = ("id", "nome", "rating", "message", "timestamp")
+    inizio = datetime(2025, 6, 21, 23, 0)
+    righe = [
+        (i, NOMI[i % len(NOMI)], i % 6, f"Festa bellissima, grazie a tutti! Perché non due sere? ({i})",
+         inizio + timedelta(minutes=i))
+        for i in range(n)
+    ]
+    return colonne, righe
+
+def righe_promemoria(n):
+    colonne = ("id", "contact", "timestamp")
+    inizio = datetime(2025, 5, 1, 9, 0)
+    return colonne, [(i, f"utente{i}@esempio.it", inizio + timedelta(hours=i)) for i in range(n)]
+
+def dizionari_psycopg2(colonne, righe):
+    """Come le restituiva RealDictCursor: una RealDictRow (OrderedDict) per riga"""
+    risultato = []
+    for riga in righe:
+        dizionario = RealDictRow()
+        for colonna, valore in zip(colonne, riga):
+            dizionario[colonna] = valore
+        risultato.append(dizionario)
+    return risultato
+
+def lista(colonne, righe, dizionari):
+    return {"success": True, "data": dizionari(colonne, righe), "totale": len(righe), "next_cursor": None}
+
+def casi():
+    """(endpoint, vecchio percorso, percorso attuale)"""
+    prenotazioni = righe_prenotazioni(500)
+    feedback = righe_feedback(50)
+    promemoria = righe_promemoria(20)
+    slot = [("2025-06-20", "19:00"), ("2025-06-20", "20:00"), ("2025-06-21", "19:00")]
+    griglia = {
+        "success": True,
+        "tavoli": list(backend.TAVOLI),
+        "capienza": list(backend.TAVOLI.values()),
+        "slot": [list(s) for s in slot],
+        "disponibili": [[(i * j) % 11 for i in range(len(backend.TAVOLI))] for j in range(len(slot))],
+        "occupati_totali": [123, 98, 140]
+    }
+    return [
+        ("/api/prenotazioni (500)",
+         lambda: jsonify(lista(*prenotazioni, dizionari_psycopg2)),
+         lambda: serializzazione.risposta_json(lista(*prenotazioni, serializzazione.dizionari))),
+        ("/api/feedback (50)",
+         lambda: jsonify(lista(*feedback, dizionari_psycopg2)),
+         lambda: serializzazione.risposta_json(lista(*feedback, serializzazione.dizionari))),
+        ("/api/reminder (20)",
+         lambda: jsonify(lista(*promemoria, dizionari_psycopg2)),
+         lambda: serializzazione.risposta_json(lista(*promemoria, serializzazione.dizionari))),
+        ("/api/tavoli/griglia",
+         lambda: jsonify(griglia),
+         lambda: serializzazione.risposta_json(griglia)),
+    ]
+
+def cronometra(funzione, ripetizioni):
+    """Tempi in microsecondi (dopo un giro di riscaldamento)"""
+    funzione()
+    tempi = []
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        funzione()
+        tempi.append((time.perf_counter() - inizio) * 1e6)
+    return statistics.median(tempi)
+
+def bench_serializzazione(ripetizioni):
+    print(f"\n[BENCH] serializzazione ({serializzazione.MOTORE}, mediana di {ripetizioni} giri)")
+    print(f"  {'endpoint':<26}{'prima µs':>12}{'dopo µs':>12}{'speedup':>10}{'byte':>10}")
+    with backend.app.app_context():
+        for nome, prima, dopo in casi():
+            corpo = prima().get_data()
+            if dopo().get_data() != corpo:
+                print(f"[ERROR] {nome}: il corpo della risposta è cambiato")
+                sys.exit(1)
+            t_prima = cronometra(prima, ripetizioni)
+            t_dopo = cronometra(dopo, ripetizioni)
+            print(f"  {nome:<26}{t_prima:>12.0f}{t_dopo:>12.0f}{t_prima / t_dopo:>9.1f}x{len(corpo):>10}")
+
+def bench_database(ripetizioni):
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+    import metriche
+
+    url = os.environ.get("DATABASE_URL", "")
+    if not url.startswith("postgres"):
+        print("[WARNING] --db richiede DATABASE_URL PostgreSQL")
+        return
+    query = "SELECT * FROM prenotazioni ORDER BY data DESC, ora DESC, id DESC LIMIT 501"
+    conn = psycopg2.connect(url, sslmode=os.environ.get("DB_SSLMODE", "require"))
+    try:
+        def leggi(fabbrica):
+            with conn.cursor(cursor_factory=fabbrica) as cur:
+                cur.execute(query)
+                return cur.fetchall()
+        righe = len(leggi(RealDictCursor))
+        print(f"\n[BENCH] lettura /api/prenotazioni dal database ({righe} righe, mediana di {ripetizioni} giri)")
+        for nome, fabbrica in (("RealDictCursor", RealDictCursor), ("CursoreTuple", metriche.CursoreTuple)):
+            print(f"  {nome:<26}{cronometra(lambda: leggi(fabbrica), ripetizioni):>12.0f} µs")
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark della serializzazione delle risposte")
+    parser.add_argument("--ripetizioni", type=int, default=200)
+    parser.add_argument("--db", action="store_true", help="misura anche la lettura da PostgreSQL")
+    args = parser.parse_args()
+
+    bench_serializzazione(args.ripetizioni)
+    if args.db:
+        bench_database(args.ripetizioni)
+
+if __name__ == "__main__":
+    main()
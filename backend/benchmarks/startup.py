@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Benchmark del tempo di avvio di un worker
+Confronta l'avvio attuale (nessuna connessione all'import) con il vecchio
+comportamento (migrazioni eseguite all'import, MIGRA_ALL_AVVIO=1).
+
+Uso: DATABASE_URL=... python benchmarks/startup.py [--ripetizioni 10]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Eseguito in un processo nuovo per ogni misura, come un worker appena avviato
+CODICE_WORKER = """
+import io, json, time, contextlib
+inizio = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    import backend
+    importato = time.perf_counter()
+    risposta = backend.app.test_client().get('/api/health')
+    pronto = time.perf_counter()
+print(json.dumps({
+    "import_ms": (importato - inizio) * 1000,
+    "prima_richiesta_ms": (pronto - importato) * 1000,
+    "totale_ms": (pronto - inizio) * 1000,
+    "status": risposta.status_code
+}))
+"""
+
+def misura(modalita, ripetizioni):
+    """Avvia `ripetizioni` processi e raccoglie i tempi di avvio"""
+    env = dict(os.environ)
+    if modalita == "migrazioni_all_import":
+        env["MIGRA_ALL_AVVIO"] = "1"
+    else:
+        env.pop("MIGRA_ALL_AVVIO", None)
+
+    risultati = []
+    for _ in range(ripetizioni):
+        uscita = subprocess.run(
+            [sys.executable, "-c", CODICE_WORKER],
+            cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True
+        )
+        risultati.append(json.loads(uscita.stdout.strip().splitlines()[-1]))
+    return risultati
+
+def riepilogo(valori):
+    valori = sorted(valori)
+    p95 = valori[min(len(valori) - 1, int(len(valori) * 0.95))]
+    return f"mediana {statistics.median(valori):8.1f} ms | p95 {p95:8.1f} ms"
+
+def main():
+    parser = argparse.ArgumentParser(description="Tempo di avvio dei worker del backend")
+    parser.add_argument("--ripetizioni", type=int, default=10)
+    args = parser.parse_args()
+
+    if not os.environ.get("DATABASE_URL"):
+        print("[ERROR] DATABASE_URL non impostata")
+        sys.exit(1)
+
+    for modalita in ("migrazioni_all_import", "import_senza_io"):
+        risultati = misura(modalita, args.ripetizioni)
+        print(f"\n[BENCH] {modalita} ({args.ripetizioni} avvii)")
+        for chiave in ("import_ms", "prima_richiesta_ms", "totale_ms"):
+            print(f"  {chiave:<20} {riepilogo([r[chiave] for r in risultati])}")
+
+if __name__ == "__main__":
+    main()
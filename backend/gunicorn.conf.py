@@ -0,0 +1,30 @@
+"""
+Configurazione gunicorn (caricata automaticamente dalla cartella backend)
+Prepara la cartella delle metriche Prometheus e il file dei limiti delle
+richieste, condivisi tra i worker.
+"""
+
+import os
+import shutil
+import tempfile
+
+# Deve essere impostata prima che i worker importino prometheus_client
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "festa_metriche")
+)
+os.environ.setdefault("LIMITI_FILE", os.path.join(tempfile.gettempdir(), "festa_limiti.bin"))
+
+def on_starting(server):
+    """Riparte da metriche e limiti vuoti a ogni avvio del master"""
+    cartella = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(cartella, ignore_errors=True)
+    os.makedirs(cartella, exist_ok=True)
+    try:
+        os.remove(os.environ["LIMITI_FILE"])
+    except FileNotFoundError:
+        pass
+
+def child_exit(server, worker):
+    """Rimuove i gauge del worker terminato dai totali"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Limitazione delle richieste per client (token bucket)
+Ogni coppia (IP, endpoint) ha un secchiello di `raffica` gettoni che si
+ricarica di `ritmo` gettoni al secondo; ogni richiesta ne consuma uno.
+
+Lo stato è in un file mappato in memoria (LIMITI_FILE), condiviso da tutti i
+worker gunicorn della macchina: la tabella è associativa a insiemi di 8 slot,
+ogni insieme è protetto da un lock fcntl sul suo intervallo di byte. Se un
+insieme è pieno si riusa lo slot aggiornato meno di recente. Senza fcntl
+(Windows, un solo processo con waitress) lo stato resta nella memoria del
+processo.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LIMITI_FILE = os.environ.get("LIMITI_FILE") or os.path.join(tempfile.gettempdir(), "festa_limiti.bin")
+LIMITI_SLOT = int(os.environ.get("LIMITI_SLOT", 8192))
+
+SLOT_PER_INSIEME = 8
+RECORD = struct.Struct("<Qdd")  # impronta della chiave, gettoni, ultimo aggiornamento
+
+def impronta(chiave):
+    """Impronta a 64 bit della chiave (0 indica uno slot libero)"""
+    return int.from_bytes(hashlib.blake2b(chiave.encode(), digest_size=8).digest(), "little") or 1
+
+def ricarica(gettoni, ultimo, adesso, ritmo, raffica):
+    """Gettoni disponibili dopo la ricarica dall'ultimo aggiornamento"""
+    return min(raffica, gettoni + max(0.0, adesso - ultimo) * ritmo)
+
+def esito(gettoni, ritmo):
+    """(consentita, gettoni rimasti, secondi di attesa prima del prossimo gettone)"""
+    if gettoni >= 1:
+        return True, gettoni - 1, 0.0
+    return False, gettoni, (1 - gettoni) / ritmo
+
+class TabellaCondivisa:
+    """Secchielli in un file mappato in memoria, condivisi tra i processi"""
+
+    def __init__(self, percorso, slot):
+        self.insiemi = max(1, slot // SLOT_PER_INSIEME)
+        dimensione = self.insiemi * SLOT_PER_INSIEME * RECORD.size
+        self._file = open(percorso, "a+b")
+        if os.fstat(self._file.fileno()).st_size < dimensione:
+            self._file.truncate(dimensione)
+        self._mappa = mmap.mmap(self._file.fileno(), dimensione)
+        # I lock fcntl sono del processo: tra i thread dello stesso worker serve anche questo
+        self._lock = threading.Lock()
+
+    def consuma(self, chiave, ritmo, raffica):
+        h = impronta(chiave)
+        lunghezza = SLOT_PER_INSIEME * RECORD.size
+        inizio = (h % self.insiemi) * lunghezza
+        with self._lock:
+            fcntl.lockf(self._file, fcntl.LOCK_EX, lunghezza, inizio, os.SEEK_SET)
+            try:
+                adesso = time.time()
+                scelto, piu_vecchio = None, None
+                for i in range(SLOT_PER_INSIEME):
+                    posizione = inizio + i * RECORD.size
+                    k, gettoni, ultimo = RECORD.unpack_from(self._mappa, posizione)
+                    if k == h:
+                        scelto = (posizione, ricarica(gettoni, ultimo, adesso, ritmo, raffica))
+                        break
+                    if piu_vecchio is None or ultimo < piu_vecchio[1]:
+                        piu_vecchio = (posizione, ultimo)
+                if scelto is None:
+                    scelto = (piu_vecchio[0], float(raffica))  # slot libero o meno recente
+                posizione, gettoni = scelto
+                consentita, gettoni, attesa = esito(gettoni, ritmo)
+                RECORD.pack_into(self._mappa, posizione, h, gettoni, adesso)
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN, lunghezza, inizio, os.SEEK_SET)
+        return consentita, attesa
+
+class TabellaLocale:
+    """Secchielli nella memoria del processo (senza fcntl)"""
+
+    def __init__(self, slot):
+        self.slot = slot
+        self._secchielli = {}
+        self._lock = threading.Lock()
+
+    def consuma(self, chiave, ritmo, raffica):
+        with self._lock:
+            adesso = time.time()
+            gettoni, ultimo = self._secchielli.pop(chiave, (float(raffica), adesso))
+            consentita, gettoni, attesa = esito(ricarica(gettoni, ultimo, adesso, ritmo, raffica), ritmo)
+            self._secchielli[chiave] = (gettoni, adesso)  # in fondo: i più vecchi sono i primi
+            if len(self._secchielli) > self.slot:
+                del self._secchielli[next(iter(self._secchielli))]
+        return consentita, attesa
+
+_tabella = None
+_tabella_pid = None
+_tabella_lock = threading.Lock()
+
+def get_tabella():
+    """Tabella dei secchielli del processo corrente"""
+    global _tabella, _tabella_pid
+    if _tabella is None or _tabella_pid != os.getpid():
+        with _tabella_lock:
+            if _tabella is None or _tabella_pid != os.getpid():
+                if fcntl is not None:
+                    _tabella = TabellaCondivisa(LIMITI_FILE, LIMITI_SLOT)
+                else:
+                    _tabella = TabellaLocale(LIMITI_SLOT)
+                _tabella_pid = os.getpid()
+    return _tabella
+
+def consuma(chiave, ritmo, raffica):
+    """Consuma un gettone per `chiave`: (consentita, secondi di attesa suggeriti)"""
+    return get_tabella().consuma(chiave, ritmo, raffica)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Metriche Prometheus del backend
+Contatori, istogrammi di latenza e richieste in corso per ogni route, con il
+tempo speso nel database separato dal tempo totale della richiesta.
+
+Con gunicorn impostare PROMETHEUS_MULTIPROC_DIR (lo fa gunicorn.conf.py):
+ogni worker scrive su file mappati in memoria e /api/metrics li aggrega.
+"""
+
+import os
+import threading
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+)
+from prometheus_client import multiprocess
+from psycopg2.extensions import cursor as cursore_semplice
+from psycopg2.extras import RealDictCursor
+
+import tracciamento
+
+MULTIPROCESSO = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+# Bucket pensati per un'API che risponde in millisecondi
+BUCKET_LATENZA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+RICHIESTE = Counter(
+    "festa_http_richieste", "Richieste HTTP servite", ["metodo", "route", "stato"]
+)
+LATENZA = Histogram(
+    "festa_http_latenza_secondi", "Durata totale delle richieste HTTP",
+    ["metodo", "route"], buckets=BUCKET_LATENZA
+)
+LATENZA_DB = Histogram(
+    "festa_http_db_secondi", "Tempo speso nel database per richiesta HTTP",
+    ["metodo", "route"], buckets=BUCKET_LATENZA
+)
+QUERY_DB = Counter(
+    "festa_db_query", "Query eseguite sul database", ["route"]
+)
+RIFIUTATE = Counter(
+    "festa_http_rifiutate", "Richieste rifiutate dal controllo di ammissione (429/503)", ["route", "motivo"]
+)
+SCRITTURE_SU_DISCO = Counter(
+    "festa_scritture_differite_su_disco",
+    "Righe della scrittura differita salvate su disco dopo i tentativi falliti", ["tabella"]
+)
+SCRITTURE_RECUPERATE = Counter(
+    "festa_scritture_differite_recuperate",
+    "Righe salvate su disco e poi scritte nel database", ["tabella"]
+)
+IN_CORSO = Gauge(
+    "festa_http_richieste_in_corso", "Richieste HTTP in corso",
+    ["route"], multiprocess_mode="livesum"
+)
+
+# Tempo DB della richiesta corrente (una richiesta per thread)
+_locale = threading.local()
+
+class _Misurato:
+    """Somma il tempo delle query alla richiesta in corso"""
+
+    def execute(self, query, vars=None):
+        inizio = time.perf_counter()
+        try:
+            risultato = super().execute(query, vars)
+        finally:
+            durata = time.perf_counter() - inizio
+            registra_db(durata)
+        if tracciamento.ATTIVO:
+            tracciamento.registra(self, query, vars, durata, self.rowcount, route_corrente())
+        return risultato
+
+    def executemany(self, query, vars_list):
+        inizio = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            registra_db(time.perf_counter() - inizio)
+
+class CursoreMisurato(_Misurato, RealDictCursor):
+    """RealDictCursor misurato: righe come dizionari (cursore predefinito del pool)"""
+
+class CursoreTuple(_Misurato, cursore_semplice):
+    """Cursore misurato con righe tuple, per le liste lunghe (nessun dizionario per riga)"""
+
+def registra_db(secondi):
+    """Aggiunge `secondi` al tempo DB della richiesta del thread corrente"""
+    misura = getattr(_locale, "misura", None)
+    if misura is not None:
+        misura[0] += secondi
+        misura[1] += 1
+
+def route_corrente():
+    """Route della richiesta servita dal thread corrente (None fuori da una richiesta)"""
+    return getattr(_locale, "route", None)
+
+def inizio_richiesta(route):
+    """Apre la misura di una richiesta; restituisce l'istante di inizio"""
+    _locale.misura = [0.0, 0]
+    _locale.route = route
+    if tracciamento.ATTIVO:
+        tracciamento.inizio_richiesta()
+    IN_CORSO.labels(route).inc()
+    return time.perf_counter()
+
+def fine_richiesta(metodo, route, stato, inizio):
+    """Chiude la misura aperta da inizio_richiesta; restituisce la durata in secondi"""
+    durata = time.perf_counter() - inizio
+    tempo_db, query = getattr(_locale, "misura", None) or (0.0, 0)
+    _locale.misura = None
+    _locale.route = None
+    if tracciamento.ATTIVO:
+        tracciamento.fine_richiesta(metodo, route, stato, durata)
+    IN_CORSO.labels(route).dec()
+    RICHIESTE.labels(metodo, route, str(stato)).inc()
+    LATENZA.labels(metodo, route).observe(durata)
+    LATENZA_DB.labels(metodo, route).observe(tempo_db)
+    if query:
+        QUERY_DB.labels(route).inc(query)
+    return durata, tempo_db
+
+def esporta():
+    """Testo Prometheus delle metriche (aggregate tra i worker in modalità multiprocesso)"""
+    if MULTIPROCESSO:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
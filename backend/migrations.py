@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""
+Migrazioni versionate dello schema PostgreSQL
+Ogni migrazione viene applicata una sola volta e registrata in schema_migrazioni
+"""
+
+import time
+from contextlib import contextmanager
+
+# Chiave del lock advisory: più processi che avviano le migrazioni insieme
+# si mettono in coda invece di applicarle due volte
+LOCK_MIGRAZIONI = 7318001
+BLOCCO_BACKFILL = 1000  # righe aggiornate per transazione durante i backfill
+
+MIGRAZIONI = []  # (versione, nome, funzione)
+
+def migrazione(versione, nome):
+    """Registra una funzione come migrazione con il numero di versione dato"""
+    def decoratore(funzione):
+        MIGRAZIONI.append((versione, nome, funzione))
+        return funzione
+    return decoratore
+
+@contextmanager
+def transazione(conn):
+    """Esegue un blocco in una transazione esplicita su una connessione in autocommit"""
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cur:
+            yield cur
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = True
+
+def _valore(riga, chiave, indice=0):
+    """Legge una colonna sia da tuple che da RealDictRow"""
+    return riga[chiave] if isinstance(riga, dict) else riga[indice]
+
+def _tipo_colonna(cur, tabella, colonna):
+    cur.execute(
+        "SELECT data_type FROM information_schema.columns WHERE table_name = %s AND column_name = %s",
+        (tabella, colonna)
+    )
+    riga = cur.fetchone()
+    return _valore(riga, "data_type") if riga else None
+
+def _elimina_indici_non_validi(cur, tabella):
+    """Rimuove gli indici lasciati INVALID da un CREATE INDEX CONCURRENTLY interrotto"""
+    cur.execute("""
+        SELECT c.relname FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = %s::regclass AND NOT i.indisvalid
+    """, (tabella,))
+    for riga in cur.fetchall():
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{_valore(riga, "relname")}"')
+
+def versione_schema(conn):
+    """Versione dello schema applicata al database (0 se mai migrato)"""
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('schema_migrazioni') AS tabella")
+        if _valore(cur.fetchone(), "tabella") is None:
+            return 0
+        cur.execute("SELECT COALESCE(MAX(versione), 0) AS versione FROM schema_migrazioni")
+        return _valore(cur.fetchone(), "versione")
+
+def versione_richiesta():
+    """Ultima versione dello schema prevista dal codice"""
+    return max(versione for versione, _, _ in MIGRAZIONI)
+
+def applica_migrazioni(conn):
+    """Applica in ordine le migrazioni mancanti; restituisce quante ne ha applicate"""
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    applicate = 0
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (LOCK_MIGRAZIONI,))
+            try:
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrazioni (
+                        versione INTEGER PRIMARY KEY,
+                        nome TEXT NOT NULL,
+                        applicata TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );
+                """)
+                cur.execute("SELECT versione FROM schema_migrazioni")
+                gia_applicate = {_valore(riga, "versione") for riga in cur.fetchall()}
+
+                for versione, nome, funzione in sorted(MIGRAZIONI, key=lambda m: m[0]):
+                    if versione in gia_applicate:
+                        continue
+                    print(f"[MIGRAZIONE] {versione:03d} {nome}...")
+                    inizio = time.monotonic()
+                    funzione(conn)
+                    cur.execute(
+                        "INSERT INTO schema_migrazioni (versione, nome) VALUES (%s, %s)",
+                        (versione, nome)
+                    )
+                    applicate += 1
+                    print(f"[OK] Migrazione {versione:03d} applicata in {time.monotonic() - inizio:.2f}s")
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (LOCK_MIGRAZIONI,))
+    finally:
+        conn.autocommit = autocommit
+    return applicate
+
+# ================================
+# STATISTICHE
+# ================================
+# Tabelle riassuntive per /api/stats, aggiornate dai trigger nella stessa
+# transazione delle scritture. I totali sono divisi per slot e per rating
+# invece che in un'unica riga: una riga globale verrebbe bloccata da ogni
+# prenotazione e serializzerebbe anche quelle su tavoli diversi.
+SQL_STATISTICHE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS stat_slot (
+        data TEXT NOT NULL,
+        ora TEXT NOT NULL,
+        prenotazioni BIGINT NOT NULL DEFAULT 0,
+        ospiti BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (data, ora)
+    );
+    CREATE TABLE IF NOT EXISTS stat_rating (
+        rating INTEGER PRIMARY KEY,
+        totale BIGINT NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS stat_contatori (
+        chiave TEXT PRIMARY KEY,
+        valore BIGINT NOT NULL DEFAULT 0
+    );
+
+    CREATE OR REPLACE FUNCTION stat_prenotazioni_trg() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            UPDATE stat_slot SET prenotazioni = prenotazioni - 1, ospiti = ospiti - OLD.ospiti
+            WHERE data = OLD.data AND ora = OLD.ora;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO stat_slot (data, ora, prenotazioni, ospiti) VALUES (NEW.data, NEW.ora, 1, NEW.ospiti)
+            ON CONFLICT (data, ora) DO UPDATE
+            SET prenotazioni = stat_slot.prenotazioni + 1, ospiti = stat_slot.ospiti + EXCLUDED.ospiti;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION stat_feedbacks_trg() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            UPDATE stat_rating SET totale = totale - 1 WHERE rating = OLD.rating;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO stat_rating (rating, totale) VALUES (NEW.rating, 1)
+            ON CONFLICT (rating) DO UPDATE SET totale = stat_rating.totale + 1;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION stat_promemoria_trg() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO stat_contatori (chiave, valore)
+        VALUES ('promemoria', CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END)
+        ON CONFLICT (chiave) DO UPDATE SET valore = stat_contatori.valore + EXCLUDED.valore;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE TRIGGER stat_feedbacks AFTER INSERT OR DELETE OR UPDATE OF rating
+        ON feedbacks FOR EACH ROW EXECUTE FUNCTION stat_feedbacks_trg();
+    CREATE OR REPLACE TRIGGER stat_promemoria AFTER INSERT OR DELETE
+        ON reminder_requests FOR EACH ROW EXECUTE FUNCTION stat_promemoria_trg();
+"""
+
+# Separato perché dipende dalle colonne data/ora, ricreate dalla migrazione 002
+SQL_STATISTICHE_TRIGGER_PRENOTAZIONI = """
+    CREATE OR REPLACE TRIGGER stat_prenotazioni AFTER INSERT OR DELETE OR UPDATE OF data, ora, ospiti
+        ON prenotazioni FOR EACH ROW EXECUTE FUNCTION stat_prenotazioni_trg();
+"""
+
+def riconcilia_statistiche(cur):
+    """Ricalcola da zero le tabelle delle statistiche (una tantum o dopo modifiche manuali).
+
+    Blocca le scritture sulle tabelle sorgente per la durata del ricalcolo;
+    il commit resta a carico del chiamante.
+    """
+    cur.execute("LOCK TABLE prenotazioni, feedbacks, reminder_requests IN SHARE MODE")
+    cur.execute("DELETE FROM stat_slot")
+    cur.execute("""
+        INSERT INTO stat_slot (data, ora, prenotazioni, ospiti)
+        SELECT data, ora, COUNT(*), SUM(ospiti) FROM prenotazioni GROUP BY data, ora
+    """)
+    cur.execute("DELETE FROM stat_rating")
+    cur.execute("""
+        INSERT INTO stat_rating (rating, totale)
+        SELECT rating, COUNT(*) FROM feedbacks GROUP BY rating
+    """)
+    cur.execute("DELETE FROM stat_contatori")
+    cur.execute("""
+        INSERT INTO stat_contatori (chiave, valore)
+        SELECT 'promemoria', COUNT(*) FROM reminder_requests
+        UNION ALL SELECT 'inizializzato', 1
+    """)
+
+# ================================
+# MIGRAZIONI
+# ================================
+@migrazione(1, "schema_iniziale")
+def schema_iniziale(conn):
+    """Tabelle, indici e statistiche (idempotente: adotta anche i database esistenti)"""
+    with transazione(conn) as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS prenotazioni (
+                id SERIAL PRIMARY KEY,
+                nome TEXT NOT NULL,
+                telefono TEXT NOT NULL,
+                data TEXT NOT NULL,
+                ora TEXT NOT NULL,
+                ospiti INTEGER NOT NULL,
+                tavolo TEXT NOT NULL,
+                note TEXT DEFAULT '',
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS feedbacks (
+                id SERIAL PRIMARY KEY,
+                nome TEXT DEFAULT 'Anonimo',
+                rating INTEGER NOT NULL CHECK (rating BETWEEN 0 AND 5),
+                message TEXT NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS reminder_requests (
+                id SERIAL PRIMARY KEY,
+                contact TEXT NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+
+        # Indici per la paginazione a cursore: ogni pagina è una scansione di intervallo
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_prenotazioni_data_ora_id ON prenotazioni(data, ora, id);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_prenotazioni_tavolo_data_ora_id ON prenotazioni(tavolo, data, ora, id);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_feedbacks_timestamp_id ON feedbacks(timestamp, id);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_reminder_timestamp ON reminder_requests(timestamp);")
+        # Sostituiti dagli indici composti qui sopra
+        cur.execute("DROP INDEX IF EXISTS idx_prenotazioni_data_ora;")
+        cur.execute("DROP INDEX IF EXISTS idx_prenotazioni_tavolo;")
+        cur.execute("DROP INDEX IF EXISTS idx_feedbacks_timestamp;")
+
+        # Contatori delle statistiche mantenuti dai trigger
+        cur.execute(SQL_STATISTICHE_SCHEMA)
+        cur.execute(SQL_STATISTICHE_TRIGGER_PRENOTAZIONI)
+        cur.execute("SELECT 1 FROM stat_contatori WHERE chiave = 'inizializzato'")
+        if cur.fetchone() is None:
+            print("[MIGRAZIONE] Prima inizializzazione contatori statistiche...")
+            riconcilia_statistiche(cur)
+
+@migrazione(2, "data_ora_tipizzate")
+def data_ora_tipizzate(conn):
+    """prenotazioni.data/ora da TEXT a DATE/TIME, senza fermare il servizio.
+
+    1. colonne tipizzate affiancate, riempite da un trigger per le nuove righe
+    2. backfill a blocchi di id, ognuno nella propria transazione
+    3. indici (compreso quello coprente per l'occupazione) creati CONCURRENTLY
+    4. scambio delle colonne in una transazione breve
+    """
+    with conn.cursor() as cur:
+        if _tipo_colonna(cur, "prenotazioni", "data") == "date":
+            return
+
+    with transazione(conn) as cur:
+        cur.execute("""
+            ALTER TABLE prenotazioni
+                ADD COLUMN IF NOT EXISTS data_tipizzata DATE,
+                ADD COLUMN IF NOT EXISTS ora_tipizzata TIME;
+        """)
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION prenotazioni_sync_tipizzate() RETURNS trigger AS $$
+            BEGIN
+                NEW.data_tipizzata := NEW.data::date;
+                NEW.ora_tipizzata := NEW.ora::time;
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE OR REPLACE TRIGGER prenotazioni_sync_tipizzate BEFORE INSERT OR UPDATE OF data, ora
+                ON prenotazioni FOR EACH ROW EXECUTE FUNCTION prenotazioni_sync_tipizzate();
+        """)
+
+    # Le righe successive a max_id sono coperte dal trigger
+    with conn.cursor() as cur:
+        cur.execute("SELECT COALESCE(MAX(id), 0) AS max_id FROM prenotazioni")
+        max_id = _valore(cur.fetchone(), "max_id")
+    for inizio in range(0, max_id, BLOCCO_BACKFILL):
+        with transazione(conn) as cur:
+            cur.execute("""
+                UPDATE prenotazioni SET data_tipizzata = data::date, ora_tipizzata = ora::time
+                WHERE id > %s AND id <= %s AND (data_tipizzata IS NULL OR ora_tipizzata IS NULL)
+            """, (inizio, inizio + BLOCCO_BACKFILL))
+
+    with conn.cursor() as cur:
+        _elimina_indici_non_validi(cur, "prenotazioni")
+        # Indice coprente: le somme di occupazione diventano index-only scan
+        cur.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_prenotazioni_occupazione_tmp
+            ON prenotazioni (data_tipizzata, ora_tipizzata, tavolo) INCLUDE (ospiti)
+        """)
+        cur.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_prenotazioni_data_ora_id_tmp
+            ON prenotazioni (data_tipizzata, ora_tipizzata, id)
+        """)
+        cur.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_prenotazioni_tavolo_data_ora_id_tmp
+            ON prenotazioni (tavolo, data_tipizzata, ora_tipizzata, id)
+        """)
+
+    with transazione(conn) as cur:
+        cur.execute("SET LOCAL lock_timeout = '10s'")
+        cur.execute("LOCK TABLE prenotazioni IN ACCESS EXCLUSIVE MODE")
+        cur.execute("""
+            UPDATE prenotazioni SET data_tipizzata = data::date, ora_tipizzata = ora::time
+            WHERE data_tipizzata IS NULL OR ora_tipizzata IS NULL
+        """)
+        cur.execute("DROP TRIGGER prenotazioni_sync_tipizzate ON prenotazioni")
+        cur.execute("DROP FUNCTION prenotazioni_sync_tipizzate()")
+        cur.execute("DROP TRIGGER IF EXISTS stat_prenotazioni ON prenotazioni")
+        # Elimina anche i vecchi indici sulle colonne TEXT
+        cur.execute("ALTER TABLE prenotazioni DROP COLUMN data, DROP COLUMN ora")
+        cur.execute("ALTER TABLE prenotazioni RENAME COLUMN data_tipizzata TO data")
+        cur.execute("ALTER TABLE prenotazioni RENAME COLUMN ora_tipizzata TO ora")
+        cur.execute("ALTER TABLE prenotazioni ALTER COLUMN data SET NOT NULL, ALTER COLUMN ora SET NOT NULL")
+        cur.execute("ALTER INDEX idx_prenotazioni_occupazione_tmp RENAME TO idx_prenotazioni_occupazione")
+        cur.execute("ALTER INDEX idx_prenotazioni_data_ora_id_tmp RENAME TO idx_prenotazioni_data_ora_id")
+        cur.execute("ALTER INDEX idx_prenotazioni_tavolo_data_ora_id_tmp RENAME TO idx_prenotazioni_tavolo_data_ora_id")
+        cur.execute("""
+            ALTER TABLE stat_slot
+                ALTER COLUMN data TYPE DATE USING data::date,
+                ALTER COLUMN ora TYPE TIME USING ora::time
+        """)
+        cur.execute(SQL_STATISTICHE_TRIGGER_PRENOTAZIONI)
+
+@migrazione(3, "richieste_idempotenti")
+def richieste_idempotenti(conn):
+    """Risposte memorizzate per le POST con header Idempotency-Key"""
+    with transazione(conn) as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS richieste_idempotenti (
+                endpoint TEXT NOT NULL,
+                chiave TEXT NOT NULL,
+                impronta TEXT NOT NULL,
+                stato INTEGER,
+                risposta TEXT,
+                creata TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (endpoint, chiave)
+            );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_richieste_idempotenti_creata ON richieste_idempotenti(creata);")
+
+@migrazione(4, "trattenute")
+def trattenute(conn):
+    """Posti trattenuti temporaneamente mentre si compila il modulo di prenotazione"""
+    with transazione(conn) as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS trattenute (
+                token TEXT PRIMARY KEY,
+                data DATE NOT NULL,
+                ora TIME NOT NULL,
+                tavolo TEXT NOT NULL,
+                ospiti INTEGER NOT NULL,
+                scade DOUBLE PRECISION NOT NULL
+            );
+        """)
+        # Somme per slot come per le prenotazioni; scade per la pulizia delle scadute
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_trattenute_slot ON trattenute(data, ora, tavolo) INCLUDE (ospiti, scade);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_trattenute_scade ON trattenute(scade);")
+
+@migrazione(5, "invio_promemoria")
+def invio_promemoria(conn):
+    """Stato dell'invio dei promemoria: inviato, tentativi falliti, ultimo errore"""
+    with transazione(conn) as cur:
+        # Default costante: nessuna riscrittura della tabella
+        cur.execute("""
+            ALTER TABLE reminder_requests
+                ADD COLUMN IF NOT EXISTS inviato TIMESTAMP,
+                ADD COLUMN IF NOT EXISTS tentativi INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS errore TEXT;
+        """)
+    with conn.cursor() as cur:
+        _elimina_indici_non_validi(cur, "reminder_requests")
+        # Solo le righe ancora da inviare: dopo l'invio l'indice resta piccolo
+        cur.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reminder_da_inviare
+            ON reminder_requests (id) WHERE inviato IS NULL
+        """)
+
+@migrazione(6, "ricerca_feedback")
+def ricerca_feedback(conn):
+    """Ricerca full-text sui messaggi di feedback: tsvector italiano generato e indice GIN"""
+    with transazione(conn) as cur:
+        # Riscrive la tabella (poche migliaia di righe): il lock dura una frazione di secondo
+        cur.execute("SET LOCAL lock_timeout = '10s'")
+        cur.execute("""
+            ALTER TABLE feedbacks ADD COLUMN IF NOT EXISTS ricerca tsvector
+                GENERATED ALWAYS AS (to_tsvector('italian', message)) STORED;
+        """)
+    with conn.cursor() as cur:
+        _elimina_indici_non_validi(cur, "feedbacks")
+        # fastupdate off: i feedback arrivano pochi alla volta, meglio inserirli subito
+        # nell'indice che lasciarli nella pending list da scorrere a ogni ricerca
+        cur.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_feedbacks_ricerca
+            ON feedbacks USING GIN (ricerca) WITH (fastupdate = off)
+        """)
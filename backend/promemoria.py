@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Invio dei promemoria della festa
+Le richieste raccolte da /api/reminder vengono lette con un cursore lato
+server, i contatti normalizzati e deduplicati (anche rispetto agli invii
+precedenti) e spediti con un trasporto intercambiabile: SMTP per le email,
+oppure "stampa" per una prova a secco, che non registra nessun esito (le
+righe restano da inviare). I numeri di telefono restano da inviare
+finché non c'è un trasporto per il canale "telefono".
+
+Gli invii partono da un pool di thread limitato, con un ritmo massimo
+(token bucket di limitatore.py) e backoff esponenziale sugli errori
+temporanei. Gli esiti sono registrati a blocchi: dopo un'interruzione un
+nuovo invio riprende dalle righe non ancora segnate (al più l'ultimo blocco
+viene rispedito).
+
+Uso: python backend.py invia-promemoria [--prova] [--limite N]
+"""
+
+import os
+import random
+import re
+import smtplib
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.message import EmailMessage
+from email.utils import make_msgid
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import limitatore
+
+PROMEMORIA_THREAD = int(os.environ.get("PROMEMORIA_THREAD", 4))
+PROMEMORIA_RITMO = float(os.environ.get("PROMEMORIA_RITMO", 5))          # messaggi al secondo
+PROMEMORIA_RAFFICA = int(os.environ.get("PROMEMORIA_RAFFICA", 10))
+PROMEMORIA_RIPETIZIONI = int(os.environ.get("PROMEMORIA_RIPETIZIONI", 3))  # tentativi per invio
+PROMEMORIA_TENTATIVI_MAX = int(os.environ.get("PROMEMORIA_TENTATIVI_MAX", 5))  # invii falliti prima di rinunciare
+PROMEMORIA_BLOCCO = 100  # esiti per UPDATE
+PROMEMORIA_BACKOFF = 1.0  # secondi prima del secondo tentativo, poi raddoppia
+PROMEMORIA_LOCK = os.path.join(tempfile.gettempdir(), "festa_promemoria.lock")
+
+PROMEMORIA_OGGETTO = os.environ.get("PROMEMORIA_OGGETTO", "Promemoria: Festa dello Sport")
+PROMEMORIA_TESTO = os.environ.get(
+    "PROMEMORIA_TESTO",
+    "Ciao!\n\nCome ci avevi chiesto, ti ricordiamo la Festa dello Sport.\n"
+    "Prenota il tuo tavolo sul sito della festa per non restare senza posto.\n\n"
+    "A presto!"
+)
+
+EMAIL = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+CELLULARE = re.compile(r"3\d{8,9}")
+TELEFONO_ESTERO = re.compile(r"\+\d{8,15}")
+
+def normalizza_contatto(contatto):
+    """(canale, contatto normalizzato) oppure None se non è né un'email né un telefono"""
+    contatto = (contatto or "").strip()
+    if "@" in contatto:
+        contatto = contatto.lower()
+        return ("email", contatto) if EMAIL.fullmatch(contatto) else None
+    numero = re.sub(r"[\s\-./()]", "", contatto)
+    if numero.startswith("0039"):
+        numero = "+" + numero[2:]
+    if numero.startswith("+39"):
+        numero = numero[3:]
+    if CELLULARE.fullmatch(numero):
+        return "telefono", "+39" + numero
+    if TELEFONO_ESTERO.fullmatch(numero):
+        return "telefono", numero
+    return None
+
+# ================================
+# TRASPORTI
+# ================================
+class ErroreDefinitivo(Exception):
+    """Il contatto non può ricevere il promemoria: inutile ritentare"""
+
+class Trasporto:
+    """Invia un promemoria a un contatto normalizzato dei canali che gestisce"""
+
+    canali = ()
+
+    def invia(self, contatto, oggetto, testo):
+        raise NotImplementedError
+
+    def chiudi(self):
+        pass
+
+class TrasportoStampa(Trasporto):
+    """Prova a secco: stampa i promemoria invece di inviarli"""
+
+    canali = ("email", "telefono")
+
+    def invia(self, contatto, oggetto, testo):
+        print(f"[PROMEMORIA] -> {contatto}: {oggetto}")
+
+class TrasportoSMTP(Trasporto):
+    """Email via SMTP, una connessione per thread riusata tra i messaggi"""
+
+    canali = ("email",)
+
+    def __init__(self, host, port, utente=None, password=None, starttls=False, mittente=None, timeout=30):
+        self.host = host
+        self.port = port
+        self.utente = utente
+        self.password = password
+        self.starttls = starttls
+        self.mittente = mittente or utente or "festa@localhost"
+        self.timeout = timeout
+        self._locale = threading.local()
+        self._lock = threading.Lock()
+        self._connessioni = []
+
+    @classmethod
+    def da_ambiente(cls):
+        return cls(
+            os.environ.get("SMTP_HOST", "localhost"),
+            int(os.environ.get("SMTP_PORT", 25)),
+            os.environ.get("SMTP_UTENTE"),
+            os.environ.get("SMTP_PASSWORD"),
+            os.environ.get("SMTP_STARTTLS") == "1",
+            os.environ.get("SMTP_MITTENTE")
+        )
+
+    def _connessione(self):
+        smtp = getattr(self._locale, "smtp", None)
+        if smtp is None:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.starttls:
+                smtp.starttls()
+            if self.utente:
+                smtp.login(self.utente, self.password or "")
+            self._locale.smtp = smtp
+            with self._lock:
+                self._connessioni.append(smtp)
+        return smtp
+
+    def _scarta(self):
+        smtp = getattr(self._locale, "smtp", None)
+        self._locale.smtp = None
+        if smtp is not None:
+            with self._lock:
+                if smtp in self._connessioni:
+                    self._connessioni.remove(smtp)
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+    def _annulla(self, smtp):
+        """Dopo un rifiuto la connessione resta buona per il messaggio successivo"""
+        try:
+            smtp.rset()
+        except (smtplib.SMTPException, OSError):
+            self._scarta()
+
+    def invia(self, contatto, oggetto, testo):
+        messaggio = EmailMessage()
+        messaggio["From"] = self.mittente
+        messaggio["To"] = contatto
+        messaggio["Subject"] = oggetto
+        messaggio["Message-ID"] = make_msgid(domain=self.mittente.rpartition("@")[2] or None)
+        messaggio.set_content(testo)
+        try:
+            # Gli errori di connessione e di login sono temporanei anche se 5xx:
+            # riguardano il server, non il destinatario
+            smtp = self._connessione()
+        except (smtplib.SMTPException, OSError):
+            self._scarta()
+            raise
+        try:
+            smtp.send_message(messaggio)
+        except smtplib.SMTPRecipientsRefused as errore:
+            self._annulla(smtp)
+            raise ErroreDefinitivo(f"destinatario rifiutato: {errore.recipients}") from errore
+        except smtplib.SMTPNotSupportedError as errore:
+            # Indirizzo con caratteri non ASCII e server senza SMTPUTF8
+            raise ErroreDefinitivo(str(errore)) from errore
+        except smtplib.SMTPDataError as errore:
+            if 500 <= errore.smtp_code < 600:
+                self._annulla(smtp)
+                raise ErroreDefinitivo(f"{errore.smtp_code} {errore.smtp_error.decode(errors='replace')}") from errore
+            self._scarta()
+            raise
+        except (smtplib.SMTPException, OSError):
+            self._scarta()  # connessione caduta: al prossimo tentativo se ne apre un'altra
+            raise
+
+    def chiudi(self):
+        with self._lock:
+            connessioni, self._connessioni = self._connessioni, []
+        for smtp in connessioni:
+            try:
+                smtp.quit()
+            except Exception:
+                pass
+
+TRASPORTI = {
+    "smtp": TrasportoSMTP.da_ambiente,
+    "stampa": TrasportoStampa,
+}
+
+def crea_trasporti(nomi):
+    """Trasporti dai nomi (es. "smtp" o "smtp,sms"); per ogni canale vale il primo"""
+    trasporti = {}
+    for nome in nomi:
+        trasporto = TRASPORTI[nome.strip()]()
+        for canale in trasporto.canali:
+            trasporti.setdefault(canale, trasporto)
+    return trasporti
+
+# ================================
+# INVIO
+# ================================
+def invia_con_ripetizioni(trasporto, contatto, oggetto, testo):
+    """Invia rispettando il ritmo massimo; None se riuscito, altrimenti (errore, definitivo)"""
+    for tentativo in range(PROMEMORIA_RIPETIZIONI):
+        # Ritmo condiviso con gli altri processi di invio della macchina
+        while True:
+            consentito, attesa = limitatore.consuma("promemoria", PROMEMORIA_RITMO, PROMEMORIA_RAFFICA)
+            if consentito:
+                break
+            time.sleep(attesa)
+        try:
+            trasporto.invia(contatto, oggetto, testo)
+            return None
+        except ErroreDefinitivo as errore:
+            return str(errore), True
+        except Exception as errore:
+            ultimo = f"{type(errore).__name__}: {errore}"
+            if tentativo + 1 < PROMEMORIA_RIPETIZIONI:
+                time.sleep(PROMEMORIA_BACKOFF * 2 ** tentativo * random.uniform(0.5, 1.5))
+    return ultimo, False
+
+class Esiti:
+    """Esiti in attesa di essere scritti, registrati a blocchi di PROMEMORIA_BLOCCO"""
+
+    def __init__(self, archivio):
+        self.archivio = archivio
+        self.inviati = []
+        self.falliti = []
+        self.conteggi = {"inviati": 0, "duplicati": 0, "falliti": 0, "scartati": 0}
+
+    def inviato(self, promemoria_id, conteggio="inviati"):
+        self.inviati.append(promemoria_id)
+        self.conteggi[conteggio] += 1
+        self._forse_scrivi()
+
+    def fallito(self, promemoria_id, tentativi, errore, definitivo):
+        tentativi = PROMEMORIA_TENTATIVI_MAX if definitivo else tentativi + 1
+        self.falliti.append((promemoria_id, tentativi, errore[:500]))
+        self.conteggi["scartati" if definitivo else "falliti"] += 1
+        self._forse_scrivi()
+
+    def _forse_scrivi(self):
+        if len(self.inviati) + len(self.falliti) >= PROMEMORIA_BLOCCO:
+            self.scrivi()
+
+    def scrivi(self):
+        if self.inviati or self.falliti:
+            self.archivio.segna_promemoria(self.inviati, self.falliti)
+            self.inviati, self.falliti = [], []
+
+class EsitiProva(Esiti):
+    """Esiti di una prova a secco: contati ma mai scritti nell'archivio"""
+
+    def scrivi(self):
+        self.inviati, self.falliti = [], []
+
+def _lock_invio():
+    """Un solo invio alla volta sulla macchina (due cron sovrapposti spedirebbero due volte)"""
+    if fcntl is None:
+        return None
+    file_lock = open(PROMEMORIA_LOCK, "a")
+    try:
+        fcntl.flock(file_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        file_lock.close()
+        raise RuntimeError("un altro invio dei promemoria è in corso")
+    return file_lock
+
+def invia_promemoria(archivio, trasporti, oggetto=PROMEMORIA_OGGETTO, testo=PROMEMORIA_TESTO, limite=None,
+                     prova=False):
+    """Invia i promemoria in attesa; restituisce i conteggi dell'invio.
+
+    `trasporti` associa a ogni canale ("email", "telefono") il suo Trasporto;
+    le righe di un canale senza trasporto restano da inviare. Con `prova`
+    gli esiti non vengono registrati: la coda resta com'era.
+    """
+    file_lock = _lock_invio()
+    esiti = EsitiProva(archivio) if prova else Esiti(archivio)
+    senza_trasporto = 0
+
+    # Contatti già raggiunti negli invii precedenti
+    righe = archivio.contatti_inviati()
+    next(righe)
+    gia_inviati = {n[1] for n in (normalizza_contatto(r[0]) for r in righe) if n}
+
+    in_corso = {}  # contatto -> [(id, tentativi)] delle righe che aspettano lo stesso invio
+    futuri = {}    # future -> contatto
+    try:
+        with ThreadPoolExecutor(max_workers=PROMEMORIA_THREAD, thread_name_prefix="promemoria") as pool:
+            def raccogli(completati):
+                for futuro in completati:
+                    contatto = futuri.pop(futuro)
+                    esito = futuro.result()
+                    for n, (promemoria_id, tentativi) in enumerate(in_corso.pop(contatto)):
+                        if esito is None:
+                            esiti.inviato(promemoria_id, "duplicati" if n else "inviati")
+                        else:
+                            esiti.fallito(promemoria_id, tentativi, *esito)
+                    if esito is None:
+                        gia_inviati.add(contatto)
+
+            righe = archivio.promemoria_da_inviare(PROMEMORIA_TENTATIVI_MAX)
+            next(righe)
+            letti = 0
+            for promemoria_id, contatto, tentativi in righe:
+                if limite is not None and letti >= limite:
+                    break
+                letti += 1
+                normalizzato = normalizza_contatto(contatto)
+                if normalizzato is None:
+                    esiti.fallito(promemoria_id, tentativi, "contatto non valido", True)
+                    continue
+                canale, contatto = normalizzato
+                if contatto in gia_inviati:
+                    esiti.inviato(promemoria_id, "duplicati")
+                    continue
+                if contatto in in_corso:
+                    # Stesso contatto già in invio: la riga ne condivide l'esito
+                    in_corso[contatto].append((promemoria_id, tentativi))
+                    continue
+                trasporto = trasporti.get(canale)
+                if trasporto is None:
+                    senza_trasporto += 1
+                    continue
+                # Al più due invii in coda per thread: la memoria non dipende dalle righe
+                if len(futuri) >= 2 * PROMEMORIA_THREAD:
+                    completati, _ = wait(futuri, return_when=FIRST_COMPLETED)
+                    raccogli(completati)
+                in_corso[contatto] = [(promemoria_id, tentativi)]
+                futuri[pool.submit(invia_con_ripetizioni, trasporto, contatto, oggetto, testo)] = contatto
+            righe.close()  # chiude il cursore lato server anche se ci si ferma a `limite`
+            raccogli(wait(futuri).done)
+    finally:
+        try:
+            esiti.scrivi()
+        finally:
+            for trasporto in set(trasporti.values()):
+                trasporto.chiudi()
+            if file_lock is not None:
+                file_lock.close()
+
+    return dict(esiti.conteggi, letti=letti, senza_trasporto=senza_trasporto)
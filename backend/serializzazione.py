@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Serializzazione JSON veloce delle risposte
+Le liste lette dal database arrivano come tuple con l'elenco delle colonne
+(nessun dizionario per riga dal cursore) e vengono codificate con orjson se
+installato, altrimenti con il modulo json della libreria standard.
+
+L'output è identico byte per byte a quello di flask.jsonify in modalità
+compatta: chiavi ordinate, caratteri non ASCII come \\uXXXX, date come
+RFC 822 e "\\n" finale. Unica eccezione: i float in notazione esponenziale
+(1e+16 contro 1e16), che le risposte servite da qui non contengono.
+"""
+
+import json
+import re
+from datetime import date
+
+from flask import current_app
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:  # dipendenza opzionale
+    orjson = None
+
+MOTORE = "orjson" if orjson is not None else "json"
+
+_NON_ASCII = re.compile(r"[^\x00-\x7e]")
+
+def _valore_predefinito(valore):
+    """Tipi non JSON, convertiti come il provider predefinito di Flask"""
+    if isinstance(valore, date):
+        return http_date(valore)
+    raise TypeError(f"Object of type {type(valore).__name__} is not JSON serializable")
+
+def _escape_unicode(corrispondenza):
+    codice = ord(corrispondenza.group())
+    if codice < 0x10000:
+        return f"\\u{codice:04x}"
+    codice -= 0x10000  # coppia surrogata, come json.dumps(ensure_ascii=True)
+    return f"\\u{0xd800 | (codice >> 10):04x}\\u{0xdc00 | (codice & 0x3ff):04x}"
+
+def codifica(valore):
+    """JSON compatto con chiavi ordinate, in byte"""
+    if orjson is None:
+        return json.dumps(
+            valore, default=_valore_predefinito, sort_keys=True, separators=(",", ":")
+        ).encode()
+    testo = orjson.dumps(
+        valore, default=_valore_predefinito,
+        option=orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    )
+    # orjson scrive UTF-8: l'escape serve solo se c'è almeno un carattere non ASCII (o DEL)
+    if not testo.isascii() or b"\x7f" in testo:
+        testo = _NON_ASCII.sub(_escape_unicode, testo.decode()).encode()
+    return testo
+
+def dizionari(colonne, righe):
+    """Righe tuple -> dizionari, con le colonne del cursore calcolate una volta"""
+    return [dict(zip(colonne, riga)) for riga in righe]
+
+def indici(colonne):
+    """Posizione di ogni colonna nelle righe tuple"""
+    return {colonna: i for i, colonna in enumerate(colonne)}
+
+def risposta_json(valore):
+    """Come jsonify(valore), con il codificatore veloce"""
+    app = current_app
+    if app.json.compact is False or (app.json.compact is None and app.debug):
+        # Output indentato di debug: resta a Flask
+        return app.json.response(valore)
+    return app.response_class(codifica(valore) + b"\n", mimetype=app.json.mimetype)
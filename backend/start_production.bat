@@ -17,6 +17,13 @@ if not exist "backend.py" (
     exit /b 1
 )
 
+REM Applica le migrazioni dello schema (una sola volta, prima di avviare il server)
+python backend.py migra
+if errorlevel 1 (
+    echo [ERROR] Migrazioni del database non riuscite.
+    exit /b 1
+)
+
 REM Prova prima con Waitress (server WSGI per Windows)
 python -c "import waitress" >nul 2>&1
 if not errorlevel 1 (
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Tracciamento delle query SQL (opzionale, TRACCIA_SQL=1)
+Per ogni richiesta registra le query eseguite (testo normalizzato, forma dei
+parametri, durata, righe) e aggrega i totali per query. Le query più lente di
+SQL_LENTA_MS finiscono nel log delle query lente con il piano di esecuzione.
+
+I dati restano nella memoria del worker: /api/debug/sql mostra quelli del
+worker che risponde.
+"""
+
+import os
+import re
+import threading
+import time
+from collections import deque
+
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, cursor as cursore_semplice
+
+ATTIVO = os.environ.get("TRACCIA_SQL") == "1"
+SOGLIA_LENTA_MS = float(os.environ.get("SQL_LENTA_MS", 200))
+EXPLAIN = os.environ.get("SQL_EXPLAIN", "1") == "1"
+MAX_QUERY_DISTINTE = 500   # oltre, le nuove query finiscono in un'unica voce
+MAX_LENTE = 100            # query lente conservate
+MAX_RICHIESTE = 50         # tracce delle ultime richieste conservate
+
+_RE_STRINGA = re.compile(r"'(?:[^']|'')*'")
+_RE_NUMERO = re.compile(r"\b\d+(?:\.\d+)?\b")
+_RE_SEGNAPOSTO = re.compile(r"%\(\w+\)s|%s")
+_RE_LISTA = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_RE_RIGHE = re.compile(r"\(\?\.\.\.\)(?:\s*,\s*\(\?\.\.\.\))+")
+_RE_SPAZI = re.compile(r"\s+")
+
+_lock = threading.Lock()
+_aggregati = {}                       # (route, query) -> totali
+_lente = deque(maxlen=MAX_LENTE)
+_richieste = deque(maxlen=MAX_RICHIESTE)
+_locale = threading.local()
+
+def normalizza(query):
+    """Testo della query con valori e segnaposto sostituiti da '?'"""
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    elif not isinstance(query, str):
+        query = str(query)
+    testo = _RE_STRINGA.sub("?", query)
+    testo = _RE_SEGNAPOSTO.sub("?", testo)
+    testo = _RE_NUMERO.sub("?", testo)
+    testo = _RE_LISTA.sub("(?...)", testo)
+    testo = _RE_RIGHE.sub("(?...),...", testo)
+    return _RE_SPAZI.sub(" ", testo).strip()
+
+def forma_parametri(parametri):
+    """Tipi dei parametri senza i valori, es. 'str,str,int' o 'data:str,ora:str'"""
+    if parametri is None:
+        return ""
+    if isinstance(parametri, dict):
+        return ",".join(f"{chiave}:{type(valore).__name__}" for chiave, valore in sorted(parametri.items()))
+    return ",".join(type(valore).__name__ for valore in parametri)
+
+def inizio_richiesta():
+    _locale.query = []
+
+def fine_richiesta(metodo, route, stato, durata):
+    """Chiude la traccia della richiesta corrente e la conserva tra le ultime"""
+    query = getattr(_locale, "query", None)
+    _locale.query = None
+    if query is None:
+        return
+    with _lock:
+        _richieste.append({
+            "metodo": metodo,
+            "route": route,
+            "stato": stato,
+            "durata_ms": round(durata * 1000, 3),
+            "db_ms": round(sum(q["durata_ms"] for q in query), 3),
+            "query": query
+        })
+
+def _spiega(cursore, query, parametri):
+    """Piano di esecuzione della query lenta; ANALYZE solo per le letture"""
+    if cursore.connection.closed:
+        return None
+    testo = query.decode("utf-8", "replace") if isinstance(query, bytes) else str(query)
+    comando = testo.lstrip().split(None, 1)[0].upper() if testo.strip() else ""
+    if ";" in testo.strip().rstrip(";"):
+        return None  # statement multipli: EXPLAIN non li accetta
+    if comando == "SELECT":
+        opzioni = "ANALYZE, BUFFERS"
+    elif comando in ("INSERT", "UPDATE", "DELETE", "WITH"):
+        opzioni = "COSTS"  # ANALYZE eseguirebbe di nuovo la scrittura
+    else:
+        return None
+
+    conn = cursore.connection
+    in_transazione = not conn.autocommit and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE
+    try:
+        # Cursore semplice: il piano non viene tracciato a sua volta. Dentro una
+        # transazione il savepoint evita che un errore dell'EXPLAIN la annulli.
+        with conn.cursor(cursor_factory=cursore_semplice) as cur:
+            if in_transazione:
+                cur.execute("SAVEPOINT traccia_explain")
+            try:
+                cur.execute(f"EXPLAIN ({opzioni}) {testo}", parametri)
+                return "\n".join(riga[0] for riga in cur.fetchall())
+            finally:
+                if in_transazione:
+                    cur.execute("ROLLBACK TO SAVEPOINT traccia_explain")
+                elif not conn.autocommit:
+                    conn.rollback()
+    except Exception as e:
+        return f"EXPLAIN non disponibile: {e}"
+
+def registra(cursore, query, parametri, durata, righe, route):
+    """Registra una query eseguita da un cursore del pool"""
+    normalizzata = normalizza(query)
+    durata_ms = durata * 1000
+    voce = {
+        "query": normalizzata,
+        "parametri": forma_parametri(parametri),
+        "durata_ms": round(durata_ms, 3),
+        "righe": righe
+    }
+    traccia = getattr(_locale, "query", None)
+    if traccia is not None:
+        traccia.append(voce)
+
+    chiave = (route or "fuori_richiesta", normalizzata)
+    with _lock:
+        totali = _aggregati.get(chiave)
+        if totali is None:
+            if len(_aggregati) >= MAX_QUERY_DISTINTE:
+                chiave = (chiave[0], "(altre query)")
+                totali = _aggregati.get(chiave)
+            if totali is None:
+                totali = _aggregati[chiave] = {"chiamate": 0, "totale_ms": 0.0, "max_ms": 0.0, "righe": 0}
+        totali["chiamate"] += 1
+        totali["totale_ms"] += durata_ms
+        totali["max_ms"] = max(totali["max_ms"], durata_ms)
+        totali["righe"] += max(righe, 0)
+
+    if durata_ms >= SOGLIA_LENTA_MS:
+        piano = _spiega(cursore, query, parametri) if EXPLAIN and cursore is not None else None
+        lenta = dict(voce, route=route, istante=time.time(), piano=piano)
+        with _lock:
+            _lente.append(lenta)
+        print(f"[SQL LENTA] {durata_ms:.1f} ms | {chiave[0]} | {normalizzata} | parametri ({voce['parametri']})")
+        if piano:
+            print(piano)
+
+def top(n=10, ordine="totale_ms"):
+    """Le `n` query con il valore più alto di `ordine` (totale_ms, max_ms, chiamate)"""
+    with _lock:
+        voci = [
+            dict(totali, route=route, query=query, medio_ms=totali["totale_ms"] / totali["chiamate"])
+            for (route, query), totali in _aggregati.items()
+        ]
+    voci.sort(key=lambda voce: voce[ordine], reverse=True)
+    for voce in voci:
+        for campo in ("totale_ms", "max_ms", "medio_ms"):
+            voce[campo] = round(voce[campo], 3)
+    return voci[:n]
+
+def lente():
+    with _lock:
+        return list(_lente)
+
+def ultime_richieste():
+    with _lock:
+        return list(_richieste)
+
+def azzera():
+    with _lock:
+        _aggregati.clear()
+        _lente.clear()
+        _richieste.clear()
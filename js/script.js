@@ -151,7 +151,28 @@ function formatPhoneError(phone) {
 }
 
 // ===== GESTIONE ERRORI MIGLIORATA =====
+function generateIdempotencyKey() {
+  if (window.crypto && typeof window.crypto.randomUUID === "function") {
+    return window.crypto.randomUUID();
+  }
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
+// Oltre questa attesa suggerita dal server l'errore viene mostrato subito
+const MAX_RETRY_AFTER_MS = 10000;
+
 async function fetchWithRetry(url, options = {}, retries = 3, delay = 1000) {
+  // Le POST usano la stessa Idempotency-Key per tutti i tentativi: se una
+  // richiesta è andata a buon fine ma la risposta si è persa, il retry non
+  // crea un duplicato e riceve la risposta originale
+  if ((options.method || "GET").toUpperCase() === "POST") {
+    const headers = new Headers(options.headers || {});
+    if (!headers.has("Idempotency-Key")) {
+      headers.set("Idempotency-Key", generateIdempotencyKey());
+    }
+    options = { ...options, headers };
+  }
+
   for (let i = 0; i < retries; i++) {
     try {
       const response = await fetch(url, options);
@@ -161,9 +182,14 @@ async function fetchWithRetry(url, options = {}, retries = 3, delay = 1000) {
         return response;
       }
 
-      // Se non è l'ultimo tentativo e l'errore è 5xx (server error), riprova
-      if (i < retries - 1 && response.status >= 500) {
-        await new Promise((resolve) => setTimeout(resolve, delay * (i + 1)));
+      // Se non è l'ultimo tentativo e l'errore è 5xx (server error) o 429
+      // (troppe richieste), riprova; Retry-After indica quanto aspettare
+      if (i < retries - 1 && (response.status >= 500 || response.status === 429)) {
+        const retryAfter = Number(response.headers.get("Retry-After")) * 1000;
+        if (retryAfter > MAX_RETRY_AFTER_MS) {
+          return response;
+        }
+        await new Promise((resolve) => setTimeout(resolve, retryAfter || delay * (i + 1)));
         continue;
       }
 
@@ -220,10 +246,74 @@ document.addEventListener("DOMContentLoaded", function () {
   const reservationForm = document.getElementById("reservation-form");
   const reservationError = document.getElementById("reservation-error");
   const reservationSuccess = document.getElementById("reservation-success");
+  const reservationSuccessTables = document.getElementById("reservation-success-tables");
+  const autoTableBtn = document.getElementById("auto-table-btn");
+  const guestsSelect = document.getElementById("guests");
+  const TAVOLO_AUTOMATICO = "auto";
+  const POSTI_PER_TAVOLO = 10;
+
+  // Applica ai pulsanti i posti disponibili ({tavolo: posti})
+  function applyTableAvailability(stato) {
+    tableBtns.forEach((btn) => {
+      const tableNum = btn.dataset.table;
+      if (!(tableNum in stato)) return;
+      const disponibili = stato[tableNum] || 0;
+
+      btn.style.opacity = "1";
+
+      // Tavoli riservati (0 posti) o senza disponibilità
+      if (disponibili === 0) {
+        btn.classList.add("booked");
+        btn.disabled = true;
+        btn.title = "Tavolo non disponibile";
+      } else {
+        btn.classList.remove("booked");
+        btn.disabled = false;
+        btn.title = `${disponibili} posti disponibili`;
+      }
+    });
+  }
+
+  // Stream SSE della disponibilità per lo slot selezionato
+  let tableStream = null;
+
+  function closeTableStream() {
+    if (tableStream) {
+      tableStream.close();
+      tableStream = null;
+    }
+  }
+
+  // Si iscrive agli aggiornamenti live; restituisce false se non supportato
+  function openTableStream(data, ora) {
+    closeTableStream();
+    if (typeof EventSource === "undefined") return false;
+
+    const url = `${CONFIG.API_BASE_URL}/api/tavoli/stream?data=${encodeURIComponent(data)}&ora=${encodeURIComponent(ora)}`;
+    const stream = new EventSource(url);
+    let received = false;
+
+    const onUpdate = (event) => {
+      received = true;
+      applyTableAvailability(JSON.parse(event.data));
+    };
+    stream.addEventListener("snapshot", onUpdate);
+    stream.addEventListener("delta", onUpdate);
+    stream.onerror = () => {
+      // Se lo stream non è mai partito (es. 503), torna al caricamento classico
+      if (!received && tableStream === stream) {
+        closeTableStream();
+        loadTableStatus(data, ora, false);
+      }
+    };
+    tableStream = stream;
+    return true;
+  }
 
   // Funzione per caricare lo stato dei tavoli dal backend
-  function loadTableStatus(data, ora) {
+  function loadTableStatus(data, ora, live = true) {
     if (!data || !ora) {
+      closeTableStream();
       // Se data/ora non sono selezionate, mostra tutti i tavoli come disponibili
       tableBtns.forEach((btn) => {
         btn.classList.remove("booked");
@@ -239,27 +329,14 @@ document.addEventListener("DOMContentLoaded", function () {
       btn.style.opacity = "0.5";
     });
 
+    // Aggiornamenti push se disponibili, altrimenti una singola richiesta
+    if (live && openTableStream(data, ora)) return;
+
     fetchWithRetry(`${CONFIG.API_BASE_URL}/api/tavoli?data=${data}&ora=${ora}`)
       .then((res) => res.json())
       .then((data) => {
         if (data.success) {
-          tableBtns.forEach((btn) => {
-            const tableNum = btn.dataset.table;
-            const disponibili = data.data[tableNum] || 0;
-
-            btn.style.opacity = "1";
-
-            // Tavoli riservati (0 posti) o senza disponibilità
-            if (disponibili === 0) {
-              btn.classList.add("booked");
-              btn.disabled = true;
-              btn.title = "Tavolo non disponibile";
-            } else {
-              btn.classList.remove("booked");
-              btn.disabled = false;
-              btn.title = `${disponibili} posti disponibili`;
-            }
-          });
+          applyTableAvailability(data.data);
         } else {
           // Reset buttons if API response is unsuccessful
           tableBtns.forEach((btn) => {
@@ -292,6 +369,7 @@ document.addEventListener("DOMContentLoaded", function () {
         loadTableStatus(dateInput.value, timeInput.value);
       } else {
         // Reset stato tavoli se data/ora non sono entrambe selezionate
+        closeTableStream();
         tableBtns.forEach((btn) => {
           btn.classList.remove("booked");
           btn.disabled = false;
@@ -304,26 +382,98 @@ document.addEventListener("DOMContentLoaded", function () {
     timeInput.addEventListener("change", updateTableStatus);
   }
 
+  // Aggiungi il tavolo selezionato come hidden input al form
+  function impostaTavolo(valore, etichetta) {
+    selectedTableLabel.classList.remove("hidden");
+    selectedTableSpan.textContent = etichetta;
+    let input = reservationForm.querySelector('input[name="table"]');
+    if (!input) {
+      input = document.createElement("input");
+      input.type = "hidden";
+      input.name = "table";
+      reservationForm.appendChild(input);
+    }
+    input.value = valore;
+  }
+
+  // Trattenuta: mentre si compila il modulo i posti del tavolo scelto restano
+  // riservati per qualche minuto; la prenotazione consuma il token
+  let trattenuta = null;
+  let richiestaTrattenuta = 0;
+
+  function rilasciaTrattenuta(token) {
+    fetch(`${CONFIG.API_BASE_URL}/api/tavoli/hold/${encodeURIComponent(token)}`, {
+      method: "DELETE",
+      keepalive: true,
+    }).catch(() => {});
+  }
+
+  function trattieniTavolo() {
+    const numero = ++richiestaTrattenuta;
+    if (trattenuta) {
+      rilasciaTrattenuta(trattenuta.token);
+      trattenuta = null;
+    }
+    const tavolo = reservationForm.querySelector('input[name="table"]')?.value;
+    const data = reservationForm.querySelector('[name="date"]')?.value;
+    const ora = reservationForm.querySelector('[name="time"]')?.value;
+    const ospiti = guestsSelect?.value;
+    if (!tavolo || tavolo === TAVOLO_AUTOMATICO || !data || !ora || !ospiti) return;
+
+    fetch(`${CONFIG.API_BASE_URL}/api/tavoli/hold`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ data, ora, tavolo, ospiti }),
+    })
+      .then((res) => res.json())
+      .then((risposta) => {
+        if (!risposta.success) {
+          if (numero === richiestaTrattenuta && risposta.error) {
+            reservationError.textContent = risposta.error;
+            reservationError.classList.remove("hidden");
+          }
+          return;
+        }
+        if (numero !== richiestaTrattenuta) {
+          // Nel frattempo è stato scelto un altro tavolo
+          rilasciaTrattenuta(risposta.trattenuta.token);
+          return;
+        }
+        trattenuta = risposta.trattenuta;
+        reservationError.classList.add("hidden");
+      })
+      .catch(() => {}); // senza trattenuta la prenotazione funziona comunque
+  }
+
+  // Assegnazione automatica: i tavoli (anche più di uno, vicini) li sceglie il backend
+  function sceltaAutomatica() {
+    tableBtns.forEach((b) => b.classList.remove("selected"));
+    impostaTavolo(TAVOLO_AUTOMATICO, "scelto dagli organizzatori");
+    trattieniTavolo();
+  }
+
   // Gestione selezione tavolo
   tableBtns.forEach((btn) => {
     btn.addEventListener("click", function () {
       if (btn.classList.contains("booked") || btn.disabled) return;
       tableBtns.forEach((b) => b.classList.remove("selected"));
       btn.classList.add("selected");
-      selectedTableLabel.classList.remove("hidden");
-      selectedTableSpan.textContent = btn.dataset.table;
-      // Aggiungi il tavolo selezionato come hidden input al form
-      let input = reservationForm.querySelector('input[name="table"]');
-      if (!input) {
-        input = document.createElement("input");
-        input.type = "hidden";
-        input.name = "table";
-        reservationForm.appendChild(input);
-      }
-      input.value = btn.dataset.table;
+      impostaTavolo(btn.dataset.table, btn.dataset.table);
+      trattieniTavolo();
     });
   });
 
+  autoTableBtn?.addEventListener("click", sceltaAutomatica);
+
+  // I gruppi più grandi di un tavolo vanno sempre su tavoli vicini
+  guestsSelect?.addEventListener("change", function () {
+    if (parseInt(guestsSelect.value, 10) > POSTI_PER_TAVOLO) sceltaAutomatica();
+    else trattieniTavolo();
+  });
+  ["date", "time"].forEach((nome) => {
+    reservationForm.querySelector(`[name="${nome}"]`)?.addEventListener("change", trattieniTavolo);
+  });
+
   // Validazione e submit form prenotazione
   reservationForm.addEventListener("submit", function (e) {
     e.preventDefault();
@@ -386,6 +536,13 @@ document.addEventListener("DOMContentLoaded", function () {
     if (!errorMsg && (!guestsInput || !guestsInput.value)) {
       errorMsg = "Seleziona il numero di persone";
       guestsInput?.setAttribute("aria-invalid", "true");
+    } else if (
+      !errorMsg &&
+      parseInt(guestsInput.value, 10) > POSTI_PER_TAVOLO &&
+      tableInput.value !== TAVOLO_AUTOMATICO
+    ) {
+      errorMsg = `Un tavolo ha ${POSTI_PER_TAVOLO} posti: per gruppi più grandi usa "Scegli tu il tavolo per me"`;
+      guestsInput?.setAttribute("aria-invalid", "true");
     }
 
     // 7. Validazione consenso privacy
@@ -430,6 +587,10 @@ document.addEventListener("DOMContentLoaded", function () {
         ora: timeInput.value,
         ospiti: guestsInput.value,
         tavolo: tableInput.value,
+        trattenuta:
+          trattenuta && trattenuta.tavolo === tableInput.value
+            ? trattenuta.token
+            : undefined,
         note:
           reservationForm.querySelector('[name="notes"]')?.value.trim() || "",
       }),
@@ -451,7 +612,25 @@ document.addEventListener("DOMContentLoaded", function () {
         return res.json();
       })
       .then((data) => {
+        if (data.in_coda) {
+          // Offline: il service worker la invierà appena torna la connessione
+          mostraPrenotazioneInCoda(data.message);
+          reservationForm.reset();
+          tableBtns.forEach((b) => b.classList.remove("selected"));
+          selectedTableLabel.classList.add("hidden");
+          selectedTableSpan.textContent = "";
+          return;
+        }
         if (data.success) {
+          trattenuta = null; // consumata dalla prenotazione
+          // Con l'assegnazione automatica mostra dove siederà il gruppo
+          if (reservationSuccessTables) {
+            const tavoli = data.prenotazione?.tavoli;
+            reservationSuccessTables.textContent = tavoli
+              ? `${tavoli.length > 1 ? "Tavoli assegnati" : "Tavolo assegnato"}: ${data.prenotazione.tavolo}`
+              : "";
+            reservationSuccessTables.classList.toggle("hidden", !tavoli);
+          }
           reservationSuccess.classList.remove("hidden");
           reservationForm.reset();
           tableBtns.forEach((b) => b.classList.remove("selected"));
@@ -1182,17 +1361,58 @@ document.addEventListener("DOMContentLoaded", function () {
 });
 
 // ===== SERVICE WORKER REGISTRATION =====
+function mostraPrenotazioneInCoda(messaggio) {
+  const avviso = document.getElementById("reservation-queued");
+  if (!avviso) return;
+  avviso.textContent = messaggio;
+  avviso.classList.remove("hidden");
+  setTimeout(() => avviso.classList.add("hidden"), 8000);
+}
+
+// Esito delle prenotazioni fatte offline, inviate dal service worker
+function mostraEsitoCoda({ risultati, error }) {
+  const rifiutate = risultati.filter((r) => !r.success);
+  if (error || rifiutate.length > 0) {
+    mostraErrore(
+      error ||
+        `${rifiutate.length} prenotazion${rifiutate.length === 1 ? "e" : "i"} fatte offline non confermat${rifiutate.length === 1 ? "a" : "e"}: ${rifiutate[0].error}`
+    );
+  }
+  const confermate = risultati.length - rifiutate.length;
+  if (confermate > 0) {
+    mostraPrenotazioneInCoda(
+      confermate === 1
+        ? "La prenotazione fatta offline è stata confermata!"
+        : `${confermate} prenotazioni fatte offline sono state confermate!`
+    );
+  }
+}
+
+function inviaPrenotazioniInCoda() {
+  // Per i browser senza Background Sync
+  navigator.serviceWorker.ready.then((registration) => {
+    if (registration.active) registration.active.postMessage("invia-prenotazioni");
+  });
+}
+
 if ("serviceWorker" in navigator) {
   window.addEventListener("load", () => {
     navigator.serviceWorker
       .register("/sw.js")
       .then((registration) => {
         console.log("Service Worker registrato:", registration.scope);
+        if (navigator.onLine) inviaPrenotazioniInCoda();
       })
       .catch((error) => {
         console.log("Service Worker non registrato:", error);
       });
   });
+  window.addEventListener("online", inviaPrenotazioniInCoda);
+  navigator.serviceWorker.addEventListener("message", (event) => {
+    if (event.data && event.data.tipo === "prenotazioni-inviate") {
+      mostraEsitoCoda(event.data);
+    }
+  });
 }
 
 // ===== HERO BACKGROUND: switch desktop/mobile =====
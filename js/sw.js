@@ -1,5 +1,18 @@
 // sw.js
 const CACHE_NAME = 'festa-sport-v1';
+const API_CACHE_NAME = 'festa-sport-api-v1';
+
+// API servite subito dalla cache e rivalidate in background (dati statici);
+// le altre GET API vanno in rete e usano la copia in cache solo offline
+const API_STALE_WHILE_REVALIDATE = ['/api/tavoli/info'];
+const API_OFFLINE = ['/api/tavoli', '/api/tavoli/griglia', '/api/feedback'];
+
+// Prenotazioni fatte senza rete: salvate in IndexedDB e inviate tutte insieme
+// a /api/prenota/batch quando la connessione torna (Background Sync, oppure
+// il messaggio 'invia-prenotazioni' della pagina dove non è supportato)
+const CODA_DB = 'festa-sport-coda';
+const CODA_SYNC_TAG = 'festa-prenotazioni';
+const BATCH_MAX = 50;
 const urlsToCache = [
   '/',
   '/index.html',
@@ -27,7 +40,7 @@ self.addEventListener('activate', (event) => {
     caches.keys().then((cacheNames) => {
       return Promise.all(
         cacheNames.map((cacheName) => {
-          if (cacheName !== CACHE_NAME) {
+          if (cacheName !== CACHE_NAME && cacheName !== API_CACHE_NAME) {
             return caches.delete(cacheName);
           }
         })
@@ -36,19 +49,211 @@ self.addEventListener('activate', (event) => {
   );
 });
 
+function rispostaOffline() {
+  return new Response(
+    JSON.stringify({ error: 'Offline - Funzionalità non disponibile' }),
+    { headers: { 'Content-Type': 'application/json' } }
+  );
+}
+
+// Richiesta di rete che aggiorna la copia in cache. Le risposte API hanno
+// ETag e "Cache-Control: no-cache": la cache HTTP del browser invia
+// If-None-Match e, se il server risponde 304, restituisce la copia già
+// scaricata senza trasferire di nuovo il corpo.
+function rivalida(request) {
+  return fetch(request).then((response) => {
+    if (response.ok) {
+      const copia = response.clone();
+      caches.open(API_CACHE_NAME).then((cache) => cache.put(request, copia));
+    }
+    return response;
+  });
+}
+
+function percorsoApi(url) {
+  return new URL(url).pathname;
+}
+
+// ===== CODA PRENOTAZIONI OFFLINE =====
+function apriCoda() {
+  return new Promise((resolve, reject) => {
+    const richiesta = indexedDB.open(CODA_DB, 1);
+    richiesta.onupgradeneeded = () => {
+      // coda: prenotazioni in attesa; invio: il blocco già inviato, da ripetere
+      // identico (stessa Idempotency-Key) finché il server non risponde
+      richiesta.result.createObjectStore('coda', { keyPath: 'chiave' });
+      richiesta.result.createObjectStore('invio', { keyPath: 'id' });
+    };
+    richiesta.onsuccess = () => resolve(richiesta.result);
+    richiesta.onerror = () => reject(richiesta.error);
+  });
+}
+
+function operazione(db, store, modo, azione) {
+  return new Promise((resolve, reject) => {
+    const tx = db.transaction(store, modo);
+    const risultato = azione(tx.objectStore(store));
+    tx.oncomplete = () => resolve(risultato && risultato.result);
+    tx.onerror = () => reject(tx.error);
+  });
+}
+
+function nuovaChiave() {
+  return self.crypto && self.crypto.randomUUID
+    ? self.crypto.randomUUID()
+    : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
+async function accodaPrenotazione(request) {
+  const dati = await request.json();
+  const db = await apriCoda();
+  await operazione(db, 'coda', 'readwrite', (store) => store.put({
+    chiave: request.headers.get('Idempotency-Key') || nuovaChiave(),
+    url: request.url.replace(/\/api\/prenota$/, '/api/prenota/batch'),
+    dati,
+    creata: Date.now()
+  }));
+  if (self.registration.sync) {
+    await self.registration.sync.register(CODA_SYNC_TAG).catch(() => {});
+  }
+  return new Response(
+    JSON.stringify({
+      success: true,
+      in_coda: true,
+      message: 'Sei offline: la prenotazione verrà inviata appena torna la connessione.'
+    }),
+    { status: 202, headers: { 'Content-Type': 'application/json' } }
+  );
+}
+
+async function avvisaPagine(messaggio) {
+  const pagine = await self.clients.matchAll({ includeUncontrolled: true, type: 'window' });
+  pagine.forEach((pagina) => pagina.postMessage(messaggio));
+}
+
+// Invia la coda a blocchi. Un blocco resta in 'invio' finché il server non
+// risponde: se la risposta si perde viene ripetuto con la stessa chiave e il
+// server restituisce l'esito già calcolato invece di prenotare di nuovo.
+// Ogni voce porta come "rif" la Idempotency-Key della POST /api/prenota
+// originale: se quella era arrivata al server (risposta persa), il blocco
+// riceve l'esito salvato invece di prenotare una seconda volta.
+async function inviaCoda() {
+  const db = await apriCoda();
+  for (;;) {
+    let blocco = await operazione(db, 'invio', 'readonly', (store) => store.get('corrente'));
+    if (!blocco) {
+      const voci = (await operazione(db, 'coda', 'readonly', (store) => store.getAll()))
+        .sort((a, b) => a.creata - b.creata)
+        .slice(0, BATCH_MAX);
+      if (voci.length === 0) {
+        return;
+      }
+      blocco = { id: 'corrente', chiave: nuovaChiave(), url: voci[0].url, voci };
+      await operazione(db, 'invio', 'readwrite', (store) => store.put(blocco));
+    }
+
+    // Errore di rete: l'eccezione fa ripetere il sync più tardi
+    const response = await fetch(blocco.url, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', 'Idempotency-Key': blocco.chiave },
+      body: JSON.stringify({
+        prenotazioni: blocco.voci.map((voce) => ({ ...voce.dati, rif: voce.chiave }))
+      })
+    });
+    if (response.status === 409 || response.status === 429 || response.status >= 500) {
+      throw new Error(`Invio prenotazioni rimandato (${response.status})`);
+    }
+
+    // Esito definitivo (anche un 400: ripeterlo non servirebbe), tranne le
+    // voci fallite per un errore del server ("riprova"), che restano in coda
+    const esito = await response.json().catch(() => ({}));
+    const daRiprovare = new Set(
+      (esito.risultati || []).filter((r) => r.riprova).map((r) => r.rif)
+    );
+    await new Promise((resolve, reject) => {
+      const tx = db.transaction(['coda', 'invio'], 'readwrite');
+      blocco.voci
+        .filter((voce) => !daRiprovare.has(voce.chiave))
+        .forEach((voce) => tx.objectStore('coda').delete(voce.chiave));
+      tx.objectStore('invio').delete('corrente');
+      tx.oncomplete = resolve;
+      tx.onerror = () => reject(tx.error);
+    });
+    await avvisaPagine({
+      tipo: 'prenotazioni-inviate',
+      risultati: (esito.risultati || []).filter((r) => !r.riprova),
+      error: response.ok ? null : esito.error || `Errore ${response.status}`
+    });
+    if (daRiprovare.size > 0) {
+      throw new Error(`${daRiprovare.size} prenotazioni rimandate`);
+    }
+  }
+}
+
+self.addEventListener('sync', (event) => {
+  if (event.tag === CODA_SYNC_TAG) {
+    event.waitUntil(inviaCoda());
+  }
+});
+
+self.addEventListener('message', (event) => {
+  if (event.data === 'invia-prenotazioni') {
+    event.waitUntil(inviaCoda().catch((err) => console.log('Coda prenotazioni:', err)));
+  }
+});
+
 // Intercetta le richieste
 self.addEventListener('fetch', (event) => {
+  // Lo stream SSE della disponibilità va direttamente in rete
+  if (event.request.url.includes('/api/tavoli/stream')) {
+    return;
+  }
+
+  if (event.request.method === 'GET' && event.request.url.includes('/api/')) {
+    const percorso = percorsoApi(event.request.url);
+
+    if (API_STALE_WHILE_REVALIDATE.includes(percorso)) {
+      // Stale-while-revalidate: copia in cache subito, aggiornata in background
+      event.respondWith(
+        caches.open(API_CACHE_NAME).then((cache) =>
+          cache.match(event.request).then((inCache) => {
+            const aggiornata = rivalida(event.request);
+            if (inCache) {
+              event.waitUntil(aggiornata.catch(() => {}));
+              return inCache;
+            }
+            return aggiornata.catch(rispostaOffline);
+          })
+        )
+      );
+      return;
+    }
+
+    if (API_OFFLINE.includes(percorso)) {
+      // Rete (rivalidata con ETag), copia in cache solo se offline
+      event.respondWith(
+        rivalida(event.request).catch(() =>
+          caches.match(event.request).then((inCache) => inCache || rispostaOffline())
+        )
+      );
+      return;
+    }
+  }
+
+  // Prenotazione senza rete: in coda per l'invio a blocchi
+  if (event.request.method === 'POST' && percorsoApi(event.request.url).endsWith('/api/prenota')) {
+    const copia = event.request.clone();
+    event.respondWith(
+      fetch(event.request).catch(() => accodaPrenotazione(copia).catch(rispostaOffline))
+    );
+    return;
+  }
+
   // Strategia: Cache First per risorse statiche, Network First per API
   if (event.request.url.includes('/api/')) {
     // Per le API, usa Network First
     event.respondWith(
-      fetch(event.request)
-        .catch(() => {
-          return new Response(
-            JSON.stringify({ error: 'Offline - Funzionalità non disponibile' }),
-            { headers: { 'Content-Type': 'application/json' } }
-          );
-        })
+      fetch(event.request).catch(rispostaOffline)
     );
   } else {
     // Per risorse statiche, usa Cache First